@@ -0,0 +1,303 @@
+"""
+In-process cache of the assistant's analysis DataFrame (Beneficiary -> Pregnancy ->
+Delivery -> Child, one row per child / delivery / pregnancy / beneficiary).
+
+The frame is keyed by the data version (see data_version.py) of every database it
+was read from: the primary or its read replica, or each shard. A request whose key
+still matches gets the cached frame. Once a write has bumped a version, requests keep
+getting the previous frame while one background thread rebuilds it, unless that frame
+was last confirmed current more than ANALYSIS_FRAME_MAX_STALE seconds ago (default
+300); then the request waits for the rebuild, as does the very first request.
+
+The cached frame uses compact dtypes (see compact_frame): categoricals for
+low-cardinality strings, int32 (int64 only where the values need it) and float32
+columns, native bool and datetime64 columns. Each build logs the memory footprint before and after.
+
+Each build also writes the frame's schema digest (see schema_digest): the compact
+column description the assistant puts in its prompt, so a request never inspects the
+frame to describe it.
+
+The frame is shared and must not be modified; generated analysis code gets a shallow
+copy (see sandbox.py), and with pandas copy-on-write anything it assigns or mutates
+lands in that copy, never in the shared frame.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, String, TypeDecorator, select
+
+from data_version import current_version
+from models import Beneficiary, Pregnancy, Delivery, Child
+from replica import analytics_engine
+from sharding import router as shard_router
+
+MAX_STALE = float(os.environ.get("ANALYSIS_FRAME_MAX_STALE", "300"))
+CHUNK_ROWS = int(os.environ.get("ANALYSIS_FRAME_CHUNK_ROWS", "50000"))
+CATEGORY_MAX_RATIO = 0.5  # strings with at most this many distinct values per non-null row become categoricals
+DIGEST_VALUES = 8  # category values listed per column in the schema digest
+
+# Left out of the digest: geography ids, including the joined rows' copies of the
+# beneficiary's (the names are there), the address (village and block), and contact
+# identifiers. They stay in the frame.
+_DIGEST_OMIT = re.compile(
+    r"(state|district|block|village)_id(_\w+)?|address|phone|rch_id"
+    r"|linked_user_id"
+)
+
+
+# Beneficiary -> Pregnancy -> Delivery -> Child as (model, alias for its id, suffix for
+# column names an earlier table already uses, foreign key to the previous table)
+_JOIN_CHAIN = [
+    (Beneficiary, "beneficiary_id", "", None),
+    (Pregnancy, "pregnancy_id", "_preg", "beneficiary_id"),
+    (Delivery, "delivery_id", "_del", "pregnancy_id"),
+    (Child, "child_id", "_child", "delivery_id"),
+]
+
+
+def _analysis_query():
+    """One LEFT JOIN over the chain with a unique alias per column (the names the old pandas merges produced)."""
+    columns, taken = [], set()
+    joined = previous = None
+    for model, id_alias, suffix, foreign_key in _JOIN_CHAIN:
+        table = model.__table__
+        joined = table if joined is None else joined.outerjoin(table, table.c[foreign_key] == previous.c.id)
+        for column in table.columns:
+            if column.name == foreign_key:
+                continue  # equal to the previous table's id
+            name = id_alias if column.name == "id" else column.name
+            if name in taken:
+                name += suffix
+            taken.add(name)
+            columns.append(column.label(name))
+        previous = table
+    return select(*columns).select_from(joined)
+
+
+ANALYSIS_QUERY = _analysis_query()
+
+
+def load_analysis_frame(conn):
+    """
+    Flat DataFrame of Beneficiary -> Pregnancy -> Delivery -> Child, one row per child
+    (or delivery, pregnancy, beneficiary where there is none further down), read from
+    `conn` with a single query in chunks of CHUNK_ROWS.
+    """
+    chunks = list(pd.read_sql(ANALYSIS_QUERY, conn, chunksize=CHUNK_ROWS))
+    if not chunks:
+        return pd.DataFrame(columns=[c.name for c in ANALYSIS_QUERY.selected_columns])
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+def _compact_int(series):
+    # No narrower than int32: generated code does arithmetic on these columns (sums,
+    # differences, products) and int8 / int16 would silently wrap
+    values = series.dropna()
+    info = np.iinfo("int32")
+    bits = 32 if values.empty or (info.min <= values.min() and values.max() <= info.max) else 64
+    # Outer-joined columns have NULLs: use the nullable dtype rather than float64
+    return series.astype(f"Int{bits}" if len(values) < len(series) else f"int{bits}")
+
+
+def _compact_column(series, sql_type):
+    if isinstance(sql_type, TypeDecorator):
+        sql_type = sql_type.impl_instance  # sqlmodel's AutoString is a String
+    if isinstance(sql_type, Boolean):
+        return series.astype("boolean" if series.isna().any() else bool)
+    if isinstance(sql_type, Integer):
+        return _compact_int(series)
+    if isinstance(sql_type, Float):
+        return series.astype("float32")
+    if isinstance(sql_type, (Date, DateTime)):
+        return pd.to_datetime(series)
+    if isinstance(sql_type, String):
+        distinct = series.nunique()
+        if distinct <= CATEGORY_MAX_RATIO * series.count():
+            return series.astype("category")
+    return series
+
+
+def compact_frame(df):
+    """`df` (as read by load_analysis_frame) with every column in the smallest dtype that holds its values."""
+    types = {c.name: c.type for c in ANALYSIS_QUERY.selected_columns}
+    return pd.DataFrame({name: _compact_column(df[name], types.get(name)) for name in df.columns}, index=df.index)
+
+
+def _dtype_kind(dtype):
+    """int, float, bool, datetime or text: what generated code relies on, not the width or the
+    categorical encoding that compact_frame picks from the current values."""
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    return dtype.kind
+
+
+def schema_hash(df):
+    schema = "\n".join(f"{name}:{_dtype_kind(dtype)}" for name, dtype in df.dtypes.items())
+    return hashlib.blake2b(schema.encode(), digest_size=8).hexdigest()
+
+
+def _format_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def _describe_column(series):
+    kind = series.dtype
+    values = series.dropna()
+    if isinstance(kind, pd.CategoricalDtype):
+        counts = values.value_counts()
+        text = ", ".join(repr(str(v)) for v in counts.index[:DIGEST_VALUES])
+        if len(counts) > DIGEST_VALUES:
+            text += f", ... ({len(counts)} values)"
+    elif pd.api.types.is_numeric_dtype(kind) or pd.api.types.is_datetime64_any_dtype(kind):
+        name = "date" if pd.api.types.is_datetime64_any_dtype(kind) else \
+            ("int" if pd.api.types.is_integer_dtype(kind) else "float")
+        text = f"{name} {_format_value(values.min())}..{_format_value(values.max())}" if len(values) else name
+    else:
+        text = f"text, e.g. {values.iloc[0]!r}" if len(values) else "text"
+    missing = 1 - len(values) / len(series) if len(series) else 0
+    if missing >= 0.01:
+        text += f"; {missing:.0%} missing"
+    return text
+
+
+def schema_digest(df):
+    """
+    Compact description of `df` for the assistant's prompt: per column its type and value
+    range, or its most frequent category values, and the share missing; bool columns on
+    one line. Identifier noise and empty columns are left out.
+    """
+    lines, flags = [], []
+    for name in df.columns:
+        if _DIGEST_OMIT.fullmatch(name) or not df[name].notna().any():
+            continue
+        if pd.api.types.is_bool_dtype(df[name].dtype):
+            flags.append(name)
+        else:
+            lines.append(f"- {name}: {_describe_column(df[name])}")
+    if flags:
+        lines.append(f"- True/False columns: {', '.join(flags)}")
+    return f"{len(df)} rows, one per child / delivery / pregnancy / beneficiary.\n" + "\n".join(lines)
+
+
+def _sources():
+    """(name, engine) of every database the frame is read from."""
+    if shard_router:
+        return [(shard.key, shard.engine) for shard in shard_router.shards()]
+    return [("primary", analytics_engine())]
+
+
+def _versions(sources):
+    versions = []
+    for name, source_engine in sources:
+        with source_engine.connect() as conn:
+            versions.append((name, current_version(conn)))
+    return tuple(versions)
+
+
+@dataclass
+class AnalysisFrame:
+    key: tuple  # ((source name, data version), ...) the frame was read at
+    frame: pd.DataFrame
+    confirmed_at: float  # time.monotonic() the key last matched the databases
+    build_seconds: float
+    raw_bytes: int  # memory footprint as read, before compact_frame
+    bytes: int
+    schema_hash: str  # of the column names and dtype kinds; keys the generated-code cache
+    columns: list
+    digest: str  # schema_digest of the frame, for the assistant's prompt
+
+
+class AnalysisFrameCache:
+    def __init__(self, max_stale=MAX_STALE):
+        self.max_stale = max_stale
+        self._entry = None
+        self._build_lock = threading.Lock()  # one build at a time
+        self._flag_lock = threading.Lock()
+        self._rebuilding = False
+        self.hits = 0
+        self.stale_hits = 0
+        self.builds = 0
+
+    def _build(self):
+        sources = _sources()
+        # Versions first: a write racing the load makes the next check rebuild, never the reverse
+        key = _versions(sources)
+        started = time.perf_counter()
+        frames = []
+        for name, source_engine in sources:
+            with source_engine.connect() as conn:
+                frames.append(load_analysis_frame(conn))
+        frame = pd.concat(frames, ignore_index=True) if len(frames) > 1 else (frames[0] if frames else pd.DataFrame())
+        raw_bytes = int(frame.memory_usage(deep=True).sum())
+        # After the concat, so every shard's strings share one set of categories
+        frame = compact_frame(frame)
+        entry = AnalysisFrame(key=key, frame=frame, confirmed_at=time.monotonic(),
+                              build_seconds=time.perf_counter() - started,
+                              raw_bytes=raw_bytes, bytes=int(frame.memory_usage(deep=True).sum()),
+                              schema_hash=schema_hash(frame), columns=frame.columns.tolist(),
+                              digest=schema_digest(frame))
+        self._entry = entry
+        self.builds += 1
+        print(f"Analysis frame built: {len(frame)} rows in {entry.build_seconds:.2f}s at {key}, "
+              f"{entry.raw_bytes / 1e6:.1f} MB -> {entry.bytes / 1e6:.1f} MB with compact dtypes")
+        return entry
+
+    def _rebuild(self):
+        try:
+            with self._build_lock:
+                self._build()
+        except Exception as e:
+            # Keep serving the previous frame; the next request retries
+            print(f"Analysis frame rebuild failed: {e}")
+        finally:
+            self._rebuilding = False
+
+    def _rebuild_in_background(self):
+        with self._flag_lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name="analysis-frame", daemon=True).start()
+
+    def entry(self):
+        """The current AnalysisFrame, rebuilt first if there is none or it is too stale."""
+        entry = self._entry
+        if entry is not None:
+            if entry.key == _versions(_sources()):
+                entry.confirmed_at = time.monotonic()
+                self.hits += 1
+                return entry
+            if time.monotonic() - entry.confirmed_at <= self.max_stale:
+                self.stale_hits += 1
+                self._rebuild_in_background()
+                return entry
+        with self._build_lock:
+            # Another request may have finished the build while this one waited
+            if self._entry is not None and self._entry is not entry:
+                return self._entry
+            return self._build()
+
+    def stats(self):
+        entry = self._entry
+        return {
+            "rows": len(entry.frame) if entry else None,
+            "bytes": entry.bytes if entry else None,
+            "raw_bytes": entry.raw_bytes if entry else None,
+            "build_seconds": round(entry.build_seconds, 3) if entry else None,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "builds": self.builds,
+        }
+
+
+analysis_frames = AnalysisFrameCache()
@@ -0,0 +1,479 @@
+"""
+Declarative analytics queries over Beneficiary -> Pregnancy -> Delivery -> Child.
+
+A query is JSON (POST /api/analytics/query):
+
+    {
+      "entity": "pregnancy",                      # rows counted: beneficiary | pregnancy | delivery | child
+      "filters": [
+        {"field": "state", "value": "Bihar"},     # op defaults to "eq"
+        {"field": "risk_level_prebirth", "op": "in", "value": ["HIGH", "MEDIUM"]},
+        {"field": "anemia", "value": true},
+        {"field": "hb_level", "op": "lt", "value": 8}
+      ],
+      "group_by": ["district"],
+      "aggregates": [{"fn": "count"}, {"fn": "avg", "field": "hb_level", "as": "mean_hb"}],
+      "order_by": "-count",                       # an aggregate or group field; "-" for descending
+      "limit": 10
+    }
+
+Fields are the entity's own columns and those of its ancestors (a child query may
+filter on the mother's age), by name or as "table.column"; the entity's own column
+wins a clash. `state`, `district` and `block` take GeoUnit names and compile to the
+indexed *_id columns of the entity's own table, whose geography is copied from the
+beneficiary. Grouped, they come back as the unit's name prefixed with the units above it
+("Bihar / Patna / Bihta"), less the state when the filters pin one ("Patna / Bihta"), so
+same-named units under different parents stay apart. Identifiers and contact details (names, phone, RCH / PM-JAY ids) are
+not queryable.
+
+Ops: eq, ne, in, not_in, lt, lte, gt, gte, between, is_null, not_null.
+Aggregates: count (rows, or non-null values of a field), sum, avg, min, max.
+
+Each query compiles to one parameterized SELECT ... GROUP BY per database (the
+analytics replica, or every shard in scope), with only the joins its fields need.
+Cost limits: at most MAX_FILTERS filters, MAX_GROUP_BY group fields, MAX_AGGREGATES
+aggregates and MAX_IN_VALUES values per list; results of at most MAX_LIMIT rows; at
+most MAX_GROUPS groups per database before the top-N; and ANALYTICS_QUERY_TIMEOUT
+seconds of SQLite time (default 5), after which the statement is interrupted.
+Invalid or too expensive queries raise QueryError, whose message is shown to the caller.
+"""
+import operator
+import os
+import time
+from dataclasses import dataclass
+from datetime import date
+
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, TypeDecorator, cast, func, literal, select
+from sqlalchemy.exc import OperationalError
+
+from geography import filter_ids, parent_ids, unit_path
+from models import Beneficiary, Pregnancy, Delivery, Child
+from replica import analytics_engine
+from sharding import router as shard_router
+
+TIMEOUT = float(os.environ.get("ANALYTICS_QUERY_TIMEOUT", "5"))
+MAX_FILTERS = 12
+MAX_GROUP_BY = 3
+MAX_AGGREGATES = 6
+MAX_IN_VALUES = 200
+MAX_LIMIT = 1000
+DEFAULT_LIMIT = 100
+MAX_GROUPS = 20000
+PROGRESS_STEPS = 10000  # SQLite VM steps between deadline checks
+
+ENTITIES = {"beneficiary": Beneficiary, "pregnancy": Pregnancy, "delivery": Delivery, "child": Child}
+# Child -> Delivery -> Pregnancy -> Beneficiary, with the column linking each to its parent
+_PARENTS = {
+    Child: (Delivery, "delivery_id"),
+    Delivery: (Pregnancy, "pregnancy_id"),
+    Pregnancy: (Beneficiary, "beneficiary_id"),
+}
+GEO_LEVELS = {"state": "state_id", "district": "district_id", "block": "block_id"}
+_HIDDEN = {
+    "id", "name", "phone", "rch_id", "pmjay_id", "address", "linked_user_id",
+    "beneficiary_id", "pregnancy_id", "delivery_id", "village", "village_id",
+    "state", "district", "block", "state_id", "district_id", "block_id",
+}
+_COMPARE = {"eq": operator.eq, "ne": operator.ne, "lt": operator.lt, "lte": operator.le, "gt": operator.gt,
+            "gte": operator.ge}
+_OPS = set(_COMPARE) | {"in", "not_in", "between", "is_null", "not_null"}
+_AGGREGATES = {"count": func.count, "sum": func.sum, "avg": func.avg, "min": func.min, "max": func.max}
+
+
+class QueryError(ValueError):
+    """The query is invalid or exceeds a cost limit; the message is meant for the caller."""
+
+
+@dataclass
+class Field:
+    name: str
+    column: object  # the model attribute
+    kind: str  # geo | category | number | integer | bool | date
+    model: type
+
+
+@dataclass
+class Aggregate:
+    fn: str
+    alias: str
+    field: Field = None
+
+
+@dataclass
+class CompiledQuery:
+    entity: str
+    statement: object
+    group_by: list
+    aggregates: list
+    order_by: str
+    descending: bool
+    limit: int
+    state: str = None  # the one state the filters pin, for shard pruning
+    sql_ordered: bool = False  # ORDER BY / LIMIT pushed into the statement
+
+
+def _chain(model):
+    """`model` and its ancestors, nearest first."""
+    models = [model]
+    while models[-1] in _PARENTS:
+        models.append(_PARENTS[models[-1]][0])
+    return models
+
+
+def _kind(column):
+    sql_type = column.type
+    if isinstance(sql_type, TypeDecorator):
+        sql_type = sql_type.impl_instance
+    if isinstance(sql_type, Boolean):
+        return "bool"
+    if isinstance(sql_type, Integer):
+        return "integer"
+    if isinstance(sql_type, Float):
+        return "number"
+    if isinstance(sql_type, (Date, DateTime)):
+        return "date"
+    return "category"
+
+
+def fields(entity):
+    """Queryable field names of `entity` -> kind, for clients building queries."""
+    model = ENTITIES[entity]
+    result = {name: "geo" for name in GEO_LEVELS}
+    for m in _chain(model):
+        for column in m.__table__.columns:
+            if column.name in _HIDDEN or column.name in result:
+                continue
+            result[column.name] = _kind(column)
+    return result
+
+
+def _field(model, name):
+    if not isinstance(name, str) or not name:
+        raise QueryError("Field names must be non-empty strings.")
+    if name in GEO_LEVELS:
+        return Field(name, getattr(model, GEO_LEVELS[name]), "geo", model)
+    table, _, column_name = name.rpartition(".")
+    chain = _chain(model)
+    if table:
+        chain = [m for m in chain if m.__tablename__ == table]
+        if not chain:
+            raise QueryError(f"Table '{table}' is not {model.__tablename__} or one of its parents.")
+    for m in chain:
+        column = m.__table__.columns.get(column_name)
+        if column is not None and column_name not in _HIDDEN:
+            return Field(name, getattr(m, column_name), _kind(column), m)
+    raise QueryError(f"Unknown field '{name}' for {model.__tablename__} queries.")
+
+
+def _value(f, value):
+    """`value` checked and converted for field `f`."""
+    if f.kind == "bool":
+        if not isinstance(value, bool):
+            raise QueryError(f"'{f.name}' takes true or false.")
+        return value
+    if f.kind in ("number", "integer"):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise QueryError(f"'{f.name}' takes a number.")
+        return value
+    if f.kind == "date":
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise QueryError(f"'{f.name}' takes an ISO date (YYYY-MM-DD).")
+    if not isinstance(value, str):
+        raise QueryError(f"'{f.name}' takes a string.")
+    return value
+
+
+def _values(f, value, op):
+    if not isinstance(value, list) or not value:
+        raise QueryError(f"'{op}' on '{f.name}' takes a non-empty list.")
+    if len(value) > MAX_IN_VALUES:
+        raise QueryError(f"At most {MAX_IN_VALUES} values per list.")
+    return [_value(f, v) for v in value]
+
+
+def _geo_ids(f, names):
+    ids = set()
+    for name in names:
+        ids.update(filter_ids(**{f.name: name}).get(GEO_LEVELS[f.name], []))
+    return sorted(ids)
+
+
+def _geo_conditions(model, f, op, value):
+    """
+    Conditions for a geography filter. eq / in also pin the levels above (a district's
+    state), so the (state_id, district_id, block_id) indexes can seek on their prefix.
+    """
+    if op not in ("eq", "ne", "in", "not_in"):
+        raise QueryError(f"'{f.name}' supports eq, ne, in, not_in, is_null and not_null.")
+    names = _values(f, value, op) if op in ("in", "not_in") else [_value(f, value)]
+    ids = _geo_ids(f, names)
+    if op in ("ne", "not_in"):
+        return [f.column.not_in(ids)]
+    conditions = [f.column.in_(ids)]
+    levels = list(GEO_LEVELS)
+    for level in reversed(levels[:levels.index(f.name)]):
+        ids = parent_ids(ids)
+        if not ids:
+            break
+        conditions.append(getattr(model, GEO_LEVELS[level]).in_(ids))
+    return conditions
+
+
+def _condition(f, op, value):
+    column = f.column
+    if op == "is_null":
+        return column.is_(None)
+    if op == "not_null":
+        return column.is_not(None)
+    if op in ("in", "not_in"):
+        values = _values(f, value, op)
+        return column.in_(values) if op == "in" else column.not_in(values)
+    if op == "between":
+        if not isinstance(value, list) or len(value) != 2:
+            raise QueryError(f"'between' on '{f.name}' takes [low, high].")
+        return column.between(_value(f, value[0]), _value(f, value[1]))
+    if op in ("lt", "lte", "gt", "gte") and f.kind in ("category", "bool"):
+        raise QueryError(f"'{op}' needs a number or date field; '{f.name}' is not one.")
+    value = _value(f, value)
+    if op == "eq" and f.kind in ("category", "bool"):
+        # Inlined rather than bound, so SQLite can match the partial ix_*_high / ix_child_offtrack indexes
+        value = literal(value, literal_execute=True)
+    return _COMPARE[op](column, value)
+
+
+def _pinned_state(filters):
+    """The single state an eq / one-value in filter restricts the query to, if any (None for malformed filters)."""
+    if not isinstance(filters, list):
+        return None
+    for item in filters:
+        if isinstance(item, dict) and item.get("field") == "state" and item.get("op", "eq") in ("eq", "in"):
+            value = item.get("value")
+            if isinstance(value, list) and len(value) == 1:
+                value = value[0]
+            if isinstance(value, str):
+                return value
+    return None
+
+
+def _list(spec, key, limit):
+    items = spec.get(key) or []
+    if not isinstance(items, list):
+        raise QueryError(f"'{key}' must be a list.")
+    if len(items) > limit:
+        raise QueryError(f"At most {limit} {key.replace('_', ' ')} per query.")
+    return items
+
+
+def compile_query(spec, single_source=True):
+    """CompiledQuery for the JSON `spec`; raises QueryError."""
+    if not isinstance(spec, dict):
+        raise QueryError("The query must be a JSON object.")
+    entity = spec.get("entity", "pregnancy")
+    if not isinstance(entity, str) or entity not in ENTITIES:
+        raise QueryError(f"'entity' must be one of {', '.join(ENTITIES)}.")
+    model = ENTITIES[entity]
+
+    filters = _list(spec, "filters", MAX_FILTERS)
+    conditions, used = [], {model}
+    for item in filters:
+        if not isinstance(item, dict):
+            raise QueryError("Each filter is an object with 'field', 'op' and 'value'.")
+        op = item.get("op", "eq")
+        if not isinstance(op, str) or op not in _OPS:
+            raise QueryError(f"Unknown op '{op}'; use one of {', '.join(sorted(_OPS))}.")
+        f = _field(model, item.get("field"))
+        if f.kind == "geo" and op not in ("is_null", "not_null"):
+            conditions.extend(_geo_conditions(model, f, op, item.get("value")))
+        else:
+            conditions.append(_condition(f, op, item.get("value")))
+        used.add(f.model)
+
+    group_by = []
+    for name in _list(spec, "group_by", MAX_GROUP_BY):
+        f = _field(model, name)
+        if f.kind in ("number", "date"):
+            raise QueryError(f"Cannot group by '{name}'; group by a category, bool, whole-number or geography field.")
+        group_by.append(f)
+        used.add(f.model)
+
+    aggregates = []
+    for item in _list(spec, "aggregates", MAX_AGGREGATES) or [{"fn": "count"}]:
+        if not isinstance(item, dict) or not isinstance(item.get("fn"), str) or item["fn"] not in _AGGREGATES:
+            raise QueryError(f"Each aggregate needs 'fn': one of {', '.join(_AGGREGATES)}.")
+        fn = item["fn"]
+        f = _field(model, item["field"]) if item.get("field") else None
+        if f is None and fn != "count":
+            raise QueryError(f"'{fn}' needs a 'field'.")
+        if f is not None:
+            if fn in ("sum", "avg") and f.kind not in ("number", "integer", "bool"):
+                raise QueryError(f"'{fn}' needs a number or bool field; '{f.name}' is not one.")
+            if fn in ("min", "max") and f.kind not in ("number", "integer", "date"):
+                raise QueryError(f"'{fn}' needs a number or date field; '{f.name}' is not one.")
+            if f.kind == "geo":
+                raise QueryError(f"Cannot aggregate '{f.name}'; group by it instead.")
+            used.add(f.model)
+        alias = item.get("as") or (fn if f is None else f"{fn}_{f.name.replace('.', '_')}")
+        if not isinstance(alias, str):
+            raise QueryError("An aggregate's 'as' must be a string.")
+        aggregates.append(Aggregate(fn, alias, f))
+    names = [f.name for f in group_by] + [a.alias for a in aggregates]
+    if len(set(names)) != len(names):
+        raise QueryError("Group fields and aggregate names must be unique.")
+
+    order_by = spec.get("order_by") or (f"-{aggregates[0].alias}" if group_by else None)
+    if order_by is not None and not isinstance(order_by, str):
+        raise QueryError("'order_by' must be a string.")
+    descending = bool(order_by) and order_by.startswith("-")
+    order_by = order_by.lstrip("-") if order_by else None
+    if order_by is not None and order_by not in names:
+        raise QueryError(f"'order_by' must name a group field or aggregate: {', '.join(names)}.")
+    limit = spec.get("limit", DEFAULT_LIMIT)
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_LIMIT:
+        raise QueryError(f"'limit' must be a whole number from 1 to {MAX_LIMIT}.")
+
+    columns = [f.column.label(f.name) for f in group_by]
+    for a in aggregates:
+        target = a.field.column if a.field else None
+        if a.fn == "count":
+            columns.append((func.count(target) if target is not None else func.count()).label(a.alias))
+        else:
+            if a.field.kind == "bool":
+                target = cast(target, Integer)  # sum / avg of the 0/1 values, typed as numbers
+            columns.append(_AGGREGATES[a.fn](target).label(a.alias))
+            if a.fn == "avg":
+                # Weights for averaging across shards
+                columns.append(func.count(target).label(f"__n_{a.alias}"))
+    statement = select(*columns).select_from(model)
+    child = model
+    # Inner joins up to the farthest ancestor a field needs
+    for parent in _chain(model)[1:]:
+        if not used.intersection(_chain(parent)):
+            break
+        link = _PARENTS[child][1]
+        statement = statement.join(parent, parent.id == getattr(child, link))
+        child = parent
+    if conditions:
+        statement = statement.where(*conditions)
+    if group_by:
+        statement = statement.group_by(*(f.column for f in group_by))
+
+    # Top-N in SQL when one database answers and the order key sorts the same there (not a GeoUnit id)
+    order_field = next((f for f in group_by if f.name == order_by), None)
+    sql_ordered = single_source and not (order_field is not None and order_field.kind == "geo")
+    if sql_ordered:
+        if order_by:
+            key = statement.selected_columns[order_by]
+            statement = statement.order_by(key.desc() if descending else key.asc())
+        statement = statement.limit(limit + 1)  # one more to tell whether the result was cut
+    else:
+        statement = statement.limit(MAX_GROUPS + 1)
+
+    return CompiledQuery(entity=entity, statement=statement, group_by=group_by, aggregates=aggregates,
+                         order_by=order_by, descending=descending, limit=limit,
+                         state=_pinned_state(filters), sql_ordered=sql_ordered)
+
+
+# --- Execution ---
+def _engines(state=None):
+    if shard_router:
+        return [shard.engine for shard in shard_router.for_scope(state)]
+    return [analytics_engine()]
+
+
+def _execute(source_engine, statement, deadline):
+    with source_engine.connect() as conn:
+        raw = conn.connection.driver_connection
+        # SQLite calls this every PROGRESS_STEPS steps; a true return interrupts the statement
+        raw.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+        try:
+            return [row._asdict() for row in conn.execute(statement)]
+        except OperationalError as e:
+            if "interrupt" in str(e):
+                raise QueryError(f"The query took longer than its {TIMEOUT:g} s limit. "
+                                 "Add filters (a state or district) to narrow it.")
+            raise
+        finally:
+            raw.set_progress_handler(None, 0)
+
+
+def _merge(rows, query):
+    """Combine the per-database groups of the same key."""
+    keys = [f.name for f in query.group_by]
+    merged = {}
+    for row in rows:
+        key = tuple(row[k] for k in keys)
+        into = merged.get(key)
+        if into is None:
+            merged[key] = dict(row)
+            continue
+        for a in query.aggregates:
+            mine, theirs = into[a.alias], row[a.alias]
+            if theirs is None:
+                continue
+            if mine is None:
+                into[a.alias] = theirs
+                if a.fn == "avg":
+                    into[f"__n_{a.alias}"] = row[f"__n_{a.alias}"]
+            elif a.fn in ("count", "sum"):
+                into[a.alias] = mine + theirs
+            elif a.fn == "min":
+                into[a.alias] = min(mine, theirs)
+            elif a.fn == "max":
+                into[a.alias] = max(mine, theirs)
+            else:
+                n_mine, n_theirs = into[f"__n_{a.alias}"], row[f"__n_{a.alias}"]
+                into[a.alias] = (mine * n_mine + theirs * n_theirs) / (n_mine + n_theirs)
+                into[f"__n_{a.alias}"] = n_mine + n_theirs
+    return list(merged.values())
+
+
+def run_query(spec):
+    """
+    Result of the JSON query `spec`:
+    {"entity", "columns", "rows": [{column: value}], "truncated", "sources", "seconds"}.
+    Raises QueryError.
+    """
+    started = time.monotonic()
+    state = _pinned_state(spec.get("filters") or []) if isinstance(spec, dict) else None
+    engines = _engines(state)
+    query = compile_query(spec, single_source=len(engines) == 1)
+    deadline = started + TIMEOUT
+    rows = []
+    for source_engine in engines:
+        part = _execute(source_engine, query.statement, deadline)
+        if not query.sql_ordered and len(part) > MAX_GROUPS:
+            raise QueryError(f"The query has more than {MAX_GROUPS} groups; group by fewer or coarser fields.")
+        rows.extend(part)
+    if len(engines) > 1:
+        rows = _merge(rows, query)
+
+    labels = {}
+    for row in rows:
+        for f in query.group_by:
+            if f.kind == "geo" and row[f.name] is not None:
+                uid = row[f.name]
+                if uid not in labels:
+                    path = unit_path(uid)
+                    labels[uid] = " / ".join(path[1:] if query.state and len(path) > 1 else path)
+                row[f.name] = labels[uid]
+        for a in query.aggregates:
+            row.pop(f"__n_{a.alias}", None)
+            if a.fn == "avg" and row[a.alias] is not None:
+                row[a.alias] = round(float(row[a.alias]), 4)
+    if query.order_by and not query.sql_ordered:
+        key = query.order_by
+        # Missing values last in either direction
+        rows = (sorted((r for r in rows if r[key] is not None), key=lambda r: r[key], reverse=query.descending)
+                + [r for r in rows if r[key] is None])
+    truncated = len(rows) > query.limit
+    columns = [f.name for f in query.group_by] + [a.alias for a in query.aggregates]
+    return {
+        "entity": query.entity,
+        "columns": columns,
+        "rows": rows[:query.limit],
+        "truncated": truncated,
+        "sources": len(engines),
+        "seconds": round(time.monotonic() - started, 4),
+    }
@@ -0,0 +1,393 @@
+"""
+Fast path for the assistant's most frequent questions.
+
+A small deterministic matcher recognizes:
+
+    high_risk_count          "How many high-risk pregnancies are there in Bihar?"
+    district_risk            "Show district-wise risk distribution"
+    offtrack_by_block        "Off-track children by block"
+    beneficiaries_by_state   "Which states have the most beneficiaries?"
+
+and answers them from the RiskRollup table or one indexed GROUP BY, in the same
+text / plot response shapes the LLM path returns, in milliseconds. A question
+matches only if every word in it is accounted for (an intent's concepts, a known
+state name, or filler such as "how many" or "show me").
+
+Questions that slice the data more finely are compiled to an analytics query (see
+analytics_query.py) when they are made only of: the rows counted (pregnancies,
+deliveries, children, beneficiaries), a risk level ("high pre-birth risk"), yes/no
+conditions ("with anemia", "preterm"), a state, one grouping ("by district",
+"by delivery type") and optionally an average ("average hb level"):
+
+    "count HIGH pre-birth risk by district in Bihar where anemia"
+    "how many preterm deliveries with nicu admission by state"
+
+Anything else ("... in 2023", "compare ...") falls through to the LLM.
+"""
+import re
+from dataclasses import dataclass, field
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from analytics_query import MAX_LIMIT, QueryError, compile_query, run_query
+from geography import state_id, state_names, unit_name
+from models import Beneficiary, RiskRollup
+from replica import analytics_engine
+from sharding import router as shard_router
+
+PLOT_MAX_BARS = 20  # bars in a distribution chart; the description names the total
+
+# Multi-word spellings folded into one token before matching
+_PHRASES = [
+    (re.compile(r"\bhigh[\s-]*risk\b"), " highrisk "),
+    (re.compile(r"\boff[\s-]*track\b"), " offtrack "),
+    (re.compile(r"\b(district|block|state)[\s-]*wise\b"), r" \1 "),
+    (re.compile(r"\bpre[\s-]*birth\b"), " prebirth "),
+    (re.compile(r"\bpost[\s-]*birth\b"), " postbirth "),
+]
+
+# Concept -> words that express it
+_CONCEPTS = {
+    "highrisk": {"highrisk"},
+    "risk": {"risk", "risks", "level", "levels"},
+    "district": {"district", "districts"},
+    "block": {"block", "blocks"},
+    "state": {"state", "states"},
+    "offtrack": {"offtrack", "missed", "overdue", "defaulter", "defaulters", "immunization", "immunisation",
+                 "vaccination", "vaccinations"},
+    "children": {"child", "children", "kids", "infants", "babies", "newborns"},
+    "pregnancies": {"pregnancy", "pregnancies", "cases", "mothers", "women", "patients"},
+    "beneficiaries": {"beneficiary", "beneficiaries", "mothers", "women", "registered", "registrations", "enrolled"},
+}
+
+_FILLER = {
+    "a", "all", "an", "and", "any", "are", "across", "by", "can", "chart", "count", "counts", "currently",
+    "display", "distribution", "do", "does", "each", "give", "graph", "has", "have", "how", "i", "in", "is",
+    "list", "many", "me", "most", "much", "number", "numbers", "of", "our", "per", "please", "plot", "show",
+    "tell", "the", "there", "total", "wise", "what", "whats", "which", "with", "you", "bar", "breakdown",
+    "get", "see", "want", "to", "we", "s", "now", "right", "today", "overall", "so", "far", "would",
+    "like", "know", "data", "find", "at", "present",
+}
+
+
+@dataclass
+class Intent:
+    name: str
+    required: list  # each entry, a concept or a tuple of alternative concepts, must appear
+    optional: list = field(default_factory=list)  # concepts that may also appear
+    scoped: bool = True  # may be narrowed to one state
+
+
+# In priority order: grouped questions before the plain count they contain
+INTENTS = [
+    Intent("district_risk", required=["district", ("risk", "highrisk")], optional=["pregnancies"]),
+    Intent("offtrack_by_block", required=["offtrack", "block"], optional=["children"]),
+    Intent("beneficiaries_by_state", required=["beneficiaries", "state"], scoped=False),
+    Intent("high_risk_count", required=["highrisk"], optional=["pregnancies", "risk"]),
+]
+
+
+def _concepts(requirement):
+    return requirement if isinstance(requirement, tuple) else (requirement,)
+
+
+def _normalize(query):
+    text = query.lower()
+    for pattern, replacement in _PHRASES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _find_state(text):
+    """(state name, text without it) for the longest state name in `text`."""
+    for name in sorted(state_names(), key=len, reverse=True):
+        pattern = re.compile(r"\b" + re.escape(name.lower()) + r"\b")
+        if pattern.search(text):
+            return name, pattern.sub(" ", text)
+    return None, text
+
+
+def match_intent(query):
+    """(Intent, state name or None) the question asks for, or None if it needs the LLM."""
+    state, text = _find_state(_normalize(query))
+    words = re.findall(r"[a-z0-9]+", text)
+    if not words:
+        return None
+    for intent in INTENTS:
+        if state and not intent.scoped:
+            continue
+        concepts = [c for r in intent.required for c in _concepts(r)] + intent.optional
+        allowed = _FILLER.union(*(_CONCEPTS[c] for c in concepts))
+        if any(w not in allowed for w in words):
+            continue
+        present = {c for c in concepts if any(w in _CONCEPTS[c] for w in words)}
+        if all(present.intersection(_concepts(r)) for r in intent.required):
+            return intent, state
+    return None
+
+
+# --- Aggregates ---
+def _engines(state=None):
+    if shard_router:
+        return [shard.engine for shard in shard_router.for_scope(state)]
+    return [analytics_engine()]
+
+
+def _rollup_rows(state=None):
+    query = select(RiskRollup)
+    if state:
+        sid = state_id(state)
+        query = query.where(RiskRollup.state_id == (sid if sid is not None else -1))
+    rows = []
+    for source_engine in _engines(state):
+        with Session(source_engine) as session:
+            rows.extend(session.exec(query).all())
+    return rows
+
+
+def _sum_by(rows, key, value):
+    totals = {}
+    for r in rows:
+        name = unit_name(getattr(r, key)) or "Unknown"
+        totals[name] = totals.get(name, 0) + getattr(r, value)
+    return totals
+
+
+def _bar(title, totals, what, scope, total=None):
+    ranked = sorted(((k, v) for k, v in totals.items() if v), key=lambda kv: (-kv[1], kv[0]))
+    shown = ranked[:PLOT_MAX_BARS]
+    if ranked:
+        top, top_value = ranked[0]
+        description = f"{top} has the most {what}{scope} ({top_value:,})"
+        if len(ranked) > len(shown):
+            description += f"; showing the top {len(shown)} of {len(ranked)}"
+        description += f". Total: {sum(v for _, v in ranked) if total is None else total:,}."
+    else:
+        description = f"No {what} found{scope}."
+    return {
+        "response": description,
+        "action": "plot",
+        "plot_data": {
+            "type": "plot",
+            "chart_type": "bar",
+            "title": title,
+            "data": [{"name": k, "value": int(v)} for k, v in shown],
+            "x_key": "name",
+            "y_key": "value",
+            "description": description,
+        },
+    }
+
+
+def _high_risk_count(state, scope):
+    rows = _rollup_rows(state)
+    pregs = sum(r.preg_high for r in rows)
+    dels = sum(r.del_high for r in rows)
+    total = sum(r.pregnancies for r in rows)
+    share = f" ({100 * pregs / total:.1f}% of {total:,} pregnancies)" if total else ""
+    return {
+        "response": f"There are {pregs:,} high-risk pregnancies{scope}{share}, "
+                    f"and {dels:,} deliveries were classified high-risk after birth.",
+        "action": "none",
+    }
+
+
+def _district_risk(state, scope):
+    return _bar(f"High-Risk Pregnancies by District{scope}", _sum_by(_rollup_rows(state), "district_id", "preg_high"),
+                "high-risk pregnancies", scope)
+
+
+def _offtrack_by_block(state, scope):
+    return _bar(f"Off-Track Children by Block{scope}", _sum_by(_rollup_rows(state), "block_id", "offtrack_children"),
+                "off-track children", scope)
+
+
+def _beneficiaries_by_state(state, scope):
+    query = select(Beneficiary.state_id, func.count(Beneficiary.id)).group_by(Beneficiary.state_id)
+    totals = {}
+    for source_engine in _engines():
+        with Session(source_engine) as session:
+            for sid, count in session.exec(query).all():
+                name = unit_name(sid) or "Unknown"
+                totals[name] = totals.get(name, 0) + count
+    return _bar("Beneficiaries by State", totals, "beneficiaries", scope)
+
+
+_ANSWERS = {
+    "high_risk_count": _high_risk_count,
+    "district_risk": _district_risk,
+    "offtrack_by_block": _offtrack_by_block,
+    "beneficiaries_by_state": _beneficiaries_by_state,
+}
+
+
+# --- Analytics-query slices ---
+_ENTITY_WORDS = {
+    "pregnancy": {"pregnancy", "pregnancies", "pregnant", "mothers", "women", "cases", "patients"},
+    "delivery": {"delivery", "deliveries", "births"},
+    "child": {"child", "children", "kids", "infants", "babies", "newborns"},
+    "beneficiary": {"beneficiary", "beneficiaries", "registered", "registrations", "enrolled"},
+}
+_DEPTH = ["beneficiary", "pregnancy", "delivery", "child"]
+_PLURALS = {"beneficiary": "beneficiaries", "pregnancy": "pregnancies", "delivery": "deliveries", "child": "children"}
+_GEO_WORDS = {"state": {"state", "states"}, "district": {"district", "districts"}, "block": {"block", "blocks"}}
+
+_RISK = [
+    re.compile(r"\b(?:(?P<stage>prebirth|postbirth|antenatal|postnatal)\s+)?(?P<level>high)risk\b"),
+    re.compile(r"\b(?P<level>high|medium|moderate|low)\s+(?:(?P<stage>prebirth|postbirth|antenatal|postnatal)\s+)?risk\b"),
+]
+# Yes/no conditions: phrase -> bool field (see analytics_query.fields)
+_FLAGS = {
+    "anemia": "anemia", "anaemia": "anemia", "anemic": "anemia", "anaemic": "anemia",
+    "high bp": "high_bp", "hypertension": "high_bp", "hypertensive": "high_bp",
+    "diabetes": "diabetes", "diabetic": "diabetes", "thyroid": "thyroid",
+    "hiv positive": "hiv_positive", "hiv": "hiv_positive", "syphilis": "syphilis_positive",
+    "previous c section": "previous_csection", "previous csection": "previous_csection",
+    "multiple pregnancy": "multiple_pregnancy", "twins": "multiple_pregnancy",
+    "danger signs": "danger_signs", "rh negative": "rh_negative", "bpl card": "bpl_card", "bpl": "bpl_card",
+    "preterm": "preterm", "premature": "preterm", "stillbirth": "stillbirth", "stillbirths": "stillbirth",
+    "stillborn": "stillbirth", "nicu admission": "nicu_admission", "nicu": "nicu_admission",
+    "offtrack": "offtrack_flag",
+}
+_GROUPS = {
+    "delivery type": "delivery_type", "blood group": "blood_group", "education": "education",
+    "occupation": "occupation", "caste category": "caste_category", "caste": "caste_category",
+    "sex": "sex", "gender": "sex", "risk level": None, "risk": None,  # None: the pre- or post-birth level
+}
+_MEASURES = {
+    "hb level": "hb_level", "hb": "hb_level", "hemoglobin": "hb_level", "haemoglobin": "hb_level",
+    "age": "age", "bmi": "bmi", "birth weight": "birthweight_grams", "birthweight": "birthweight_grams",
+    "anc visits": "anc_visits_completed", "gestational age": "gestational_age_weeks",
+}
+_SLICE_FILLER = {"where", "who", "whose", "had", "having", "among", "only", "for", "from", "average", "mean",
+                 "avg", "prebirth", "postbirth"}
+
+
+def _phrase(words):
+    return re.compile(r"\b" + r"[\s-]*".join(map(re.escape, words.split())) + r"\b")
+
+
+_FLAG_PATTERNS = [(_phrase(p), f) for p, f in sorted(_FLAGS.items(), key=lambda kv: -len(kv[0]))]
+_GROUP_PATTERN = re.compile(r"\b(?:by|per|across|each)\s+(" + "|".join(
+    r"[\s-]*".join(map(re.escape, p.split())) for p in sorted(_GROUPS, key=len, reverse=True)) + r")s?\b")
+_MEASURE_PATTERNS = [(_phrase(p), f) for p, f in sorted(_MEASURES.items(), key=lambda kv: -len(kv[0]))]
+
+
+@dataclass
+class Slice:
+    spec: dict  # the analytics query
+    entity: str
+    qualifiers: list  # human-readable filters, for the answer text
+    state: str = None
+    group: str = None
+    measure: str = None
+
+
+def match_slice(query):
+    """Slice for a question the analytics query API can answer, or None."""
+    text = _normalize(query)
+    state, text = _find_state(text)
+    filters, qualifiers = [], []
+    stage = level = None
+    for pattern in _RISK:
+        found = pattern.search(text)
+        if found:
+            level = found.group("level").upper().replace("MODERATE", "MEDIUM")
+            stage = found.group("stage")
+            text = text[:found.start()] + " " + text[found.end():]
+            break
+    group = None
+    found = _GROUP_PATTERN.search(text)
+    if found:
+        group = _GROUPS[re.sub(r"[\s-]+", " ", found.group(1))] or "risk_level"
+        text = text[:found.start()] + " " + text[found.end():]
+    measure = None
+    if re.search(r"\b(average|mean|avg)\b", text):
+        for pattern, name in _MEASURE_PATTERNS:
+            if pattern.search(text):
+                measure, text = name, pattern.sub(" ", text, count=1)
+                break
+        if measure is None:
+            return None
+    flags = []
+    for pattern, name in _FLAG_PATTERNS:
+        if pattern.search(text):
+            text = pattern.sub(" ", text)
+            if name not in flags:
+                flags.append(name)
+
+    words = re.findall(r"[a-z0-9]+", text)
+    entities = {e for e, vocabulary in _ENTITY_WORDS.items() if any(w in vocabulary for w in words)}
+    geo = [level_name for level_name, vocabulary in _GEO_WORDS.items() if any(w in vocabulary for w in words)]
+    allowed = _FILLER | _SLICE_FILLER | set().union(*_ENTITY_WORDS.values()) | set().union(*_GEO_WORDS.values())
+    if any(w not in allowed for w in words) or len(geo) > 1 or (geo and group):
+        return None
+    group = group or (geo[0] if geo else None)
+    if not (level or flags or group or measure or state):
+        return None  # nothing to slice by: leave it to the LLM
+
+    postbirth = stage in ("postbirth", "postnatal")
+    entity = max(entities, key=_DEPTH.index) if entities else ("delivery" if postbirth else "pregnancy")
+    risk_field = "risk_level_postbirth" if postbirth else "risk_level_prebirth"
+    if group == "risk_level":
+        group = risk_field
+    if state:
+        filters.append({"field": "state", "value": state})
+    if level:
+        filters.append({"field": risk_field, "value": level})
+        qualifiers.append(f"{level} {'post' if postbirth else 'pre'}-birth risk")
+    for name in flags:
+        filters.append({"field": name, "value": True})
+        qualifiers.append(name.replace("_flag", "").replace("_", " ").replace("offtrack", "off-track"))
+    aggregates = [{"fn": "count"}]
+    if measure:
+        if group:
+            return None  # one number per group reads better as a chart the LLM path can draw
+        aggregates.append({"fn": "avg", "field": measure, "as": "average"})
+    spec = {"entity": entity, "filters": filters, "aggregates": aggregates, "limit": MAX_LIMIT}
+    if group:
+        spec["group_by"] = [group]
+    try:
+        compile_query(spec)
+    except QueryError:
+        return None  # e.g. a condition recorded on a later stage than the rows asked about
+    return Slice(spec=spec, entity=entity, qualifiers=qualifiers, state=state, group=group, measure=measure)
+
+
+def answer_slice(sliced):
+    """The assistant response for a matched Slice."""
+    result = run_query(sliced.spec)
+    scope = f" in {sliced.state}" if sliced.state else ""
+    what = _PLURALS[sliced.entity] + (f" with {' and '.join(sliced.qualifiers)}" if sliced.qualifiers else "")
+    if sliced.group:
+        name = "risk level" if sliced.group.startswith("risk_level") else sliced.group.replace("_", " ")
+        totals = {str(r[sliced.group]) if r[sliced.group] is not None else "Unknown": r["count"] for r in result["rows"]}
+        total = None
+        if result["truncated"]:
+            total = run_query({**sliced.spec, "group_by": []})["rows"][0]["count"]
+        return _bar(f"{what[0].upper()}{what[1:]} by {name.title()}{scope}", totals, what, scope, total=total)
+    row = result["rows"][0]
+    if sliced.measure:
+        if row["average"] is None:
+            return {"response": f"No {sliced.measure.replace('_', ' ')} is recorded for {what}{scope}.", "action": "none"}
+        return {
+            "response": f"The average {sliced.measure.replace('_', ' ')} is {row['average']:,.2f} "
+                        f"across {row['count']:,} {what}{scope}.",
+            "action": "none",
+        }
+    return {"response": f"There are {row['count']:,} {what}{scope}.", "action": "none"}
+
+
+def answer(intent, state=None):
+    """The assistant response for a matched intent."""
+    return _ANSWERS[intent.name](state, f" in {state}" if state else "")
+
+
+def answer_intent(query):
+    """The assistant response for a recognized question, or None to use the LLM."""
+    matched = match_intent(query)
+    if matched is not None:
+        return answer(*matched)
+    sliced = match_slice(query)
+    return answer_slice(sliced) if sliced else None
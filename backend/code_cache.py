@@ -0,0 +1,164 @@
+"""
+Persistent cache of the assistant's LLM-generated `analyze(df)` code.
+
+Entries are keyed by the normalized question (case, punctuation and spacing folded,
+"please" dropped) together with the analysis frame's schema hash, so a repeated
+question skips the code-generation round trip and only the execution step runs,
+while a schema change (new column, changed dtype) never reuses code written for the
+old frame. Only code that executed successfully is stored.
+
+On reuse the code is validated again: it must compile, define `analyze`, and every
+`df['column']` it reads without creating must exist in the current frame. Code that
+fails validation or raises when run is discarded, and the next request regenerates it.
+
+The cache is a small SQLite file next to the database (not a table in it: writes
+there would bump the data version and invalidate every dashboard cache), shared by
+all workers and bounded to ASSISTANT_CODE_CACHE_SIZE entries (default 1000) by
+least-recent use. Hit/miss counters are per process; see `stats()`.
+"""
+import ast
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import database
+
+MAX_ENTRIES = int(os.environ.get("ASSISTANT_CODE_CACHE_SIZE", "1000"))
+PATH = os.environ.get("ASSISTANT_CODE_CACHE_PATH") or database.sqlite_file_name + ".code-cache"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generated_code (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    schema_hash TEXT NOT NULL,
+    code TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0
+)
+"""
+_LAST_USED_INDEX = "CREATE INDEX IF NOT EXISTS ix_generated_code_last_used ON generated_code (last_used)"
+
+_FILLER = {"please", "pls", "kindly"}
+
+
+def normalize_query(query):
+    words = re.findall(r"[a-z0-9]+", (query or "").lower())
+    return " ".join(w for w in words if w not in _FILLER)
+
+
+def _column_references(tree):
+    """Column names the code reads as df['name'] without assigning them itself."""
+    read, assigned = set(), set()
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "df"
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+            (assigned if isinstance(node.ctx, ast.Store) else read).add(node.slice.value)
+    return read - assigned
+
+
+def validate_code(code, columns):
+    """None if `code` can run against a frame with `columns`, else the reason it cannot."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return f"syntax error: {e}"
+    if not any(isinstance(node, ast.FunctionDef) and node.name == "analyze" for node in tree.body):
+        return "no analyze() function"
+    missing = _column_references(tree) - set(columns)
+    if missing:
+        return f"unknown columns {sorted(missing)}"
+    return None
+
+
+class GeneratedCodeCache:
+    def __init__(self, path=PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._created = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.rejected = 0  # cached code that failed validation or execution and was dropped
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=database.profile["busy_timeout_ms"] / 1000)
+        if not self._created:
+            with self._lock:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute(_SCHEMA)
+                conn.execute(_LAST_USED_INDEX)
+                conn.commit()
+                self._created = True
+        return conn
+
+    @staticmethod
+    def key(query, schema_hash):
+        return hashlib.blake2b(f"{schema_hash}\n{normalize_query(query)}".encode(), digest_size=16).hexdigest()
+
+    def get(self, query, schema_hash, columns):
+        """Validated cached code for the question, or None."""
+        key = self.key(query, schema_hash)
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT code FROM generated_code WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            problem = validate_code(row[0], columns)
+            if problem:
+                print(f"Discarding cached analysis code: {problem}")
+                conn.execute("DELETE FROM generated_code WHERE key = ?", (key,))
+                conn.commit()
+                self.rejected += 1
+                self.misses += 1
+                return None
+            conn.execute("UPDATE generated_code SET last_used = ?, uses = uses + 1 WHERE key = ?", (time.time(), key))
+            conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, query, schema_hash, code):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO generated_code (key, query, schema_hash, code, created_at, last_used, uses) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0) ON CONFLICT (key) DO UPDATE SET code = excluded.code, last_used = excluded.last_used",
+                (self.key(query, schema_hash), normalize_query(query), schema_hash, code, now, now),
+            )
+            # Least recently used first out
+            conn.execute(
+                "DELETE FROM generated_code WHERE key IN "
+                "(SELECT key FROM generated_code ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+        self.stores += 1
+
+    def discard(self, query, schema_hash):
+        """Drop code that failed when run, so the next request asks the LLM again."""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM generated_code WHERE key = ?", (self.key(query, schema_hash),))
+            conn.commit()
+        self.rejected += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with closing(self._connect()) as conn:
+            entries = conn.execute("SELECT count(*) FROM generated_code").fetchone()[0]
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "rejected": self.rejected,
+        }
+
+
+code_cache = GeneratedCodeCache()
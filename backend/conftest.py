@@ -0,0 +1,16 @@
+"""
+pytest setup for the backend tests.
+
+Every test module shares one scratch database (MAATRINET_DB is read once, when
+database.py is first imported), so tests create their own rows and never assume an
+empty table. maatrinet.db is never touched.
+"""
+import os
+import tempfile
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "tests.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+os.environ.setdefault("MAATRINET_SHARD_DIR", os.path.join(tempfile.mkdtemp(), "shards"))
+
+# Scripts that call a server running on localhost:8000, not tests
+collect_ignore = ["test_login.py", "test_state_filter.py"]
@@ -2,16 +2,16 @@
 One-time migration script:
 1. Add `state` column to beneficiary table
 2. Add `state` column to user table (for authorizer scope)
-3. Populate beneficiary.state from Excel district→state mapping
+3. Populate beneficiary.state from the geography district→state mapping
 4. Create 19 state-level authorizer users
 """
 
 import sqlite3
-import pandas as pd
 import hashlib
 
+from geography import BACKFILL_SQL, district_state_map
+
 DB_PATH = "d:/MUMMY - BABY/maatrinet.db"
-EXCEL_PATH = "d:/MUMMY - BABY/data/RCH_Maternal_Child_5000_Synthetic.xlsx"
 
 def hash_password(pw: str) -> str:
     return hashlib.sha256(pw.encode()).hexdigest()
@@ -38,11 +38,9 @@ def main():
 
     conn.commit()
 
-    # ── 3. Build district → state mapping from Excel ─────────────────────────
-    print("\nLoading Excel to build district→state map...")
-    df = pd.read_excel(EXCEL_PATH)
-    dist_state_map = dict(zip(df["District"].str.strip(), df["State"].str.strip()))
-    print(f"  Found {len(dist_state_map)} unique district→state mappings")
+    # ── 3. District → state mapping from the in-memory geography dimension ──
+    dist_state_map = district_state_map()
+    print(f"\n  Found {len(dist_state_map)} unique district→state mappings")
 
     # ── 4. Populate beneficiary.state from district mapping ──────────────────
     print("Updating beneficiary.state from district mapping...")
@@ -53,8 +51,12 @@ def main():
             (state, district)
         )
         updated += cur.rowcount
+    # Keep the geography copies on pregnancy/delivery/child in step
+    for sql in BACKFILL_SQL:
+        cur.execute(sql)
     conn.commit()
     print(f"  Updated {updated} beneficiary records with state")
+    print("  Run `python geography.py` and `python rollups.py` to refresh geography ids and dashboard rollups.")
 
     # Verify
     cur.execute("SELECT state, COUNT(*) FROM beneficiary GROUP BY state ORDER BY COUNT(*) DESC")
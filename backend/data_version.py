@@ -0,0 +1,41 @@
+"""
+Data-version counter for cache invalidation.
+
+The single DataVersion row is bumped once per transaction, in the same transaction as
+the write, whenever a Session flushes inserts, updates or deletes (registrations,
+status updates, recomputes, rollup rebuilds). Caches remember the version they were
+built from and treat any other version as stale. Because the counter lives in the
+database it is shared by every worker process.
+
+Writes that bypass the ORM (raw SQL backfills) must call bump_data_version themselves.
+"""
+from sqlalchemy import event, select, update
+from sqlmodel import Session
+
+from models import DataVersion
+
+# Table constructs rather than text, so a schema_translate_map (an ATTACHed shard) applies
+_READ = select(DataVersion.version).where(DataVersion.id == 1)
+_BUMP = update(DataVersion).where(DataVersion.id == 1).values(version=DataVersion.version + 1)
+
+
+def current_version(conn) -> int:
+    """Committed data version as seen by `conn` (a Connection or Session)."""
+    return conn.execute(_READ).scalar() or 0
+
+def bump_data_version(conn):
+    conn.execute(_BUMP)
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_on_write(session, flush_context, instances):
+    if session.info.get("data_version_bumped"):
+        return
+    if any(not isinstance(obj, DataVersion) for obj in (*session.new, *session.dirty, *session.deleted)):
+        bump_data_version(session.connection())
+        session.info["data_version_bumped"] = True
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _reset_bump(session):
+    session.info.pop("data_version_bumped", None)
@@ -1,19 +1,54 @@
-from sqlmodel import create_engine, Session, SQLModel
+from contextlib import contextmanager
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 import os
 
-import os
+from db_profile import ENVIRONMENT, load_profile, connect_args, pool_args, apply_pragmas, install_tracing
+from migrations import migrate
 
 # Use absolute path to avoid ambiguity between backend/maatrinet.db and root/maatrinet.db
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-sqlite_file_name = os.path.join(BASE_DIR, "maatrinet.db")
+# MAATRINET_DB points the app at another file (e.g. the scratch DB in test_query_plans.py)
+sqlite_file_name = os.environ.get("MAATRINET_DB") or os.path.join(BASE_DIR, "maatrinet.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+# Pragmas, pool sizes and query tracing for MAATRINET_ENV (see db_profile.py)
+profile = load_profile(ENVIRONMENT)
+
+engine = create_engine(sqlite_url, connect_args=connect_args(profile), **pool_args(profile))
+
+# aiosqlite engine for the async read routes; writes and scripts keep using `engine`
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{sqlite_file_name}",
+                                   connect_args=connect_args(profile), **pool_args(profile))
+
+for _label, _sync_engine in (("sync", engine), ("async", async_engine.sync_engine)):
+    apply_pragmas(_sync_engine, profile)
+    install_tracing(_sync_engine, _label, profile)
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    """Bring the schema up to date via the versioned migrations in migrations.py. Returns the versions applied."""
+    return migrate(engine)
+
+@contextmanager
+def startup_lock():
+    """Cross-process lock so only one worker at a time migrates and seeds (no-op where fcntl is missing)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(sqlite_file_name + ".startup.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
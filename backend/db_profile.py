@@ -0,0 +1,149 @@
+"""
+SQLite engine profiles: connection pragmas, pool sizing and query tracing per environment.
+
+MAATRINET_ENV selects the profile (production, development or test; default production).
+Every profile runs the database in WAL mode, so dashboard readers keep reading the
+last committed snapshot while a recompute or import holds the single write lock, and
+writers wait up to `busy_timeout_ms` for each other instead of failing with
+"database is locked".
+
+SQL is no longer echoed. A sampled fraction of statements, plus every statement
+slower than `slow_ms`, is logged as one JSON line on the "maatrinet.sql" logger:
+
+    {"engine": "async", "ms": 3.2, "rows": 40, "sql": "SELECT ...", "slow": false}
+
+Any profile setting can be overridden with MAATRINET_DB_<NAME> (e.g.
+MAATRINET_DB_TRACE_SAMPLE=1 to trace every statement, MAATRINET_DB_POOL_SIZE=20).
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import event
+
+PROFILES = {
+    "production": {
+        "synchronous": "NORMAL",        # WAL + NORMAL: durable across app crashes, only an OS crash can lose the last commits
+        "cache_size_kb": 64_000,        # page cache per connection
+        "mmap_size_mb": 256,
+        "temp_store": "MEMORY",         # sorts and temp B-trees for GROUP BY / ORDER BY stay off disk
+        "busy_timeout_ms": 5_000,
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout_s": 30,
+        "trace_sample": 0.01,
+        "slow_ms": 250,
+    },
+    "development": {
+        "synchronous": "NORMAL",
+        "cache_size_kb": 32_000,
+        "mmap_size_mb": 128,
+        "temp_store": "MEMORY",
+        "busy_timeout_ms": 5_000,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout_s": 30,
+        "trace_sample": 1.0,
+        "slow_ms": 100,
+    },
+    "test": {
+        "synchronous": "OFF",           # scratch databases: speed over durability
+        "cache_size_kb": 8_000,
+        "mmap_size_mb": 0,
+        "temp_store": "MEMORY",
+        "busy_timeout_ms": 5_000,
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout_s": 10,
+        "trace_sample": 0.0,
+        "slow_ms": 0,                   # 0: no slow-query logging
+    },
+}
+
+ENVIRONMENT = os.environ.get("MAATRINET_ENV", "production")
+
+
+def load_profile(environment=ENVIRONMENT):
+    """The named profile with MAATRINET_DB_<NAME> environment overrides applied."""
+    if environment not in PROFILES:
+        raise ValueError(f"Unknown MAATRINET_ENV {environment!r}; expected one of {sorted(PROFILES)}")
+    profile = dict(PROFILES[environment])
+    for name, default in profile.items():
+        value = os.environ.get(f"MAATRINET_DB_{name.upper()}")
+        if value is not None:
+            profile[name] = type(default)(value)
+    return profile
+
+
+def connect_args(profile):
+    # Driver-level busy timeout (seconds) covers the connect itself; the pragma covers every statement
+    return {"check_same_thread": False, "timeout": profile["busy_timeout_ms"] / 1000}
+
+
+def pool_args(profile):
+    return {"pool_size": profile["pool_size"], "max_overflow": profile["max_overflow"],
+            "pool_timeout": profile["pool_timeout_s"]}
+
+
+def apply_pragmas(sync_engine, profile):
+    """Set the profile's pragmas on every new DBAPI connection of `sync_engine` (also the async engine's)."""
+    pragmas = [
+        "PRAGMA journal_mode = WAL",
+        f"PRAGMA synchronous = {profile['synchronous']}",
+        f"PRAGMA cache_size = -{int(profile['cache_size_kb'])}",
+        f"PRAGMA mmap_size = {int(profile['mmap_size_mb']) * 1024 * 1024}",
+        f"PRAGMA temp_store = {profile['temp_store']}",
+        f"PRAGMA busy_timeout = {int(profile['busy_timeout_ms'])}",
+    ]
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+# --- Query tracing ---
+trace_logger = logging.getLogger("maatrinet.sql")
+if not trace_logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+def install_tracing(sync_engine, label, profile):
+    """Log sampled and slow statements of `sync_engine` as JSON lines (see module docstring)."""
+    sample, slow_ms = profile["trace_sample"], profile["slow_ms"]
+    if sample <= 0 and slow_ms <= 0:
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("trace_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _finish(conn, cursor, statement, parameters, context, executemany):
+        ms = (time.perf_counter() - conn.info["trace_start"].pop()) * 1000
+        slow = slow_ms > 0 and ms >= slow_ms
+        if not slow and random.random() >= sample:
+            return
+        trace_logger.log(logging.WARNING if slow else logging.INFO, json.dumps({
+            "engine": label,
+            "ms": round(ms, 2),
+            "rows": cursor.rowcount if cursor.rowcount >= 0 else None,
+            "sql": " ".join(statement.split()),
+            "slow": slow,
+        }))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _failed(context):
+        if context.connection is not None and context.connection.info.get("trace_start"):
+            context.connection.info["trace_start"].pop()
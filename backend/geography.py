@@ -0,0 +1,547 @@
+"""
+Geography for the MaatriNet data model.
+
+GeoUnit is a small dimension (STATE -> DISTRICT -> BLOCK -> VILLAGE) with integer ids,
+loaded once from the RCH data plus FALLBACK_MAP. Beneficiary and Hospital reference it
+through state_id / district_id / block_id (/ village_id), and Pregnancy, Delivery and
+Child carry a denormalized copy of their beneficiary's ids (names come from the
+dimension), so state-scoped queries filter a single table through an integer composite
+index instead of joining Child -> Delivery -> Pregnancy -> Beneficiary and comparing strings.
+
+A before_flush hook (registered ahead of the rollup hook) resolves ids for new or moved
+beneficiaries and hospitals, fills in a missing state from the district, stamps new fact
+rows and propagates address changes to all facts of a beneficiary in the same transaction;
+rows below a re-linked pregnancy or delivery are restamped with it.
+"""
+import os
+import threading
+
+from sqlalchemy import delete, event, inspect, update, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import Session
+
+from database import engine
+from data_version import bump_data_version
+from parquet_export import mark_all_partitions
+from models import Beneficiary, Hospital, Pregnancy, Delivery, Child, GeoUnit, RiskRollup, MonthlyTrend
+
+GEO_ATTRS = ("state", "district", "block")
+GEO_ID_ATTRS = ("state_id", "district_id", "block_id")
+_FACTS = (Pregnancy, Delivery, Child)
+
+# fact class -> (relationship, parent class, foreign key)
+_PARENTS = {
+    Pregnancy: ("beneficiary", Beneficiary, "beneficiary_id"),
+    Delivery: ("pregnancy", Pregnancy, "pregnancy_id"),
+    Child: ("delivery", Delivery, "delivery_id"),
+}
+
+# Hardcoded fallback mapping for common dummy data districts missing from the RCH sheet
+FALLBACK_MAP = {
+    'Ahmedabad': 'Gujarat',
+    'Erode': 'Tamil Nadu',
+    'Nagpur': 'Maharashtra',
+    'Bhubaneswar': 'Odisha',
+    'Faridabad': 'Haryana',
+    'Ranchi': 'Jharkhand',
+    'Patna': 'Bihar',
+    'Raipur': 'Chhattisgarh',
+    'Jaipur': 'Rajasthan',
+    'Lucknow': 'Uttar Pradesh',
+    'Bhopal': 'Madhya Pradesh',
+    'Indore': 'Madhya Pradesh',
+    'Pune': 'Maharashtra',
+    'Mumbai': 'Maharashtra',
+    'Kolkata': 'West Bengal',
+    'Chennai': 'Tamil Nadu',
+    'Bangalore': 'Karnataka',
+    'Hyderabad': 'Telangana',
+    'Visakhapatnam': 'Andhra Pradesh',
+    'Guwahati': 'Assam',
+    'Surat': 'Gujarat',
+    'Vadodara': 'Gujarat',
+    'Nashik': 'Maharashtra',
+    'Thane': 'Maharashtra',
+    'Aurangabad': 'Maharashtra',
+    'Solapur': 'Maharashtra',
+    'Amravati': 'Maharashtra',
+    'Kolhapur': 'Maharashtra',
+    'Akola': 'Maharashtra',
+    'Latur': 'Maharashtra',
+    'Dhule': 'Maharashtra',
+    'Ahmednagar': 'Maharashtra',
+    'Chandrapur': 'Maharashtra',
+    'Parbhani': 'Maharashtra',
+    'Jalgaon': 'Maharashtra',
+    'Jalna': 'Maharashtra',
+    'Beed': 'Maharashtra',
+    'Gondia': 'Maharashtra',
+    'Satara': 'Maharashtra',
+    'Sangli': 'Maharashtra',
+    'Ratnagiri': 'Maharashtra',
+    'Sindhudurg': 'Maharashtra',
+    'Bhandara': 'Maharashtra',
+    'Wardha': 'Maharashtra',
+    'Yavatmal': 'Maharashtra',
+    'Washim': 'Maharashtra',
+    'Buldhana': 'Maharashtra',
+    'Hingoli': 'Maharashtra',
+    'Nanded': 'Maharashtra',
+    'Osmanabad': 'Maharashtra',
+    'Nandurbar': 'Maharashtra',
+    'Gadchiroli': 'Maharashtra',
+    'Palghar': 'Maharashtra',
+}
+
+RCH_EXCEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/RCH_Maternal_Child_5000_Synthetic.xlsx')
+
+
+def _clean(name):
+    if name is None:
+        return None
+    name = str(name).strip()
+    return name or None
+
+
+# --- In-memory dimension cache ---
+class _GeoCache:
+    """Process-local copy of GeoUnit. Misses fall through to the database."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.by_key = {}  # (level, parent_id, name) -> id
+        self.by_id = {}   # id -> (level, name, parent_id)
+        self.by_name = {} # (level, name) -> {ids}, for name filters at any parent
+
+    def remember(self, uid, level, name, parent_id):
+        self.by_key[(level, parent_id, name)] = uid
+        self.by_id[uid] = (level, name, parent_id)
+        self.by_name.setdefault((level, name), set()).add(uid)
+
+    def forget(self, uid):
+        level, name, parent_id = self.by_id.pop(uid)
+        self.by_key.pop((level, parent_id, name), None)
+        self.by_name.get((level, name), set()).discard(uid)
+
+    def ensure_loaded(self, conn=None):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            query = select(GeoUnit.id, GeoUnit.level, GeoUnit.name, GeoUnit.parent_id)
+            if conn is None:
+                with engine.connect() as c:
+                    rows = c.execute(query).all()
+            else:
+                rows = conn.execute(query).all()
+            for row in rows:
+                self.remember(row.id, row.level, row.name, row.parent_id)
+            self.loaded = True
+
+_cache = _GeoCache()
+
+
+def unit_id(conn, level, name, parent_id=0, create=True, created=None):
+    """
+    Id of the GeoUnit (level, parent, name), inserting it through `conn` if it is new.
+    Ids of inserted units are appended to `created` so they can be forgotten on rollback.
+    """
+    name = _clean(name)
+    if name is None:
+        return None
+    parent_id = parent_id or 0
+    _cache.ensure_loaded(conn)
+    key = (level, parent_id, name)
+    if key in _cache.by_key:
+        return _cache.by_key[key]
+
+    lookup = select(GeoUnit.id).where(GeoUnit.level == level, GeoUnit.parent_id == parent_id, GeoUnit.name == name)
+    found = conn.execute(lookup).scalar()
+    if found is None:
+        if not create:
+            return None
+        conn.execute(
+            sqlite_insert(GeoUnit.__table__).values(level=level, name=name, parent_id=parent_id).on_conflict_do_nothing()
+        )
+        found = conn.execute(lookup).scalar()
+        if created is not None:
+            created.append(found)
+    _cache.remember(found, level, name, parent_id)
+    return found
+
+
+def unit_name(uid):
+    """Display name of a GeoUnit id ('' for unknown)."""
+    if not uid:
+        return ""
+    _cache.ensure_loaded()
+    if uid not in _cache.by_id:
+        with engine.connect() as conn:
+            row = conn.execute(select(GeoUnit.level, GeoUnit.name, GeoUnit.parent_id).where(GeoUnit.id == uid)).first()
+        if row is None:
+            return ""
+        _cache.remember(uid, row.level, row.name, row.parent_id)
+    return _cache.by_id[uid][1]
+
+
+def unit_path(uid):
+    """Names of a GeoUnit and the units above it, state first ([] for unknown)."""
+    names = []
+    while uid:
+        name = unit_name(uid)
+        if not name:
+            break
+        names.append(name)
+        uid = _cache.by_id[uid][2]
+    return names[::-1]
+
+
+def state_id(name):
+    """Id of a state by name, without creating it. Turns ?state= filters into integer keys."""
+    name = _clean(name)
+    if name is None:
+        return None
+    _cache.ensure_loaded()
+    uid = _cache.by_key.get(("STATE", 0, name))
+    if uid is None:
+        with engine.connect() as conn:
+            uid = unit_id(conn, "STATE", name, create=False)
+    return uid
+
+
+# Lookups that never touch the database, for async routes: None means "not in the loaded
+# dimension", and the caller falls back to the functions above in a worker thread
+def cached_unit_name(uid):
+    """unit_name() from the in-memory dimension only."""
+    if not uid:
+        return ""
+    unit = _cache.by_id.get(uid) if _cache.loaded else None
+    return unit[1] if unit else None
+
+
+def cached_state_id(name):
+    """state_id() from the in-memory dimension only."""
+    name = _clean(name)
+    if name is None or not _cache.loaded:
+        return None
+    return _cache.by_key.get(("STATE", 0, name))
+
+
+def cached_filter_ids(state=None, district=None, block=None):
+    """filter_ids() from the in-memory dimension only; None if a level matches no loaded unit."""
+    if not _cache.loaded:
+        return None
+    filters = {}
+    parents = None
+    for attr, level, name in (("state_id", "STATE", state), ("district_id", "DISTRICT", district),
+                              ("block_id", "BLOCK", block)):
+        name = _clean(name)
+        if name is None:
+            parents = None
+            continue
+        ids = _cache.by_name.get((level, name), set())
+        if parents is not None:
+            ids = {uid for uid in ids if _cache.by_id[uid][2] in parents}
+        if not ids:
+            # Possibly a unit another process added after ours was loaded
+            return None
+        parents = filters[attr] = sorted(ids)
+    return filters
+
+
+def parent_ids(ids):
+    """Ids of the parent units of `ids` (a district's state, a block's district), or None if one has no parent."""
+    _cache.ensure_loaded()
+    parents = set()
+    for uid in ids:
+        unit = _cache.by_id.get(uid)
+        if unit is None or not unit[2]:
+            return None
+        parents.add(unit[2])
+    return sorted(parents)
+
+
+def state_names():
+    """Names of every known state."""
+    _cache.ensure_loaded()
+    return [name for (level, parent_id, name) in list(_cache.by_key) if level == "STATE"]
+
+
+def filter_ids(state=None, district=None, block=None):
+    """
+    GeoUnit ids for ?state=&district=&block= name filters, each level narrowed by the one above.
+    Returns {"state_id": [...], "district_id": [...], "block_id": [...]} with only the filtered
+    levels present; an empty list means the filter matches nothing.
+    """
+    _cache.ensure_loaded()
+    cached = cached_filter_ids(state, district, block)
+    if cached is not None:
+        return cached
+    filters = {}
+    parents = None
+    with engine.connect() as conn:
+        for attr, level, name in (("state_id", "STATE", state), ("district_id", "DISTRICT", district),
+                                  ("block_id", "BLOCK", block)):
+            name = _clean(name)
+            if name is None:
+                parents = None  # e.g. block without district: match the block name under any district
+                continue
+            query = select(GeoUnit.id).where(GeoUnit.level == level, GeoUnit.name == name)
+            if parents is not None:
+                query = query.where(GeoUnit.parent_id.in_(parents))
+            parents = filters[attr] = list(conn.execute(query).scalars())
+    return filters
+
+
+def district_state_map():
+    """District name -> state name, from the dimension plus FALLBACK_MAP."""
+    _cache.ensure_loaded()
+    mapping = dict(FALLBACK_MAP)
+    for (level, parent_id, name), uid in list(_cache.by_key.items()):
+        if level == "DISTRICT" and parent_id in _cache.by_id:
+            mapping[name] = _cache.by_id[parent_id][1]
+    return mapping
+
+
+def infer_state(district):
+    district = _clean(district)
+    if district is None:
+        return None
+    mapping = district_state_map()
+    return mapping.get(district) or mapping.get(district.title())
+
+
+def resolve_ids(conn, state, district, block, village=None, created=None):
+    """(state_id, district_id, block_id, village_id) for a set of names, creating units as needed."""
+    s_id = unit_id(conn, "STATE", state, created=created)
+    d_id = unit_id(conn, "DISTRICT", district, s_id, created=created)
+    b_id = unit_id(conn, "BLOCK", block, d_id, created=created)
+    v_id = unit_id(conn, "VILLAGE", village, b_id, created=created)
+    return s_id, d_id, b_id, v_id
+
+
+# --- Loading and backfill ---
+def _load_units(conn, df=None, created=None):
+    if df is None and os.path.exists(RCH_EXCEL_PATH):
+        import pandas as pd
+        df = pd.read_excel(RCH_EXCEL_PATH)
+
+    for district, state in FALLBACK_MAP.items():
+        resolve_ids(conn, state, district, None, created=created)
+    if df is not None:
+        cols = [c for c in ("State", "District", "Block", "Village") if c in df.columns]
+        for values in df[cols].drop_duplicates().itertuples(index=False):
+            names = {c: (None if v != v else v) for c, v in zip(cols, values)}  # NaN -> None
+            resolve_ids(conn, names.get("State"), names.get("District"), names.get("Block"), names.get("Village"), created)
+
+
+def load_units(session: Session, df=None):
+    """Load the dimension from an RCH dataframe (read from RCH_EXCEL_PATH if not given) plus FALLBACK_MAP."""
+    _load_units(session.connection(), df, session.info.setdefault("geo_created", []))
+    session.commit()
+
+
+# Copy denormalized ids from parents onto fact rows; usable from SQLAlchemy or sqlite3
+_FACT_COPY_COLUMNS = GEO_ID_ATTRS
+BACKFILL_SQL = [
+    "UPDATE pregnancy SET " + ", ".join(
+        f"{c} = (SELECT b.{c} FROM beneficiary b WHERE b.id = pregnancy.beneficiary_id)" for c in _FACT_COPY_COLUMNS),
+    "UPDATE delivery SET " + ", ".join(
+        f"{c} = (SELECT p.{c} FROM pregnancy p WHERE p.id = delivery.pregnancy_id)" for c in _FACT_COPY_COLUMNS),
+    "UPDATE child SET " + ", ".join(
+        f"{c} = (SELECT d.{c} FROM delivery d WHERE d.id = child.delivery_id)" for c in _FACT_COPY_COLUMNS),
+]
+
+
+def backfill_fact_geography(connection):
+    """Re-copy geography from Beneficiary onto every fact row."""
+    for sql in BACKFILL_SQL:
+        connection.exec_driver_sql(sql)
+    bump_data_version(connection)
+    mark_all_partitions(connection)
+
+
+def _backfill_ids(conn, only_missing=True, created=None):
+    for table, has_village in (("beneficiary", True), ("hospital", False)):
+        village_col = "village" if has_village else "NULL"
+        where = " WHERE state_id IS NULL OR district_id IS NULL" if only_missing else ""
+        combos = conn.execute(text(f"SELECT DISTINCT state, district, block, {village_col} FROM {table}{where}")).all()
+        for state, district, block, village in combos:
+            new_state = _clean(state) or infer_state(district)
+            s_id, d_id, b_id, v_id = resolve_ids(conn, new_state, district, block, village, created)
+            assignments = "state = :new_state, state_id = :s_id, district_id = :d_id, block_id = :b_id"
+            match = "state IS :state AND district IS :district AND block IS :block"
+            if has_village:
+                assignments += ", village_id = :v_id"
+                match += " AND village IS :village"
+            conn.execute(text(f"UPDATE {table} SET {assignments} WHERE {match}"), {
+                "new_state": new_state, "s_id": s_id, "d_id": d_id, "b_id": b_id, "v_id": v_id,
+                "state": state, "district": district, "block": block, "village": village,
+            })
+    backfill_fact_geography(conn)
+
+
+def backfill_geography_ids(session: Session, only_missing=True):
+    """Fill in missing states and GeoUnit ids on beneficiaries and hospitals, then re-copy onto facts."""
+    _backfill_ids(session.connection(), only_missing, session.info.setdefault("geo_created", []))
+    session.commit()
+
+
+def backfill_geography(conn):
+    """
+    Migration step (see migrations.py): ids for rows written before the dimension existed.
+    Runs once per database; rows whose geography can't be resolved (a self-registered
+    beneficiary without a state) keep their NULL ids and are not retried on every start.
+    """
+    pending = conn.execute(text(
+        "SELECT 1 FROM beneficiary WHERE state_id IS NULL UNION ALL SELECT 1 FROM hospital WHERE state_id IS NULL LIMIT 1"
+    )).first()
+    if pending is None:
+        return
+    created = []
+    try:
+        if conn.execute(select(GeoUnit.id)).first() is None:
+            print("  loading geography dimension from RCH data")
+            _load_units(conn, created=created)
+        _backfill_ids(conn, created=created)
+        # Keyed by the ids just assigned: ensure_rollups rebuilds them on startup
+        conn.execute(delete(RiskRollup))
+        conn.execute(delete(MonthlyTrend))
+    except Exception:
+        # The migration's transaction rolls back; so must the units it cached
+        for uid in created:
+            if uid in _cache.by_id:
+                _cache.forget(uid)
+        raise
+
+
+def ensure_geography(session: Session):
+    """Load the dimension if it is empty and warm the in-memory copy (async routes only read that)."""
+    if session.exec(select(GeoUnit.id)).first() is None:
+        print("Loading geography dimension from RCH data...")
+        load_units(session)
+    _cache.ensure_loaded()
+
+
+# --- Write-path hook ---
+def _parent(session, obj):
+    """Owning row one level up (Beneficiary, Pregnancy or Delivery), pending or persistent."""
+    rel, cls, fk = _PARENTS[type(obj)]
+    parent, parent_id = getattr(obj, rel), getattr(obj, fk)
+    if parent_id is not None and not _changed(obj, (rel,)) and (parent is None or parent.id != parent_id):
+        # Pending objects don't lazy-load relationships, and a changed FK leaves the old one loaded
+        parent = session.get(cls, parent_id)
+    return parent
+
+
+def _restamp_below(conn, obj, values):
+    """Write `values` onto the committed rows below a re-linked pregnancy or delivery."""
+    if isinstance(obj, Pregnancy):
+        del_ids = select(Delivery.id).where(Delivery.pregnancy_id == obj.id)
+        conn.execute(update(Delivery).where(Delivery.pregnancy_id == obj.id).values(**values))
+        conn.execute(update(Child).where(Child.delivery_id.in_(del_ids)).values(**values))
+    else:
+        conn.execute(update(Child).where(Child.delivery_id == obj.id).values(**values))
+
+
+def _changed(obj, attrs):
+    state = inspect(obj)
+    return any(state.attrs[a].history.has_changes() for a in attrs)
+
+
+def _maintain_geography(session, flush_context, instances):
+    pending = list(session.new) + list(session.dirty)
+
+    # 1. Resolve ids for new and re-addressed beneficiaries and hospitals
+    for obj in pending:
+        if not isinstance(obj, (Beneficiary, Hospital)):
+            continue
+        has_village = isinstance(obj, Beneficiary)
+        if obj in session.new or _changed(obj, GEO_ATTRS + (("village",) if has_village else ())):
+            if not _clean(obj.state):
+                obj.state = infer_state(obj.district) or obj.state
+            village = obj.village if has_village else None
+            if session.info.get("shard"):
+                # GeoUnit lives in the primary database only (see sharding.py); new units commit at once
+                with engine.begin() as conn:
+                    ids = resolve_ids(conn, obj.state, obj.district, obj.block, village)
+            else:
+                ids = resolve_ids(
+                    session.connection(), obj.state, obj.district, obj.block,
+                    village, session.info.setdefault("geo_created", []),
+                )
+            obj.state_id, obj.district_id, obj.block_id = ids[:3]
+            if has_village:
+                obj.village_id = ids[3]
+
+    # 2. Beneficiary moves: rewrite the copies held by all of its facts
+    restamped = {}  # (class, id) -> values written onto the committed rows below it
+    for ben in session.dirty:
+        if not (isinstance(ben, Beneficiary) and ben.id is not None and _changed(ben, GEO_ATTRS)):
+            continue
+        conn = session.connection()
+        values = {a: getattr(ben, a) for a in _FACT_COPY_COLUMNS}
+        preg_ids = select(Pregnancy.id).where(Pregnancy.beneficiary_id == ben.id)
+        del_ids = select(Delivery.id).where(Delivery.pregnancy_id.in_(preg_ids))
+        conn.execute(update(Pregnancy).where(Pregnancy.beneficiary_id == ben.id).values(**values))
+        conn.execute(update(Delivery).where(Delivery.pregnancy_id.in_(preg_ids)).values(**values))
+        conn.execute(update(Child).where(Child.delivery_id.in_(del_ids)).values(**values))
+        restamped[(Beneficiary, ben.id)] = values
+
+    # 3. New rows and re-parented rows copy from their parent (parents first); the committed
+    #    rows below a re-parented pregnancy or delivery move with it
+    for cls in _FACTS:
+        rel, _, fk = _PARENTS[cls]
+        for obj in pending:
+            if type(obj) is cls and (obj in session.new or _changed(obj, (fk, rel))):
+                parent = _parent(session, obj)
+                if parent is None:
+                    continue
+                values = {a: getattr(parent, a) for a in _FACT_COPY_COLUMNS}
+                for a, value in values.items():
+                    setattr(obj, a, value)
+                if obj.id is not None and obj not in session.new and cls is not Child:
+                    _restamp_below(session.connection(), obj, values)
+                    restamped[(cls, obj.id)] = values
+
+    # Keep already-loaded instances in step with what was just written behind the ORM's back
+    if restamped:
+        for obj in list(session.identity_map.values()):
+            if not isinstance(obj, _FACTS) or obj in session.deleted or _changed(obj, _FACT_COPY_COLUMNS):
+                continue
+            owner = _parent(session, obj)
+            while owner is not None:
+                values = restamped.get((type(owner), owner.id))
+                if values is not None:
+                    for a, value in values.items():
+                        set_committed_value(obj, a, value)
+                    break
+                owner = None if isinstance(owner, Beneficiary) else _parent(session, owner)
+
+# insert=True: must run before the rollup hook, which keys on the ids assigned here
+event.listen(Session, "before_flush", _maintain_geography, insert=True)
+
+
+@event.listens_for(Session, "after_commit")
+def _keep_committed_units(session):
+    session.info.pop("geo_created", None)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_units(session):
+    # Units inserted inside a rolled-back transaction must not linger in the cache
+    for uid in session.info.pop("geo_created", []):
+        if uid in _cache.by_id:
+            _cache.forget(uid)
+
+
+if __name__ == "__main__":
+    from database import create_db_and_tables
+
+    create_db_and_tables()
+    with Session(engine) as session:
+        load_units(session)
+        backfill_geography_ids(session)
+    print(f"Geography dimension holds {len(_cache.by_id)} units.")
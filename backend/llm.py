@@ -0,0 +1,353 @@
+"""
+LLM backends for the assistant, with deadlines, hedging and circuit breakers.
+
+ASSISTANT_LLM selects the provider:
+
+    gemini  Google Gemini through google.generativeai (default when GEMINI_API_KEY is set)
+    stub    deterministic local backend, no network: writes a plausible analyze(df)
+            for code prompts and echoes the result for answer prompts, after
+            ASSISTANT_LLM_STUB_LATENCY_MS (default 200). Models named in
+            ASSISTANT_LLM_STUB_FAIL always fail. For offline load tests of the
+            assistant pipeline.
+
+`llm.generate(prompt)` asks the provider's models in preference order. Every call has
+its own deadline (ASSISTANT_LLM_CALL_TIMEOUT, default 10 s) and the whole request an
+overall one (ASSISTANT_LLM_DEADLINE, default 25 s). If the current model has not
+answered after ASSISTANT_LLM_HEDGE_AFTER seconds (default 3), the next model is asked
+in parallel and the first acceptable answer wins; a model that fails moves on to the
+next one at once. Each model has a circuit breaker: after
+ASSISTANT_LLM_BREAKER_FAILURES consecutive failures or timeouts (default 3) it is
+skipped for ASSISTANT_LLM_BREAKER_COOLDOWN seconds (default 30), then tried again
+with a single probe call.
+"""
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROVIDER = os.environ.get("ASSISTANT_LLM") or ("gemini" if os.environ.get("GEMINI_API_KEY") else None)
+CALL_TIMEOUT = float(os.environ.get("ASSISTANT_LLM_CALL_TIMEOUT", "10"))
+DEADLINE = float(os.environ.get("ASSISTANT_LLM_DEADLINE", "25"))
+HEDGE_AFTER = float(os.environ.get("ASSISTANT_LLM_HEDGE_AFTER", "3"))
+BREAKER_FAILURES = int(os.environ.get("ASSISTANT_LLM_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("ASSISTANT_LLM_BREAKER_COOLDOWN", "30"))
+
+
+# --- Providers ---
+class GeminiProvider:
+    name = "gemini"
+    PREFERRED = ['gemini-2.0-flash', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro']
+    FALLBACK = ['gemini-1.5-flash', 'gemini-pro', 'models/gemini-1.5-flash']
+
+    def __init__(self, api_key):
+        import google.generativeai as genai
+        self.genai = genai
+        genai.configure(api_key=api_key)
+        self._models = None
+
+    def models(self):
+        """Discover available Gemini models once and cache the result."""
+        if self._models is not None:
+            return self._models
+        available_models = []
+        try:
+            for m in self.genai.list_models(request_options={"timeout": CALL_TIMEOUT}):
+                if 'generateContent' in m.supported_generation_methods:
+                    available_models.append(m.name)
+            print(f"Discovered Models: {available_models}")
+        except Exception as e:
+            print(f"Model Discovery Error: {e}")
+
+        models_to_try = []
+        for pref in self.PREFERRED:
+            for avail in available_models:
+                if pref in avail and avail not in models_to_try:
+                    models_to_try.append(avail)
+        for avail in available_models:
+            if avail not in models_to_try and "vision" not in avail and "embedding" not in avail:
+                models_to_try.append(avail)
+
+        self._models = models_to_try or list(self.FALLBACK)
+        print(f"Cached Model List: {self._models}")
+        return self._models
+
+    def generate(self, model, prompt, timeout):
+        response = self.genai.GenerativeModel(model).generate_content(prompt, request_options={"timeout": timeout})
+        return response.text
+
+    def stream(self, model, prompt, timeout):
+        response = self.genai.GenerativeModel(model).generate_content(
+            prompt, stream=True, request_options={"timeout": timeout})
+        for chunk in response:
+            yield chunk.text
+
+
+class StubProvider:
+    """Deterministic offline backend (see module docstring)."""
+    name = "stub"
+
+    def __init__(self, latency_ms=None, failing=None):
+        self.latency = float(os.environ.get("ASSISTANT_LLM_STUB_LATENCY_MS", "200") if latency_ms is None else latency_ms) / 1000
+        fail = os.environ.get("ASSISTANT_LLM_STUB_FAIL", "") if failing is None else failing
+        self.failing = {m.strip() for m in fail.split(",") if m.strip()}
+
+    def models(self):
+        return ["stub-primary", "stub-fallback"]
+
+    def generate(self, model, prompt, timeout):
+        time.sleep(min(self.latency, timeout))
+        if model in self.failing:
+            raise RuntimeError(f"{model} is configured to fail")
+        if "def analyze" in prompt:
+            return self._code(prompt)
+        return self._answer(prompt)
+
+    def stream(self, model, prompt, timeout):
+        words = re.findall(r"\S+\s*", self._answer(prompt))
+        for word in words:
+            time.sleep(min(self.latency / len(words), timeout))
+            if model in self.failing:
+                raise RuntimeError(f"{model} is configured to fail")
+            yield word
+
+    @staticmethod
+    def _answer(prompt):
+        result = re.search(r'Raw Data Analysis Result: "(.*)"', prompt)
+        return f"Here is what I found: {result.group(1) if result else 'no result'}."
+
+    @staticmethod
+    def _code(prompt):
+        found = re.search(r'User Query: "(.*)"', prompt)
+        query = found.group(1).lower() if found else ""
+        names = re.findall(r"^- (\w+): ", prompt, re.M)  # the schema digest's column lines
+        column = next((n for n in sorted(names, key=len, reverse=True)
+                       if re.search(rf"\b({re.escape(n)}|{re.escape(n.replace('_', ' '))})\b", query)), "district")
+        if any(w in query for w in ("plot", "chart", "graph", "distribution")):
+            return f'''def analyze(df):
+    counts = df[{column!r}].value_counts().head(10)
+    return {{"type": "plot", "chart_type": "bar", "title": "{column} distribution",
+            "data": [{{"name": str(k), "value": int(v)}} for k, v in counts.items()],
+            "x_key": "name", "y_key": "value", "description": "Top values of {column}."}}'''
+        if "how many" in query or "count" in query:
+            return f'''def analyze(df):
+    return int(df[{column!r}].count())'''
+        return f'''def analyze(df):
+    col = df[{column!r}]
+    if str(col.dtype) in ("category", "object", "str", "string"):
+        return f"The most common {column} is {{col.mode().iloc[0]}} ({{int(col.value_counts().iloc[0])}} of {{len(df)}} records)."
+    return f"The average {column} is {{float(col.mean()):.2f}} across {{int(col.count())}} records."'''
+
+
+# --- Circuit breaker ---
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.consecutive = 0
+        self.opened_at = None  # time.monotonic() the breaker opened; None while closed
+        self.probe_at = None  # when the half-open probe call was let through
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # Half-open: one probe per cooldown (a probe whose caller gave up counts as lost)
+            if self.probe_at is not None and now - self.probe_at < self.cooldown:
+                return False
+            self.probe_at = now
+            return True
+
+    def success(self):
+        with self._lock:
+            self.consecutive, self.opened_at, self.probe_at = 0, None, None
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.probe_at is not None or self.consecutive >= self.failures:
+                self.opened_at, self.probe_at = time.monotonic(), None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probe_at is not None else "open"
+
+
+# --- Client ---
+@dataclass
+class LLMReply:
+    text: str
+    model: str
+    seconds: float
+
+
+class LLMClient:
+    def __init__(self, provider, call_timeout=CALL_TIMEOUT, deadline=DEADLINE, hedge_after=HEDGE_AFTER):
+        self.provider = provider
+        self.call_timeout = call_timeout
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        # Calls that miss their deadline cannot be cancelled and finish here in the background
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm")
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.hedges = 0
+
+    def _breaker(self, model):
+        with self._lock:
+            return self._breakers.setdefault(model, CircuitBreaker())
+
+    def models(self):
+        return self.provider.models()
+
+    def generate(self, prompt, accept=None, deadline=None):
+        """
+        First LLMReply whose text passes `accept` (any text if None), or None if no model
+        produced one before the deadline.
+        """
+        started = time.monotonic()
+        deadline_at = started + (deadline or self.deadline)
+        candidates = list(self.models())
+        pending = {}  # future -> (model, started)
+
+        def launch():
+            """Call the next model whose breaker lets it through; False if none is left."""
+            while candidates:
+                model = candidates.pop(0)
+                if not self._breaker(model).allow():
+                    continue
+                timeout = max(0.1, min(self.call_timeout, deadline_at - time.monotonic()))
+                pending[self._executor.submit(self.provider.generate, model, prompt, timeout)] = (model, time.monotonic())
+                self.calls += 1
+                return True
+            return False
+
+        launch()
+        while pending:
+            now = time.monotonic()
+            if now >= deadline_at:
+                break
+            last_launch = max(t for _, t in pending.values())
+            # Wake up for the next hedge or the oldest call's deadline, whichever is first
+            wake = min([deadline_at] + [t + self.call_timeout for _, t in pending.values()]
+                       + ([last_launch + self.hedge_after] if candidates else []))
+            wait(list(pending), timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+            done = [future for future in pending if future.done()]
+            for future in done:
+                model, _ = pending.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    print(f"Model {model} failed: {e}")
+                    self.failures += 1
+                    self._breaker(model).failure()
+                    continue
+                self._breaker(model).success()
+                if accept is None or accept(text):
+                    return LLMReply(text=text, model=model, seconds=time.monotonic() - started)
+                print(f"Model {model} answered with unusable text")
+            now = time.monotonic()
+            for future, (model, t) in list(pending.items()):
+                if now - t >= self.call_timeout:
+                    print(f"Model {model} timed out after {self.call_timeout:g}s")
+                    del pending[future]
+                    self.timeouts += 1
+                    self._breaker(model).failure()
+            if not pending:
+                launch()
+            elif candidates and now - last_launch >= self.hedge_after and launch():
+                self.hedges += 1
+        return None
+
+    def stream(self, prompt, deadline=None):
+        """
+        Text chunks of the answer from the first model that starts answering in time,
+        falling back to the next model only before the first chunk. Yields nothing if no
+        model answers; a model that stalls or fails midway ends the stream early.
+        """
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        for model in self.models():
+            if time.monotonic() >= deadline_at:
+                return
+            if not self._breaker(model).allow():
+                continue
+            chunks, stop = queue.Queue(), threading.Event()
+            timeout = max(0.1, min(self.call_timeout, deadline_at - time.monotonic()))
+            self._executor.submit(self._pump, model, prompt, timeout, chunks, stop)
+            self.calls += 1
+            started = False
+            try:
+                while True:
+                    try:
+                        kind, value = chunks.get(timeout=max(0.0, min(self.call_timeout, deadline_at - time.monotonic())))
+                    except queue.Empty:
+                        print(f"Model {model} stalled for {self.call_timeout:g}s while streaming")
+                        self.timeouts += 1
+                        self._breaker(model).failure()
+                        break
+                    if kind == "chunk":
+                        started = True
+                        yield value
+                    elif kind == "end":
+                        self._breaker(model).success()
+                        return
+                    else:
+                        print(f"Model {model} failed: {value}")
+                        self.failures += 1
+                        self._breaker(model).failure()
+                        break
+            finally:
+                stop.set()
+            if started:
+                return
+
+    def _pump(self, model, prompt, timeout, chunks, stop):
+        try:
+            for text in self.provider.stream(model, prompt, timeout):
+                if stop.is_set():
+                    return
+                if text:
+                    chunks.put(("chunk", text))
+            chunks.put(("end", None))
+        except Exception as e:
+            chunks.put(("error", e))
+
+    def stats(self):
+        return {
+            "provider": self.provider.name,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "breakers": {model: b.state for model, b in self._breakers.items()},
+        }
+
+
+def _provider():
+    if PROVIDER == "stub":
+        return StubProvider()
+    if PROVIDER == "gemini":
+        api_key = os.environ.get("GEMINI_API_KEY")
+        return GeminiProvider(api_key) if api_key else None
+    if PROVIDER:
+        raise ValueError(f"Unknown ASSISTANT_LLM {PROVIDER!r}; expected 'gemini' or 'stub'")
+    return None
+
+
+_configured = _provider()
+llm = LLMClient(_configured) if _configured else None
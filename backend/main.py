@@ -1,23 +1,39 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Body
+from fastapi import FastAPI, Depends, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import func, case
+from fastapi.responses import JSONResponse
+from sqlalchemy import func, literal
+from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
-from typing import List, Optional
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
 from datetime import date, datetime, timedelta
-import json
-import numpy as np
 import pandas as pd
-import math
 import os
 import random
-import google.generativeai as genai
-from dotenv import load_dotenv
-import re
-import io
 import contextlib
-
-from database import engine, create_db_and_tables, get_session
-from models import User, Hospital, Beneficiary, Pregnancy, Delivery, Child, SchemeApplication
+import heapq
+import threading
+import traceback
+from types import SimpleNamespace
+
+from database import engine, async_engine, sqlite_file_name, create_db_and_tables, get_session, get_async_session, startup_lock
+from replica import replica, analytics_async_engine, get_analytics_async_session
+from sharding import router as shard_router, FactSessions
+from models import User, Hospital, Beneficiary, Pregnancy, Delivery, Child, SchemeApplication, RiskRollup, MonthlyTrend
+from rollups import ensure_rollups
+from geography import (ensure_geography, load_units, filter_ids, infer_state, state_id as geo_state_id, unit_name,
+                       cached_filter_ids, cached_state_id, cached_unit_name, GEO_ID_ATTRS)
+from response_cache import ResponseCacheMiddleware
+from analysis_frame import analysis_frames
+from analytics_query import run_query as run_analytics_query, fields as query_fields, ENTITIES as QUERY_ENTITIES, QueryError
+from code_cache import code_cache
+from sandbox import sandbox, SandboxBusy
+from llm import llm
+from assistant_intents import match_intent, match_slice, answer as answer_matched_intent, answer_slice
+from streaming import stream_json_array, stream_ndjson, stream_csv, stream_events
+from warmup import warmup, WarmupMiddleware
+import parquet_export  # noqa: F401  (logs changed partitions for the Parquet export)
 from ml.risk_models import predict_prebirth_risk, predict_postbirth_risk, detect_offtrack
 
 # --- India NIS Immunization Schedule (milestones by weeks from birth) ---
@@ -65,6 +81,13 @@ def _compute_immunizations(delivery_date, bpl_card, education, birth_dose_done):
 
 app = FastAPI(title="MaatriNet API")
 
+# Dashboard responses are cached until the next write bumps the data version.
+# Added before CORS so it sits inside it and cache hits still get CORS headers.
+app.add_middleware(ResponseCacheMiddleware)
+
+# Until the background seed import is done, /api/ routes answer 503 "warming up" (see warmup.py)
+app.add_middleware(WarmupMiddleware)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -73,10 +96,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-def on_startup():
+def prepare_database():
+    """Migrate, seed and build derived tables. Idempotent; runs in the background after startup."""
     create_db_and_tables()
     seed_data_if_empty()
+    warmup.begin("deriving")
+    with Session(engine) as session:
+        ensure_geography(session)
+        ensure_rollups(session)
+    if shard_router:
+        # Sharded reads never look at the primary: facts the seed left there move to their shards first
+        warmup.begin("sharding")
+        moved = shard_router.rehome(engine, sqlite_file_name)
+        if moved:
+            print(f"Moved {sum(moved.values())} seeded beneficiaries into {len(moved)} shard(s)")
+
+# Per-process readiness, reported by /health/ready (each worker answers for itself)
+worker_state = {"ready": False, "worker": os.environ.get("MAATRINET_WORKER"), "started_at": None}
+
+def _warm_up():
+    try:
+        warmup.begin("waiting")
+        # Only one worker seeds; the others wait here and then find the data already in place
+        with startup_lock():
+            prepare_database()
+        if replica:
+            replica.start()
+        worker_state["ready"] = True
+        worker_state["started_at"] = datetime.now().isoformat(timespec="seconds")
+        warmup.finish()
+    except Exception as e:
+        traceback.print_exc()
+        warmup.fail(e)
+
+@app.on_event("startup")
+def on_startup():
+    # Migrations are quick and every route needs them; the seed import runs in the background
+    with startup_lock():
+        create_db_and_tables()
+    sandbox.start()
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+@app.get("/health/live")
+def health_live():
+    failed = warmup.phase == "failed"
+    body = {"status": "failed" if failed else "alive", "pid": os.getpid(), "worker": worker_state["worker"],
+            "error": warmup.error}
+    return JSONResponse(body, status_code=503 if failed else 200)
+
+@app.get("/health/ready")
+def health_ready():
+    ready = worker_state["ready"]
+    body = {"status": "ready" if ready else "warming_up", **worker_state, **warmup.snapshot()}
+    return JSONResponse(body, status_code=200 if ready else 503)
 
 # --- SEEDING LOGIC ---
 def seed_data_if_empty():
@@ -103,6 +175,8 @@ def seed_data_if_empty():
             
             print(f"Reading Excel from: {excel_path}")
             df = pd.read_excel(excel_path)
+            warmup.begin("seeding", rows_total=len(df))
+            load_units(session, df)
             # Fix Dates
             date_cols = ['Registration_Date', 'LMP_Date', 'EDD_Date', 'Delivery_Date']
             for col in date_cols:
@@ -165,6 +239,7 @@ def seed_data_if_empty():
                     rch_id=str(get_val(row, 'RCH_ID')),
                     age=int(get_val(row, 'Mother_Age', 25)),
                     address=f"{get_val(row, 'Village')}, {h_block}",
+                    state=get_val(row, 'State'),
                     district=h_dist,
                     block=h_block,
                     village=get_val(row, 'Village'),
@@ -210,6 +285,7 @@ def seed_data_if_empty():
                     hospital_id=h_id,
                     lmp_date=get_val(row, 'LMP_Date'),
                     edd_date=get_val(row, 'EDD_Date'),
+                    registration_date=get_val(row, 'Registration_Date'),
                     gravida=int(get_val(row, 'Gravida', 1)),
                     para=int(get_val(row, 'Parity', 0)),
                     high_risk_conditions=", ".join(high_risk) if high_risk else None,
@@ -323,6 +399,7 @@ def seed_data_if_empty():
                     )
                     session.add(sa2)
 
+                warmup.advance(index + 1)
                 if index % 50 == 0:
                     print(f"Imported {index} records...")
                     session.commit()
@@ -370,17 +447,48 @@ def seed_data_if_empty():
             print(f"Warning: Could not link demo users: {e}")
 
 
+# --- Fact databases: the request's session, or per-state shards (see sharding.py) ---
+def get_fact_sessions(session: Session = Depends(get_session)):
+    facts = FactSessions(session, shard_router)
+    try:
+        yield facts
+    finally:
+        facts.close()
+
+def _find(session: Session, model, **filters):
+    """First fact row matching `filters`, from whichever database holds it."""
+    if shard_router:
+        return shard_router.locate(model, **filters)[1]
+    return session.exec(select(model).filter_by(**filters)).first()
+
+async def _fact_rows(session: AsyncSession, query, state: Optional[str] = None):
+    """Rows of `query` over the fact tables: from `session`, or from `state`'s shard (every shard without one)."""
+    if shard_router:
+        return await shard_router.gather(query, state)
+    return (await session.exec(query)).all()
+
+async def _locate(session: AsyncSession, model, options=(), **filters):
+    """Async `_find`; `options` are eager loads."""
+    if shard_router:
+        return (await shard_router.alocate(model, options, **filters))[1]
+    return (await session.exec(select(model).filter_by(**filters).options(*options))).first()
+
+def _fact_engines(state: Optional[str] = None):
+    """Async engines the line lists stream from."""
+    if shard_router:
+        return [shard.async_engine for shard in shard_router.for_scope(state)]
+    return [analytics_async_engine()]
+
 # --- Authorizer Application Management ---
 @app.get("/api/authorizer/applications")
-def get_authorizer_applications(status: Optional[str] = None, session: Session = Depends(get_session)):
-    query = select(SchemeApplication)
+async def get_authorizer_applications(status: Optional[str] = None, session: AsyncSession = Depends(get_async_session)):
+    query = select(SchemeApplication, Beneficiary).outerjoin(Beneficiary, Beneficiary.id == SchemeApplication.beneficiary_id)
     if status:
         query = query.where(SchemeApplication.status == status)
-    apps = session.exec(query).all()
+    rows = await _fact_rows(session, query)
     
     results = []
-    for a in apps:
-        ben = session.get(Beneficiary, a.beneficiary_id)
+    for a, ben in rows:
         results.append({
             "id": a.id,
             "beneficiary_name": ben.name if ben else "Unknown Mother",
@@ -393,7 +501,8 @@ def get_authorizer_applications(status: Optional[str] = None, session: Session =
     return results
 
 @app.post("/api/authorizer/applications/{app_id}/update-status")
-def update_application_status(app_id: int, status_data: dict = Body(...), session: Session = Depends(get_session)):
+def update_application_status(app_id: int, status_data: dict = Body(...), facts: FactSessions = Depends(get_fact_sessions)):
+    session = facts.owner(SchemeApplication, id=app_id)
     app_record = session.get(SchemeApplication, app_id)
     if not app_record:
         raise HTTPException(status_code=404, detail="Application not found")
@@ -406,7 +515,8 @@ def update_application_status(app_id: int, status_data: dict = Body(...), sessio
 
 # --- Auth Routes ---
 @app.post("/api/auth/register-beneficiary")
-def register_beneficiary(data: dict = Body(...), session: Session = Depends(get_session)):
+def register_beneficiary(data: dict = Body(...), session: Session = Depends(get_session),
+                         facts: FactSessions = Depends(get_fact_sessions)):
     import hashlib
     
     phone = data.get("phone")
@@ -421,7 +531,7 @@ def register_beneficiary(data: dict = Body(...), session: Session = Depends(get_
     
     if existing_user:
         # Check if beneficiary profile exists
-        existing_ben = session.exec(select(Beneficiary).where(Beneficiary.linked_user_id == existing_user.id)).first()
+        existing_ben = _find(session, Beneficiary, linked_user_id=existing_user.id)
         if existing_ben:
              raise HTTPException(status_code=400, detail="User with this phone already registered.")
         else:
@@ -429,6 +539,10 @@ def register_beneficiary(data: dict = Body(...), session: Session = Depends(get_
             session.delete(existing_user)
             session.commit()
 
+    # The profile has no state yet (the request session unless sharded). Resolved before the
+    # user insert below opens a write transaction, as a new shard registers in the primary.
+    fact_session = facts.for_state(None)
+
     # Create User
     pw_hash = hashlib.sha256(password.encode()).hexdigest()
     new_user = User(
@@ -452,14 +566,16 @@ def register_beneficiary(data: dict = Body(...), session: Session = Depends(get_
         block="Unknown",
         linked_user_id=new_user.id
     )
-    session.add(new_ben)
+    fact_session.add(new_ben)
     
     try:
         session.commit()
+        fact_session.commit()  # same session unless sharded: the user stays in the primary database
         session.refresh(new_user)
-        session.refresh(new_ben)
+        fact_session.refresh(new_ben)
     except Exception as e:
         session.rollback()
+        fact_session.rollback()
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
     
     return {"message": "Registration successful", "user_id": new_user.id, "beneficiary_id": new_ben.id}
@@ -491,13 +607,35 @@ def login(data: dict = Body(...)):
             "state": user.state  # None for global authorizer, state name for state-scoped
         }
 
+async def _state_key(state: str) -> int:
+    """GeoUnit id for a ?state= filter; unknown states map to -1, which matches nothing."""
+    sid = cached_state_id(state)
+    if sid is None:
+        # Not in the loaded dimension: look it up without blocking the event loop
+        sid = await run_in_threadpool(geo_state_id, state)
+    return sid if sid is not None else -1
+
+async def _unit_name(uid):
+    """Display name of a GeoUnit id for a line-list row (None if unknown)."""
+    name = cached_unit_name(uid)
+    if name is None:
+        name = await run_in_threadpool(unit_name, uid)
+    return name or None
+
+async def _unit_names(ids):
+    """{GeoUnit id: display name (None for the unassigned key 0 or an unknown id)}, from the in-memory dimension where possible."""
+    names = {uid: cached_unit_name(uid) for uid in set(ids)}
+    missing = [uid for uid, name in names.items() if name is None]
+    if missing:
+        names.update(await run_in_threadpool(lambda: {uid: unit_name(uid) for uid in missing}))
+    return {uid: name or None for uid, name in names.items()}
+
 # --- Admin Routes ---
 @app.get("/api/admin/overview")
-def get_admin_overview(session: Session = Depends(get_session)):
-    hospitals = session.exec(select(Hospital)).all()
-    authorizers = session.exec(select(User).where(User.role == "AUTHORIZER")).all()
-    beneficiaries = session.exec(select(User).where(User.role == "BENEFICIARY")).all()
-    hosp_users = session.exec(select(User).where(User.role == "HOSPITAL")).all()
+async def get_admin_overview(session: AsyncSession = Depends(get_async_session)):
+    hospitals = (await session.exec(select(Hospital))).all()
+    authorizers = (await session.exec(select(User).where(User.role == "AUTHORIZER"))).all()
+    role_counts = dict((await session.exec(select(User.role, func.count(User.id)).group_by(User.role))).all())
     
     # Helper to avoid circular relationship recursion (User -> Beneficiary -> User)
     def safe_user(u):
@@ -524,8 +662,8 @@ def get_admin_overview(session: Session = Depends(get_session)):
     return {
         "total_hospitals": len(hospitals),
         "total_authorizers": len(authorizers),
-        "total_beneficiaries": len(beneficiaries),
-        "total_hospital_users": len(hosp_users),
+        "total_beneficiaries": role_counts.get("BENEFICIARY", 0),
+        "total_hospital_users": role_counts.get("HOSPITAL", 0),
         "hospitals": [safe_hosp(h) for h in hospitals],
         "authorizers": [safe_user(u) for u in authorizers]
     }
@@ -545,12 +683,22 @@ def create_hospital(data: dict = Body(...), session: Session = Depends(get_sessi
     session.refresh(new_hosp)
     return new_hosp
 
+# The public hospital payload: the GeoUnit ids are internal
+_HOSPITAL_COLUMNS = [c for c in Hospital.__table__.columns if c.name not in GEO_ID_ATTRS]
+
 @app.get("/api/authorizer/hospitals")
-def get_authorizer_hospitals(state: Optional[str] = None, session: Session = Depends(get_session)):
-    query = select(Hospital)
-    if state:
-        query = query.where(Hospital.state == state)
-    return session.exec(query).all()
+async def get_authorizer_hospitals(state: Optional[str] = None):
+    state_key = await _state_key(state) if state else None
+
+    async def rows():
+        query = select(*_HOSPITAL_COLUMNS)
+        if state_key is not None:
+            query = query.where(Hospital.state_id == state_key)
+        async with async_engine.connect() as conn:
+            async for row in await conn.stream(query):
+                yield row._asdict()
+
+    return stream_json_array(rows())
 
 @app.post("/api/admin/users/authorizer")
 def create_authorizer(data: dict = Body(...), session: Session = Depends(get_session)):
@@ -580,208 +728,369 @@ def create_hospital_user(data: dict = Body(...), session: Session = Depends(get_
     return new_user
 
 # --- Authorizer Routes ---
+async def _monthly_trend(session: AsyncSession, state: Optional[str], trend_from: Optional[str], trend_to: Optional[str],
+                         months: int, anchor: str = "registrations"):
+    """
+    Monthly buckets from the MonthlyTrend rollup, oldest first.
+    `trend_from`/`trend_to` are inclusive YYYY-MM bounds; without `trend_from`, the
+    latest `months` buckets (up to `trend_to`) with a non-zero `anchor` count are
+    returned, so the default window isn't taken up by months that only have deliveries
+    (or, for a delivery trend, only registrations).
+    """
+    query = select(
+        MonthlyTrend.month,
+        func.sum(MonthlyTrend.registrations).label("registrations"),
+        func.sum(MonthlyTrend.high_risk).label("high_risk"),
+        func.sum(MonthlyTrend.anc_compliance_sum).label("anc_compliance_sum"),
+        func.sum(MonthlyTrend.deliveries).label("deliveries"),
+    )
+    if state:
+        query = query.where(MonthlyTrend.state_id == await _state_key(state))
+    if trend_from:
+        query = query.where(MonthlyTrend.month >= trend_from)
+    if trend_to:
+        query = query.where(MonthlyTrend.month <= trend_to)
+    query = query.group_by(MonthlyTrend.month).order_by(MonthlyTrend.month.desc())
+    if not trend_from:
+        query = query.having(func.sum(getattr(MonthlyTrend, anchor)) > 0).limit(months)
+    rows = await _fact_rows(session, query, state)
+    if shard_router:
+        # Each shard returned its own latest buckets; add them up per month and keep the latest again
+        merged = {}
+        for r in rows:
+            m = merged.setdefault(r.month, SimpleNamespace(month=r.month, registrations=0, high_risk=0,
+                                                           anc_compliance_sum=0.0, deliveries=0))
+            m.registrations += r.registrations
+            m.high_risk += r.high_risk
+            m.anc_compliance_sum += r.anc_compliance_sum
+            m.deliveries += r.deliveries
+        rows = [merged[k] for k in sorted(merged, reverse=True)]
+        if not trend_from:
+            rows = rows[:months]
+    return list(reversed(rows))
+
 @app.get("/api/authorizer/summary")
-def get_authorizer_summary(state: Optional[str] = None, session: Session = Depends(get_session)):
+async def get_authorizer_summary(
+    state: Optional[str] = None,
+    trend_from: Optional[str] = None,
+    trend_to: Optional[str] = None,
+    months: int = 6,
+    session: AsyncSession = Depends(get_analytics_async_session),
+):
     """
     Returns summary stats. If `state` is provided, filters to that state only.
     State authorizers pass their assigned state; global authorizer passes nothing.
+    `trend_from`/`trend_to` (YYYY-MM) select the monthly_trend range, default is the latest `months` months
+    with registrations.
     """
-    # Base query helper: join Beneficiary for state filtering
-    def state_filter_pregs(q):
-        if state:
-            return q.join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id).filter(Beneficiary.state == state)
-        return q
-
-    def state_filter_deliveries(q):
-        if state:
-            return q.join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)\
-                    .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)\
-                    .filter(Beneficiary.state == state)
-        return q
-
-    def state_filter_children(q):
-        if state:
-            return q.join(Delivery, Delivery.id == Child.delivery_id)\
-                    .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)\
-                    .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)\
-                    .filter(Beneficiary.state == state)
-        return q
-
-    preg_risk = state_filter_pregs(
-        session.query(Pregnancy.risk_level_prebirth, func.count(Pregnancy.id)).group_by(Pregnancy.risk_level_prebirth)
-    ).all()
-
-    del_risk = state_filter_deliveries(
-        session.query(Delivery.risk_level_postbirth, func.count(Delivery.id)).group_by(Delivery.risk_level_postbirth)
-    ).all()
-
-    offtrack_child_count = state_filter_children(
-        session.query(func.count(Child.id)).filter(Child.offtrack_flag == True)
-    ).scalar() or 0
-
-    district_data = session.query(
-        Beneficiary.district,
-        func.count(Pregnancy.id).label("total_pregs"),
-        func.sum(case((Pregnancy.risk_level_prebirth == "HIGH", 1), else_=0)).label("high_risk_pre"),
-        func.avg(Pregnancy.anc_visits_completed / Pregnancy.anc_expected).label("avg_anc_compliance")
-    ).join(Pregnancy, Beneficiary.id == Pregnancy.beneficiary_id)
-    if state:
-        district_data = district_data.filter(Beneficiary.state == state)
-    district_data = district_data.group_by(Beneficiary.district).all()
-
-    block_data = session.query(
-        Beneficiary.block,
-        func.count(Pregnancy.id).label("count"),
-        func.sum(case((Pregnancy.risk_level_prebirth == "HIGH", 1), else_=0)).label("high_risk")
-    ).join(Pregnancy, Beneficiary.id == Pregnancy.beneficiary_id)
+    # Served from the incrementally maintained RiskRollup table (see rollups.py)
+    query = select(RiskRollup)
     if state:
-        block_data = block_data.filter(Beneficiary.state == state)
-    block_data = block_data.group_by(Beneficiary.block).all()
-
-    monthly_trend = [
-        {"month": "Jan", "high_risk": 45, "coverage": 82},
-        {"month": "Feb", "high_risk": 52, "coverage": 85},
-        {"month": "Mar", "high_risk": 48, "coverage": 88},
-        {"month": "Apr", "high_risk": 61, "coverage": 84},
-        {"month": "May", "high_risk": 55, "coverage": 91},
-        {"month": "Jun", "high_risk": 42, "coverage": 89},
-    ]
+        query = query.where(RiskRollup.state_id == await _state_key(state))
+    rollup_rows = await _fact_rows(session, query, state)
+    names = await _unit_names([r.district_id for r in rollup_rows] + [r.block_id for r in rollup_rows])
+
+    preg_risk = {}
+    del_risk = {}
+    offtrack_child_count = 0
+    districts = {}
+    blocks = {}
+    for r in rollup_rows:
+        for level in ("HIGH", "MEDIUM", "LOW"):
+            preg_count = getattr(r, f"preg_{level.lower()}")
+            del_count = getattr(r, f"del_{level.lower()}")
+            if preg_count:
+                preg_risk[level] = preg_risk.get(level, 0) + preg_count
+            if del_count:
+                del_risk[level] = del_risk.get(level, 0) + del_count
+        offtrack_child_count += r.offtrack_children
+
+        if not r.pregnancies:
+            continue
+        # Grouped on integer GeoUnit keys; names come from the in-memory dimension
+        d = districts.setdefault(r.district_id, {"district": names[r.district_id], "total_pregs": 0, "high_risk_pre": 0, "anc_sum": 0.0})
+        d["total_pregs"] += r.pregnancies
+        d["high_risk_pre"] += r.preg_high
+        d["anc_sum"] += r.anc_compliance_sum
+        # Blocks are listed by name across districts, as before
+        block_name = names[r.block_id]
+        b = blocks.setdefault(block_name, {"block": block_name, "count": 0, "high_risk": 0})
+        b["count"] += r.pregnancies
+        b["high_risk"] += r.preg_high
+
+    for d in districts.values():
+        d["avg_anc_compliance"] = d.pop("anc_sum") / d["total_pregs"]
+
+    monthly_trend = [{
+        "month": t.month,
+        "high_risk": t.high_risk,
+        # No registrations that month: no coverage to report (not 0%)
+        "coverage": round(100 * t.anc_compliance_sum / t.registrations) if t.registrations else None,
+        "registrations": t.registrations,
+        "deliveries": t.deliveries,
+    } for t in await _monthly_trend(session, state, trend_from, trend_to, months)]
 
     return {
-        "pregnancy_risk_distribution": dict(preg_risk),
-        "delivery_risk_distribution": dict(del_risk),
+        "pregnancy_risk_distribution": preg_risk,
+        "delivery_risk_distribution": del_risk,
         "offtrack_count": offtrack_child_count,
-        "districts": [dict(row._asdict()) for row in district_data],
-        "blocks": [dict(row._asdict()) for row in block_data],
+        # Unassigned (null) first, as the SQL GROUP BY listed it
+        "districts": sorted(districts.values(), key=lambda d: (d["district"] is not None, d["district"] or "")),
+        "blocks": [blocks[k] for k in sorted(blocks, key=lambda k: (k is not None, k or ""))],
         "monthly_trend": monthly_trend,
         "state_scope": state or "ALL"
     }
 
 @app.get("/api/admin/analytics")
-def get_admin_analytics(session: Session = Depends(get_session)):
+async def get_admin_analytics(months: int = 12, session: AsyncSession = Depends(get_analytics_async_session)):
     # User distribution by role
-    roles = session.query(User.role, func.count(User.id)).group_by(User.role).all()
+    roles = (await session.exec(select(User.role, func.count(User.id)).group_by(User.role))).all()
     
     # Hospitals by district
-    hosp_dist = session.query(Hospital.district, func.count(Hospital.id)).group_by(Hospital.district).all()
+    hosp_dist = (await session.exec(select(Hospital.district, func.count(Hospital.id)).group_by(Hospital.district))).all()
     
-    # Deliveries trend (last 12 months placeholder)
-    delivery_trend = session.query(
-        func.strftime('%m', Delivery.delivery_date).label('month'),
-        func.count(Delivery.id).label('count')
-    ).group_by('month').order_by('month').all()
+    # Deliveries trend (latest `months` months with deliveries, from the MonthlyTrend rollup)
+    delivery_trend = [{"month": t.month, "count": t.deliveries}
+                      for t in await _monthly_trend(session, None, None, None, months, anchor="deliveries")]
 
-    # Scheme applications by status
-    scheme_status = session.query(SchemeApplication.status, func.count(SchemeApplication.id)).group_by(SchemeApplication.status).all()
+    # Scheme applications by status (summed over shards when sharded)
+    scheme_status = {}
+    for status_name, count in await _fact_rows(
+            session, select(SchemeApplication.status, func.count(SchemeApplication.id)).group_by(SchemeApplication.status)):
+        scheme_status[status_name] = scheme_status.get(status_name, 0) + count
 
     # Total active pregnancies for the metric card
-    active_pregs = session.exec(select(func.count(Pregnancy.id))).one()
+    active_pregs = sum(await _fact_rows(session, select(func.count(Pregnancy.id))))
 
     return {
         "role_distribution": dict(roles),
         "hospital_distribution": dict(hosp_dist),
-        "delivery_trend": [dict(row._asdict()) for row in delivery_trend],
-        "scheme_status": dict(scheme_status),
+        "delivery_trend": delivery_trend,
+        "scheme_status": scheme_status,
         "active_pregnancies": active_pregs
     }
 
-@app.get("/api/authorizer/highrisk")
-def get_highrisk_cases(state: Optional[str] = None, session: Session = Depends(get_session)):
-    # Filter by state if provided
-    if state:
-        pre_high = session.query(Pregnancy).join(
-            Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id
-        ).filter(
-            Pregnancy.risk_level_prebirth == "HIGH",
-            Beneficiary.state == state
-        ).all()
-        post_high = session.query(Delivery).join(
-            Pregnancy, Pregnancy.id == Delivery.pregnancy_id
-        ).join(
-            Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id
-        ).filter(
-            Delivery.risk_level_postbirth == "HIGH",
-            Beneficiary.state == state
-        ).all()
-    else:
-        pre_high = session.exec(select(Pregnancy).where(Pregnancy.risk_level_prebirth == "HIGH")).all()
-        post_high = session.exec(select(Delivery).where(Delivery.risk_level_postbirth == "HIGH")).all()
+_HIGH = literal("HIGH", literal_execute=True)
 
-    results = []
-    for p in pre_high:
-        results.append({
+def _geo_where(query, model, geo):
+    """Apply filter_ids() output (GeoUnit id lists per level) to a fact-table query."""
+    for attr, ids in geo.items():
+        query = query.where(getattr(model, attr).in_(ids))
+    return query
+
+async def _highrisk_pregnancies(conn, geo):
+    query = (
+        select(Pregnancy.id, Pregnancy.state_id, Pregnancy.district_id, Pregnancy.block_id, Pregnancy.risk_score_prebirth,
+               Pregnancy.edd_date, Beneficiary.name, Beneficiary.phone)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .where(Pregnancy.risk_level_prebirth == _HIGH)
+    )
+    query = _geo_where(query, Pregnancy, geo)
+    # Sorted by SQLite, not in Python, so rows stream straight into the merge below
+    query = query.order_by(Pregnancy.risk_score_prebirth.desc(), Pregnancy.id.desc())
+    async for r in await conn.stream(query):
+        yield {
             "type": "Pregnancy",
-            "name": p.beneficiary.name,
-            "district": p.beneficiary.district,
-            "block": p.beneficiary.block,
-            "state": p.beneficiary.state,
-            "score": p.risk_score_prebirth or 0.0,
-            "id": p.id,
-            "pregnancy_id": p.id,
-            "phone": p.beneficiary.phone,
-            "edd": str(p.edd_date) if p.edd_date else None,
+            "name": r.name,
+            "district": await _unit_name(r.district_id),
+            "block": await _unit_name(r.block_id),
+            "state": await _unit_name(r.state_id),
+            "score": r.risk_score_prebirth or 0.0,
+            "id": r.id,
+            "pregnancy_id": r.id,
+            "phone": r.phone,
+            "edd": str(r.edd_date) if r.edd_date else None,
             "children": []
-        })
-    for d in post_high:
-        results.append({
-            "type": "Delivery",
-            "name": d.pregnancy.beneficiary.name,
-            "district": d.pregnancy.beneficiary.district,
-            "block": d.pregnancy.beneficiary.block,
-            "state": d.pregnancy.beneficiary.state,
-            "score": d.risk_score_postbirth or 0.0,
-            "hospital": d.hospital_id,
-            "id": d.id,
-            "pregnancy_id": d.pregnancy_id,
-            "phone": d.pregnancy.beneficiary.phone,
-            "delivery_date": str(d.delivery_date) if d.delivery_date else None,
-            "delivery_type": d.delivery_type,
-            "children": [
-                {
-                    "name": c.name or "Baby",
+        }
+
+async def _delivery_case(group):
+    d = group[0]
+    return {
+        "type": "Delivery",
+        "name": d.name,
+        "district": await _unit_name(d.district_id),
+        "block": await _unit_name(d.block_id),
+        "state": await _unit_name(d.state_id),
+        "score": d.risk_score_postbirth or 0.0,
+        "hospital": d.hospital_id,
+        "id": d.id,
+        "pregnancy_id": d.pregnancy_id,
+        "phone": d.phone,
+        "delivery_date": str(d.delivery_date) if d.delivery_date else None,
+        "delivery_type": d.delivery_type,
+        "children": [
+            {
+                "name": c.child_name or "Baby",
+                "sex": c.sex,
+                "offtrack": c.offtrack_flag,
+                "immunizations_completed": c.immunizations_completed,
+                "immunizations_expected": c.immunizations_expected,
+            }
+            for c in group if c.child_id is not None
+        ]
+    }
+
+async def _highrisk_deliveries(conn, geo):
+    query = (
+        select(Delivery.id, Delivery.state_id, Delivery.district_id, Delivery.block_id, Delivery.risk_score_postbirth,
+               Delivery.hospital_id, Delivery.pregnancy_id, Delivery.delivery_date, Delivery.delivery_type,
+               Beneficiary.name, Beneficiary.phone,
+               Child.id.label("child_id"), Child.name.label("child_name"), Child.sex, Child.offtrack_flag,
+               Child.immunizations_completed, Child.immunizations_expected)
+        .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .outerjoin(Child, Child.delivery_id == Delivery.id)
+        .where(Delivery.risk_level_postbirth == _HIGH)
+    )
+    query = _geo_where(query, Delivery, geo)
+    query = query.order_by(Delivery.risk_score_postbirth.desc(), Delivery.id.desc())
+    # One row per child (or one childless row); consecutive rows share the delivery
+    group = []
+    async for row in await conn.stream(query):
+        if group and row.id != group[0].id:
+            yield await _delivery_case(group)
+            group = []
+        group.append(row)
+    if group:
+        yield await _delivery_case(group)
+
+async def _merge_by_score(*streams):
+    """Merge async streams of cases that are each sorted by descending score (ties: earlier stream first)."""
+    heads = []
+    for i, stream in enumerate(streams):
+        case = await anext(stream, None)
+        if case is not None:
+            heapq.heappush(heads, (-case["score"], i, case))
+    while heads:
+        _, i, case = heapq.heappop(heads)
+        yield case
+        case = await anext(streams[i], None)
+        if case is not None:
+            heapq.heappush(heads, (-case["score"], i, case))
+
+async def _highrisk_rows(geo, state=None):
+    async with contextlib.AsyncExitStack() as stack:
+        streams = []
+        for fact_engine in _fact_engines(state):
+            conn = await stack.enter_async_context(fact_engine.connect())
+            streams += [_highrisk_pregnancies(conn, geo), _highrisk_deliveries(conn, geo)]
+        # Every cursor is already ordered by score, so a merge keeps the combined list sorted
+        async for case in _merge_by_score(*streams):
+            yield case
+
+async def _offtrack_rows(geo, state=None):
+    query = (
+        select(Child.name.label("child_name"), Beneficiary.name.label("beneficiary"),
+               Child.state_id, Child.district_id, Child.block_id, Child.sex,
+               Child.immunizations_completed, Child.immunizations_expected)
+        .join(Delivery, Delivery.id == Child.delivery_id)
+        .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .where(Child.offtrack_flag == literal(True, literal_execute=True)) # matches partial ix_child_offtrack
+    )
+    query = _geo_where(query, Child, geo)
+    for fact_engine in _fact_engines(state):
+        async with fact_engine.connect() as conn:
+            async for c in await conn.stream(query):
+                yield {
+                    "child_name": c.child_name or "Unnamed Child",
+                    "beneficiary": c.beneficiary,
+                    "district": await _unit_name(c.district_id),
+                    "block": await _unit_name(c.block_id),
+                    "state": await _unit_name(c.state_id),
                     "sex": c.sex,
-                    "offtrack": c.offtrack_flag,
                     "immunizations_completed": c.immunizations_completed,
                     "immunizations_expected": c.immunizations_expected,
                 }
-                for c in d.children
-            ]
-        })
 
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results
+async def _geo_filter(state, district, block):
+    geo = cached_filter_ids(state, district, block)
+    if geo is None:
+        # filter_ids reads GeoUnit through the sync engine
+        geo = await run_in_threadpool(filter_ids, state, district, block)
+    return geo
+
+@app.get("/api/authorizer/highrisk")
+async def get_highrisk_cases(state: Optional[str] = None, district: Optional[str] = None, block: Optional[str] = None):
+    # Geography is denormalized onto the fact tables, so the geo filters are index seeks.
+    # 'HIGH' is inlined rather than bound so SQLite can match the partial ix_*_high indexes.
+    return stream_json_array(_highrisk_rows(await _geo_filter(state, district, block), state))
 
 @app.get("/api/authorizer/offtrack")
-def get_offtrack_cases(state: Optional[str] = None, session: Session = Depends(get_session)):
-    if state:
-        offtrack_children = session.query(Child).join(
-            Delivery, Delivery.id == Child.delivery_id
-        ).join(
-            Pregnancy, Pregnancy.id == Delivery.pregnancy_id
-        ).join(
-            Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id
-        ).filter(
-            Child.offtrack_flag == True,
-            Beneficiary.state == state
-        ).all()
-    else:
-        offtrack_children = session.exec(select(Child).where(Child.offtrack_flag == True)).all()
-
-    return [{
-        "child_name": c.name or "Unnamed Child",
-        "beneficiary": c.delivery.pregnancy.beneficiary.name,
-        "district": c.delivery.pregnancy.beneficiary.district,
-        "block": c.delivery.pregnancy.beneficiary.block,
-        "state": c.delivery.pregnancy.beneficiary.state,
-    } for c in offtrack_children]
+async def get_offtrack_cases(state: Optional[str] = None, district: Optional[str] = None, block: Optional[str] = None):
+    return stream_json_array(_offtrack_rows(await _geo_filter(state, district, block), state))
+
+# --- Line-list exports for field teams ---
+_HIGHRISK_CSV_COLUMNS = [
+    "type", "id", "pregnancy_id", "name", "phone", "state", "district", "block", "score", "edd",
+    "hospital", "delivery_date", "delivery_type",
+    "child_name", "child_sex", "child_offtrack", "child_immunizations_completed", "child_immunizations_expected",
+]
+_OFFTRACK_CSV_COLUMNS = [
+    "child_name", "beneficiary", "state", "district", "block", "sex",
+    "immunizations_completed", "immunizations_expected",
+]
+
+async def _one_line_per_child(cases):
+    """Flatten highrisk cases for CSV: one line per child, or one line for a case without children."""
+    async for case in cases:
+        children = case.pop("children")
+        if not children:
+            yield case
+        for child in children:
+            yield {**case, **{f"child_{k}": v for k, v in child.items()}}
+
+def _export(kind, rows, format, csv_columns, state, district, block):
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    scope = "_".join(x.replace(" ", "-") for x in (state, district, block) if x) or "all"
+    filename = f"{kind}_{scope}_{date.today().isoformat()}.{format}"
+    if format == "ndjson":
+        return stream_ndjson(rows, filename)
+    if kind == "highrisk":
+        rows = _one_line_per_child(rows)
+    return stream_csv(rows, csv_columns, filename)
+
+@app.get("/api/authorizer/highrisk/export")
+async def export_highrisk_cases(format: str = "csv", state: Optional[str] = None, district: Optional[str] = None,
+                          block: Optional[str] = None):
+    """High-risk line list as CSV (one line per child) or NDJSON (one case per line, children nested)."""
+    rows = _highrisk_rows(await _geo_filter(state, district, block), state)
+    return _export("highrisk", rows, format, _HIGHRISK_CSV_COLUMNS, state, district, block)
+
+@app.get("/api/authorizer/offtrack/export")
+async def export_offtrack_cases(format: str = "csv", state: Optional[str] = None, district: Optional[str] = None,
+                          block: Optional[str] = None):
+    rows = _offtrack_rows(await _geo_filter(state, district, block), state)
+    return _export("offtrack", rows, format, _OFFTRACK_CSV_COLUMNS, state, district, block)
+
+# --- Declarative analytics queries (filters, group-by, aggregates, top-N; see analytics_query.py) ---
+@app.post("/api/analytics/query")
+def query_analytics(spec: dict = Body(...)):
+    try:
+        return run_analytics_query(spec)
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analytics/fields")
+def get_analytics_fields(entity: str = "pregnancy"):
+    """Fields an analytics query over `entity` may filter, group or aggregate on, with their kinds."""
+    if entity not in QUERY_ENTITIES:
+        raise HTTPException(status_code=400, detail=f"entity must be one of {', '.join(QUERY_ENTITIES)}")
+    return {"entity": entity, "fields": query_fields(entity)}
 
 # --- Hospital Routes ---
 _RISK_ORDER = {"HIGH": 0, "MEDIUM": 1, "LOW": 2, None: 3}
 
+# Async sessions can't lazy-load, so the relationships each read route walks are eager-loaded
+_WITH_CHILDREN = selectinload(Pregnancy.deliveries).selectinload(Delivery.children)
+
 @app.get("/api/hospital/dashboard")
-def get_hospital_dashboard(hospital_id: int, session: Session = Depends(get_session)):
-    pregs = session.exec(select(Pregnancy).where(Pregnancy.hospital_id == hospital_id)).all()
-    dels = session.exec(select(Delivery).where(Delivery.hospital_id == hospital_id)).all()
+async def get_hospital_dashboard(hospital_id: int, session: AsyncSession = Depends(get_async_session)):
+    # A hospital may treat mothers from any state: fans out to every shard when sharded
+    pregs = await _fact_rows(session, select(Pregnancy).where(Pregnancy.hospital_id == hospital_id)
+                             .options(selectinload(Pregnancy.beneficiary), _WITH_CHILDREN))
+    dels = await _fact_rows(session, select(Delivery).where(Delivery.hospital_id == hospital_id))
 
     patient_list = [{
         "id": p.id,
@@ -821,13 +1130,16 @@ def get_hospital_dashboard(hospital_id: int, session: Session = Depends(get_sess
     }
 
 @app.get("/api/hospital/patient/{preg_id}")
-def get_hospital_patient_detail(preg_id: int, session: Session = Depends(get_session)):
-    preg = session.get(Pregnancy, preg_id)
+async def get_hospital_patient_detail(preg_id: int, session: AsyncSession = Depends(get_async_session)):
+    preg = await _locate(session, Pregnancy, [
+        selectinload(Pregnancy.beneficiary).selectinload(Beneficiary.pregnancies)
+        .selectinload(Pregnancy.deliveries).selectinload(Delivery.children)], id=preg_id)
     if not preg:
         raise HTTPException(status_code=404, detail="Patient record not found")
     
     beneficiary = preg.beneficiary
-    applications = session.exec(select(SchemeApplication).where(SchemeApplication.beneficiary_id == beneficiary.id)).all()
+    applications = await _fact_rows(
+        session, select(SchemeApplication).where(SchemeApplication.beneficiary_id == beneficiary.id), beneficiary.state)
     
     return {
         "profile": {
@@ -858,7 +1170,8 @@ def get_hospital_patient_detail(preg_id: int, session: Session = Depends(get_ses
 # --- Beneficiary Routes ---
 # Hospital: Register a new mother with full profile + pregnancy clinical data
 @app.post("/api/hospital/register-mother")
-def hospital_register_mother(data: dict = Body(...), session: Session = Depends(get_session)):
+def hospital_register_mother(data: dict = Body(...), session: Session = Depends(get_session),
+                             facts: FactSessions = Depends(get_fact_sessions)):
     """
     Hospital registers a new mother with:
     - Personal info (name, age, phone, address etc.)
@@ -893,6 +1206,8 @@ def hospital_register_mother(data: dict = Body(...), session: Session = Depends(
     district = data.get("district", "")
     state = data.get("state", "")
     address_parts = [p for p in [village, block, district, state] if p]
+    # The mother's facts go to her state's database (the request session unless sharded)
+    fact_session = facts.for_state(state or infer_state(district))
     
     new_ben = Beneficiary(
         name=data.get("name", "Unknown"),
@@ -912,9 +1227,9 @@ def hospital_register_mother(data: dict = Body(...), session: Session = Depends(
         aadhaar_linked=bool(data.get("aadhaar_linked", False)),
         linked_user_id=new_user.id
     )
-    session.add(new_ben)
-    session.commit()
-    session.refresh(new_ben)
+    fact_session.add(new_ben)
+    fact_session.commit()
+    fact_session.refresh(new_ben)
     
     # 3. Create Pregnancy record with clinical data
     lmp_str = data.get("lmp_date")
@@ -969,9 +1284,9 @@ def hospital_register_mother(data: dict = Body(...), session: Session = Depends(
         usg_done=bool(data.get("usg_done", False)),
         danger_signs=bool(data.get("danger_signs", False)),
     )
-    session.add(new_preg)
-    session.commit()
-    session.refresh(new_preg)
+    fact_session.add(new_preg)
+    fact_session.commit()
+    fact_session.refresh(new_preg)
     
     # 4. Run ML risk prediction immediately
     risk_result = predict_prebirth_risk(new_preg)
@@ -990,8 +1305,8 @@ def hospital_register_mother(data: dict = Body(...), session: Session = Depends(
     if new_preg.danger_signs: conditions.append("Danger Signs")
     new_preg.high_risk_conditions = ", ".join(conditions) if conditions else None
     
-    session.add(new_preg)
-    session.commit()
+    fact_session.add(new_preg)
+    fact_session.commit()
     
     # --- Scheme Recommendation Logic ---
     recommendations = []
@@ -1046,7 +1361,8 @@ def hospital_register_mother(data: dict = Body(...), session: Session = Depends(
 
 # (Duplicates of auth route above, but keeping for compatibility)
 @app.post("/api/beneficiary/scheme-applications")
-def apply_scheme(data: dict = Body(...), session: Session = Depends(get_session)):
+def apply_scheme(data: dict = Body(...), facts: FactSessions = Depends(get_fact_sessions)):
+    session = facts.owner(Beneficiary, id=data["beneficiary_id"])
     new_app = SchemeApplication(
         beneficiary_id=data["beneficiary_id"],
         pregnancy_id=data.get("pregnancy_id"),
@@ -1071,20 +1387,23 @@ def register_admin(data: dict = Body(...), session: Session = Depends(get_sessio
     return {"message": "Admin registration successful"}
 
 @app.get("/api/beneficiary/dashboard")
-def get_beneficiary_dashboard(user_id: int, session: Session = Depends(get_session)):
-    beneficiary = session.exec(select(Beneficiary).where(Beneficiary.linked_user_id == user_id)).first()
+async def get_beneficiary_dashboard(user_id: int, session: AsyncSession = Depends(get_async_session)):
+    beneficiary = await _locate(session, Beneficiary, linked_user_id=user_id)
     if not beneficiary:
         # Fallback for demo if not linked
-        beneficiary = session.exec(select(Beneficiary)).first()
+        beneficiary = await _locate(session, Beneficiary)
     if not beneficiary:
          raise HTTPException(status_code=404, detail="Beneficiary profile not found")
     
-    pregs = session.exec(select(Pregnancy).where(Pregnancy.beneficiary_id == beneficiary.id).order_by(Pregnancy.id.desc())).all()
-    applications = session.exec(select(SchemeApplication).where(SchemeApplication.beneficiary_id == beneficiary.id)).all()
+    pregs = await _fact_rows(
+        session, select(Pregnancy).where(Pregnancy.beneficiary_id == beneficiary.id).order_by(Pregnancy.id.desc())
+        .options(_WITH_CHILDREN), beneficiary.state)
+    applications = await _fact_rows(
+        session, select(SchemeApplication).where(SchemeApplication.beneficiary_id == beneficiary.id), beneficiary.state)
     
     hospital_info = None
     if pregs and pregs[0].deliveries:
-        h = session.get(Hospital, pregs[0].deliveries[0].hospital_id)
+        h = await session.get(Hospital, pregs[0].deliveries[0].hospital_id)
         hospital_info = {"name": h.name, "location": f"{h.block}, {h.district}"}
 
     today = date.today()
@@ -1128,7 +1447,8 @@ def get_beneficiary_dashboard(user_id: int, session: Session = Depends(get_sessi
     }
 
 @app.post("/api/beneficiary/complete-profile-and-apply")
-def complete_profile_and_apply(data: dict = Body(...), session: Session = Depends(get_session)):
+def complete_profile_and_apply(data: dict = Body(...), session: Session = Depends(get_session),
+                               facts: FactSessions = Depends(get_fact_sessions)):
     """
     Updates Beneficiary & Pregnancy profile and submits Scheme Application.
     """
@@ -1141,7 +1461,9 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
     if not user:
          raise HTTPException(status_code=404, detail="User not found.")
 
-    ben = session.exec(select(Beneficiary).where(Beneficiary.linked_user_id == user_id)).first()
+    # Her current database (the request session unless sharded)
+    fact_session = facts.owner(Beneficiary, default_state=data.get("state"), linked_user_id=user_id)
+    ben = fact_session.exec(select(Beneficiary).where(Beneficiary.linked_user_id == user_id)).first()
     
     if not ben:
         # Create new Beneficiary profile if it doesn't exist
@@ -1154,9 +1476,9 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
             block=data.get("block", "Unknown"),
             address="Update Profile"
         )
-        session.add(ben)
-        session.commit()
-        session.refresh(ben)
+        fact_session.add(ben)
+        fact_session.commit()
+        fact_session.refresh(ben)
 
     # 2. Update Beneficiary Details
     if "name" in data: ben.name = data["name"]
@@ -1182,13 +1504,13 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
     if "pmjay_id" in data: ben.pmjay_id = data["pmjay_id"]
     if "aadhaar_linked" in data: ben.aadhaar_linked = data["aadhaar_linked"]
 
-    session.add(ben)
-    session.commit() # Commit ben updates
+    fact_session.add(ben)
+    fact_session.commit() # Commit ben updates
     
     # 3. Update or Create Pregnancy Record
     # Find active pregnancy (no delivery date yet)
     # For now, just getting the latest one created
-    current_preg = session.exec(select(Pregnancy).where(Pregnancy.beneficiary_id == ben.id).order_by(Pregnancy.id.desc())).first()
+    current_preg = fact_session.exec(select(Pregnancy).where(Pregnancy.beneficiary_id == ben.id).order_by(Pregnancy.id.desc())).first()
 
     if not current_preg:
         # Create a new pregnancy record if none exists
@@ -1208,9 +1530,9 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
             anc_visits_completed=int(data.get("anc_visits_completed", 0)),
             risk_level_prebirth="LOW" # Default
         )
-        session.add(current_preg)
-        session.commit()
-        session.refresh(current_preg)
+        fact_session.add(current_preg)
+        fact_session.commit()
+        fact_session.refresh(current_preg)
     
     p = current_preg
     if "lmp_date" in data and data["lmp_date"]:
@@ -1283,9 +1605,9 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
     if p.danger_signs: conds.append("Danger Signs")
     p.high_risk_conditions = ", ".join(conds) if conds else None
 
-    session.add(p)
-    session.commit()
-    session.refresh(p)
+    fact_session.add(p)
+    fact_session.commit()
+    fact_session.refresh(p)
 
     # 4. Create Scheme Application
     new_app = SchemeApplication(
@@ -1295,8 +1617,8 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
         scheme_type=data.get("scheme_type", "General"),
         status="SUBMITTED"
     )
-    session.add(new_app)
-    session.commit()
+    fact_session.add(new_app)
+    fact_session.commit()
 
     # --- Scheme Recommendation Logic ---
     recommendations = []
@@ -1355,61 +1677,66 @@ def complete_profile_and_apply(data: dict = Body(...), session: Session = Depend
             "docs": "BPL/Caste Cert, Bank Passbook, Aadhaar"
         })
 
-    return {
+    response = {
         "message": "Profile updated and application submitted successfully!",
         "risk_level": p.risk_level_prebirth,
         "risk_score": p.risk_score_prebirth,
         "application_id": new_app.id,
         "recommended_schemes": recommendations
     }
+    # A changed state moves her records into that state's shard (no-op unless sharded)
+    facts.rehome(fact_session, ben)
+    return response
 
 # --- Prediction Routes ---
 @app.post("/api/predictions/recompute")
-def recompute_all_predictions(session: Session = Depends(get_session)):
+def recompute_all_predictions(facts: FactSessions = Depends(get_fact_sessions)):
     """Recompute ML risk scores for all records and persist to DB."""
     preg_count = 0
     del_count = 0
     child_count = 0
     high_risk_count = 0
 
-    # 1. Update Pregnancies
-    pregnancies = session.exec(select(Pregnancy)).all()
-    for p in pregnancies:
-        try:
-            res = predict_prebirth_risk(p)
-            p.risk_score_prebirth = res["score"]
-            p.risk_level_prebirth = res["level"]
-            session.add(p)
-            preg_count += 1
-            if res["level"] == "HIGH":
-                high_risk_count += 1
-        except Exception as e:
-            print(f"Error predicting prebirth for pregnancy {p.id}: {e}")
+    # One pass per fact database (every shard when sharded)
+    for session in facts.all():
+        # 1. Update Pregnancies
+        pregnancies = session.exec(select(Pregnancy)).all()
+        for p in pregnancies:
+            try:
+                res = predict_prebirth_risk(p)
+                p.risk_score_prebirth = res["score"]
+                p.risk_level_prebirth = res["level"]
+                session.add(p)
+                preg_count += 1
+                if res["level"] == "HIGH":
+                    high_risk_count += 1
+            except Exception as e:
+                print(f"Error predicting prebirth for pregnancy {p.id}: {e}")
 
-    # 2. Update Deliveries
-    deliveries = session.exec(select(Delivery)).all()
-    for d in deliveries:
-        try:
-            res = predict_postbirth_risk(d)
-            d.risk_score_postbirth = res["score"]
-            d.risk_level_postbirth = res["level"]
-            session.add(d)
-            del_count += 1
-        except Exception as e:
-            print(f"Error predicting postbirth for delivery {d.id}: {e}")
+        # 2. Update Deliveries
+        deliveries = session.exec(select(Delivery)).all()
+        for d in deliveries:
+            try:
+                res = predict_postbirth_risk(d)
+                d.risk_score_postbirth = res["score"]
+                d.risk_level_postbirth = res["level"]
+                session.add(d)
+                del_count += 1
+            except Exception as e:
+                print(f"Error predicting postbirth for delivery {d.id}: {e}")
 
-    # 3. Update Children Off-track
-    children = session.exec(select(Child)).all()
-    for c in children:
-        try:
-            c.offtrack_flag = detect_offtrack(c)
-            session.add(c)
-            child_count += 1
-        except Exception as e:
-            print(f"Error detecting offtrack for child {c.id}: {e}")
+        # 3. Update Children Off-track
+        children = session.exec(select(Child)).all()
+        for c in children:
+            try:
+                c.offtrack_flag = detect_offtrack(c)
+                session.add(c)
+                child_count += 1
+            except Exception as e:
+                print(f"Error detecting offtrack for child {c.id}: {e}")
 
-    # CRITICAL: commit all changes to the database
-    session.commit()
+        # CRITICAL: commit all changes to the database
+        session.commit()
 
     return {
         "status": "success",
@@ -1421,116 +1748,46 @@ def recompute_all_predictions(session: Session = Depends(get_session)):
     }
 
 # --- AI Assistant Routes ---
-# Load environment variables from .env file
-load_dotenv()
-
-# Configure Gemini (You should use an environment variable for the key)
-API_KEY = os.getenv("GEMINI_API_KEY")  
-if API_KEY:
-    genai.configure(api_key=API_KEY)
-
-# --- Cached Model Discovery (runs once at startup, not per-request) ---
-_cached_models_to_try = []
-
-def _discover_gemini_models():
-    """Discover available Gemini models once and cache the result."""
-    global _cached_models_to_try
-    if _cached_models_to_try:
-        return _cached_models_to_try
-    
-    available_models = []
-    try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available_models.append(m.name)
-        print(f"Discovered Models: {available_models}")
-    except Exception as e:
-        print(f"Model Discovery Error: {e}")
-
-    preferred_order = ['gemini-2.0-flash', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro']
-    models_to_try = []
-
-    if available_models:
-        for pref in preferred_order:
-            for avail in available_models:
-                if pref in avail and avail not in models_to_try:
-                    models_to_try.append(avail)
-        for avail in available_models:
-            if avail not in models_to_try and "vision" not in avail and "embedding" not in avail:
-                models_to_try.append(avail)
-
-    if not models_to_try:
-        models_to_try = ['gemini-1.5-flash', 'gemini-pro', 'models/gemini-1.5-flash']
-
-    _cached_models_to_try = models_to_try
-    print(f"Cached Model List: {_cached_models_to_try}")
-    return _cached_models_to_try
-
-# --- Helper: Build Analysis DataFrame ---
-def get_analysis_dataframe(session: Session):
-    """
-    Constructs a flat DataFrame merging Beneficiary -> Pregnancy -> Delivery -> Child.
-    Useful for ad-hoc analysis and "deriving new features".
-    """
-    # Fetch all data (optimized slightly to avoid N+1 if possible, but for prototype simple select is fine)
-    bens = session.exec(select(Beneficiary)).all()
-    pregs = session.exec(select(Pregnancy)).all()
-    dels = session.exec(select(Delivery)).all()
-    children = session.exec(select(Child)).all()
-    
-    if not bens:
-        return pd.DataFrame()
-
-    # Convert to list of dicts (using model_dump if available, else dict used in older sqlmodel)
-    def to_dict(obj):
-        d = obj.model_dump() if hasattr(obj, "model_dump") else obj.dict()
-        # Remove relationship keys that cause serialization issues
-        return {k: v for k, v in d.items() if not isinstance(v, (list, dict)) and v.__class__.__module__ != 'sqlmodel'}
-
-    df_ben = pd.DataFrame([to_dict(b) for b in bens])
-    df_preg = pd.DataFrame([to_dict(p) for p in pregs]) if pregs else pd.DataFrame()
-    df_del = pd.DataFrame([to_dict(d) for d in dels]) if dels else pd.DataFrame()
-    df_child = pd.DataFrame([to_dict(c) for c in children]) if children else pd.DataFrame()
-    
-    # Rename id columns to avoid collisions
-    if not df_ben.empty: df_ben = df_ben.rename(columns={'id': 'beneficiary_id'})
-    if not df_preg.empty: df_preg = df_preg.rename(columns={'id': 'pregnancy_id', 'beneficiary_id': 'beneficiary_id_fk'})
-    if not df_del.empty: df_del = df_del.rename(columns={'id': 'delivery_id', 'pregnancy_id': 'pregnancy_id_fk'})
-    if not df_child.empty: df_child = df_child.rename(columns={'id': 'child_id', 'delivery_id': 'delivery_id_fk'})
-
-    # Merge: Ben -> Preg -> Del -> Child
-    # 1. Ben + Preg (Left join to keep all beneficiaries)
-    if not df_preg.empty:
-        df = pd.merge(df_ben, df_preg, left_on='beneficiary_id', right_on='beneficiary_id_fk', how='left', suffixes=('', '_preg'))
-    else:
-        df = df_ben
-        
-    # 2. + Del
-    if not df_del.empty:
-        df = pd.merge(df, df_del, left_on='pregnancy_id', right_on='pregnancy_id_fk', how='left', suffixes=('', '_del'))
-        
-    # 3. + Child
-    if not df_child.empty:
-        df = pd.merge(df, df_child, left_on='delivery_id', right_on='delivery_id_fk', how='left', suffixes=('', '_child'))
-        
-    # Cleanup join columns
-    cols_to_drop = [c for c in df.columns if '_fk' in c]
-    df = df.drop(columns=cols_to_drop, errors='ignore')
-    
-    return df
+@app.get("/api/assistant/metrics")
+def assistant_metrics():
+    """Per-process counters of the generated-code cache, the analysis frame cache, the sandbox pool and the LLM client."""
+    return {"code_cache": code_cache.stats(), "analysis_frame": analysis_frames.stats(), "sandbox": sandbox.stats(),
+            "llm": llm.stats() if llm else None}
 
 # Greeting words to match exactly (not by length)
 _GREETING_WORDS = {'hi', 'hello', 'hey', 'greetings', 'namaste', 'hola', 'howdy', 'sup', 'yo'}
 
-@app.post("/api/assistant/query")
-def assistant_query(data: dict = Body(...), session: Session = Depends(get_session)):
-    query = data.get("query", "").strip()
+def _assistant_steps(query, stream=False):
+    """
+    The assistant pipeline as (event, data) pairs, ending with ("done", response).
+
+    Along the way: ("stage", {"stage": "intent" | "code_generated" | "result_computed", ...}), where
+    an "intent" stage names the path taken (a fast-path intent, "analytics_query" or "llm"),
+    ("plot", plot_data) as soon as a chart is computed and, with `stream`,
+    ("token", {"text": ...}) for each chunk of the final answer as the LLM writes it.
+    """
     query_lower = query.lower()
     print(f"Assistant Query: {query}")
 
     try:
-        if not API_KEY:
-            return {"response": "AI Service not configured (Missing API Key).", "action": "none"}
+        # 0. Frequent questions are answered from the rollups without the LLM (see assistant_intents.py)
+        matched = match_intent(query)
+        if matched is not None:
+            intent, state = matched
+            yield "stage", {"stage": "intent", "intent": intent.name, "state": state}
+            print("Answered from the intent fast path.")
+            yield "done", answer_matched_intent(intent, state)
+            return
+        sliced = match_slice(query)
+        if sliced is not None:
+            yield "stage", {"stage": "intent", "intent": "analytics_query", "query": sliced.spec}
+            print("Answered with an analytics query.")
+            yield "done", answer_slice(sliced)
+            return
+
+        if llm is None:
+            yield "done", {"response": "AI Service not configured (Missing API Key).", "action": "none"}
+            return
 
         # 1. Quick return for greetings (no LLM, no DataFrame, no exec needed)
         query_words = query_lower.split()
@@ -1539,7 +1796,7 @@ def assistant_query(data: dict = Body(...), session: Session = Depends(get_sessi
         
         if is_greeting:
             print("Detected greeting. Returning hardcoded response.")
-            return {
+            yield "done", {
                 "response": "Hello! I am Sentinel AI, your maternal health data assistant. You can ask me questions like:\n\n"
                            "• \"How many high-risk pregnancies are there?\"\n"
                            "• \"Show district-wise risk distribution\"\n"
@@ -1548,30 +1805,22 @@ def assistant_query(data: dict = Body(...), session: Session = Depends(get_sessi
                            "How can I help you today?",
                 "action": "none"
             }
+            return
 
-        # 2. Load Data for Analysis
-        df = get_analysis_dataframe(session)
-        print(f"DEBUG: Loaded DF with {len(df)} rows and columns: {df.columns.tolist()}")
-        
-        # Prepare Schema Info
-        buffer = io.StringIO()
-        df.info(buf=buffer)
-        schema_info = buffer.getvalue()
-        columns_list = df.columns.tolist()
-        
-        # Sample data (first row) to give context on values
-        sample_row = df.head(1).to_dict(orient='records')[0] if not df.empty else {}
+        # Neither fast path matched: the question goes to the LLM-generated analysis
+        yield "stage", {"stage": "intent", "intent": "llm"}
 
-        # 3. Discover models (cached after first call)
-        models_to_try = _discover_gemini_models()
-        print(f"Using Models: {models_to_try}")
+        # 2. Load Data for Analysis (cached per data version, see analysis_frame.py)
+        # Its schema digest (column types, ranges, category values) is built with it, once per data version
+        frame_entry = analysis_frames.entry()
+        schema_hash = frame_entry.schema_hash
 
-        # 4. Construct Prompt for Code Generation
+        # 3. Construct Prompt for Code Generation
         system_prompt = f"""
         You are an expert Python Data Analyst & Guide for MaatriNet (Maternal & Child Health System).
         You have access to a pandas DataFrame `df` containing the entire dataset.
         
-        User Query: "{data.get('query')}"
+        User Query: "{query}"
         
         # App Navigation & Usage Context (Use this to answer "How to" questions):
         - **Login**: /login (Roles: Admin, Authorizer, Hospital, Beneficiary).
@@ -1582,10 +1831,7 @@ def assistant_query(data: dict = Body(...), session: Session = Depends(get_sessi
         - **Registration**: /register (New mothers).
         
         # DataFrame Schema:
-        Columns: {columns_list}
-        
-        # Sample Row:
-        {sample_row}
+{frame_entry.digest}
         
         # Task:
         1. Write a Python function `analyze(df)` that analyzes the data to answer the query.
@@ -1634,78 +1880,73 @@ def assistant_query(data: dict = Body(...), session: Session = Depends(get_sessi
             return "To register a patient, navigate to the Hospital Dashboard (/dashboard/hospital) and click 'Register Pregnancy'."
         """
 
-        generated_code = None
-
-        # 5. Generate Code with LLM
-        for model_name in models_to_try:
-            try:
-                print(f"Attempting code generation with: {model_name}")
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(system_prompt)
-                candidate_code = response.text.replace("```python", "").replace("```", "").strip()
-                
-                if "def analyze" in candidate_code:
-                    generated_code = candidate_code
-                    break
-            except Exception as e:
-                print(f"Model {model_name} failed: {e}")
-                continue
+        # 4. Reuse code generated for the same question (see code_cache.py), else generate it with the LLM
+        generated_code = code_cache.get(query, schema_hash, frame_entry.columns)
+        from_cache = generated_code is not None
+        cacheable = not from_cache
+        code_model = None
+        if not from_cache:
+            # Per-call deadlines, hedged fallback models and circuit breakers (see llm.py)
+            reply = llm.generate(system_prompt, accept=lambda text: "def analyze" in text)
+            if reply:
+                print(f"Code generated by {reply.model} in {reply.seconds:.2f}s")
+                code_model = reply.model
+                generated_code = reply.text.replace("```python", "").replace("```", "").strip()
         
         # Final Fallback if LLM failed or refused
         if not generated_code or "def analyze" not in generated_code:
              print("LLM failed to generate valid code. Using fallback.")
+             cacheable = False
              generated_code = """
 def analyze(df):
     return "I am experiencing high traffic or a temporary error. Please ask your question again in a moment."
 """
         
-        print(f"Generated Analysis Code:\n{generated_code}")
+        print(f"{'Cached' if from_cache else 'Generated'} Analysis Code:\n{generated_code}")
+        yield "stage", {"stage": "code_generated", "cached": from_cache, "model": code_model}
 
-        # 6. Execute Code safely
-        # Pass libraries to globals so the defined function can access them
-        execution_globals = {"df": df.copy(), "pd": pd, "np": np}
-        
+        # 5. Execute Code safely: in a sandbox worker with CPU, memory and result-size limits (see sandbox.py)
         try:
-            # We explicitly define the function in the local scope, using our custom globals
-            exec(generated_code, execution_globals)
-            
-            # Check if 'analyze' was defined
-            if "analyze" not in execution_globals:
-                 raise Exception("Function 'analyze(df)' was not defined in generated code.")
-            
-            # Run the specific analysis function
-            result = execution_globals["analyze"](df)
+            result = sandbox.run(generated_code, frame_entry)
             print(f"Analysis Result Value: {result}")
             
             if result is None:
                 print("WARNING: Analysis returned None.")
-                return {"response": "I understood your query but the analysis returned no result. Could you clarify?", "action": "none"}
+                yield "done", {"response": "I understood your query but the analysis returned no result. Could you clarify?", "action": "none"}
+                return
+            if cacheable:
+                code_cache.put(query, schema_hash, generated_code)
+
+            is_plot = isinstance(result, dict) and result.get("type") == "plot"
+            yield "stage", {"stage": "result_computed", "type": "plot" if is_plot else "text"}
 
-            
             # Check for Plot Result
-            if isinstance(result, dict) and result.get("type") == "plot":
+            if is_plot:
                 # Return the plot data directly to the frontend
-                return {
+                yield "plot", result
+                yield "done", {
                     "response": result.get("description", "Here is the chart you requested."),
                     "action": "plot",
                     "plot_data": result
                 }
+                return
 
             # If the result is already a clean string, check if it's conversational enough to return directly
             if isinstance(result, str) and len(result) > 20:
                 # Already a good response from the analyze function, return directly
-                return {
+                yield "done", {
                     "response": result,
                     "action": "none"
                 }
+                return
 
-            # 7. Final Natural Language Response
+            # 6. Final Natural Language Response
             # Feed the result back to LLM to make it conversational
             final_prompt = f"""
             System: You are Sentinel AI, a helpful assistant for the MaatriNet maternal health project.
             
             Context:
-            - User Question: "{data.get('query')}"
+            - User Question: "{query}"
             - Raw Data Analysis Result: "{result}"
             
             Task: Write a natural, helpful response to the user's question using the Raw Data Result.
@@ -1715,23 +1956,27 @@ def analyze(df):
             - DO NOT say "Analysis complete" or "Here is the data". Just answer the question.
             """
             
-            # Use same model for final response
-            final_response = str(result)
-            for model_name in models_to_try:
-                try:
-                    model = genai.GenerativeModel(model_name)
-                    final_response = model.generate_content(final_prompt).text
-                    break
-                except: continue
+            # Without a reply in time, the raw result is still the answer
+            if stream:
+                parts = []
+                for text in llm.stream(final_prompt):
+                    parts.append(text)
+                    yield "token", {"text": text}
+                final_response = "".join(parts) or str(result)
+            else:
+                reply = llm.generate(final_prompt)
+                final_response = reply.text if reply else str(result)
             
-            return {
+            yield "done", {
                 "response": final_response,
                 "action": "none"
             }
 
         except Exception as exec_err:
             print(f"Execution Error: {exec_err}")
-            return {
+            if from_cache and not isinstance(exec_err, SandboxBusy):
+                code_cache.discard(query, schema_hash)
+            yield "done", {
                 "response": f"I attempted to analyze the data but encountered an error: {str(exec_err)}. Please try rephrasing.",
                 "action": "none"
             }
@@ -1739,11 +1984,26 @@ def analyze(df):
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return {
+        yield "done", {
             "response": f"System Error: {str(e)}",
             "action": "none"
         }
 
+@app.post("/api/assistant/query")
+def assistant_query(data: dict = Body(...)):
+    for event, payload in _assistant_steps(data.get("query", "").strip()):
+        if event == "done":
+            return payload
+
+@app.post("/api/assistant/query/stream")
+def assistant_query_stream(data: dict = Body(...)):
+    """
+    /api/assistant/query as Server-Sent Events: progress stages, the chart as soon as it is
+    computed, the answer token by token, and last a "done" event with the full response.
+    """
+    return stream_events(_assistant_steps(data.get("query", "").strip(), stream=True))
+
 if __name__ == "__main__":
     import uvicorn
+    # Single process; `python serve.py --workers N` for the pre-forked multi-worker server
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,351 @@
+"""
+Versioned schema migrations for maatrinet.db.
+
+The schema version lives in SQLite's `PRAGMA user_version`. Each migration runs in
+its own transaction together with the version bump, so a failed step leaves the
+database at the previous version and is retried on the next start.
+
+Every step is frozen DDL rather than a create_all() over the live models, so a
+step always builds the same schema no matter what models.py looks like today.
+Steps are idempotent (IF NOT EXISTS, columns checked before ALTER TABLE):
+databases created by the first release, before this module existed, already
+carry the baseline tables, and the release after it added some columns ad hoc.
+
+Add new steps to the end of MIGRATIONS; never edit or renumber a released step.
+
+Usage:  python migrations.py           # upgrade to the latest version
+        python migrations.py status    # print current / latest version
+"""
+import sys
+
+
+# Schema of the first release (the tables SQLModel.metadata.create_all used to build), frozen here
+# so later model changes never leak into step 1
+BASELINE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS hospital (
+        id INTEGER NOT NULL,
+        name VARCHAR NOT NULL,
+        state VARCHAR,
+        district VARCHAR NOT NULL,
+        block VARCHAR NOT NULL,
+        type VARCHAR NOT NULL,
+        has_nicu BOOLEAN NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user (
+        id INTEGER NOT NULL,
+        name VARCHAR NOT NULL,
+        phone_or_email VARCHAR NOT NULL,
+        role VARCHAR NOT NULL,
+        password_hash VARCHAR NOT NULL,
+        hospital_id INTEGER,
+        state VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(hospital_id) REFERENCES hospital (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_phone_or_email ON user (phone_or_email)",
+    """CREATE TABLE IF NOT EXISTS beneficiary (
+        id INTEGER NOT NULL,
+        name VARCHAR NOT NULL,
+        rch_id VARCHAR,
+        age INTEGER NOT NULL,
+        address VARCHAR NOT NULL,
+        state VARCHAR,
+        district VARCHAR NOT NULL,
+        block VARCHAR NOT NULL,
+        village VARCHAR,
+        phone VARCHAR NOT NULL,
+        education VARCHAR,
+        occupation VARCHAR,
+        caste_category VARCHAR,
+        bpl_card BOOLEAN NOT NULL,
+        pmjay_id VARCHAR,
+        aadhaar_linked BOOLEAN NOT NULL,
+        linked_user_id INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(linked_user_id) REFERENCES user (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_beneficiary_rch_id ON beneficiary (rch_id)",
+    """CREATE TABLE IF NOT EXISTS pregnancy (
+        id INTEGER NOT NULL,
+        beneficiary_id INTEGER NOT NULL,
+        lmp_date DATE,
+        edd_date DATE,
+        gravida INTEGER NOT NULL,
+        para INTEGER NOT NULL,
+        high_risk_conditions VARCHAR,
+        anc_visits_completed INTEGER NOT NULL,
+        anc_expected INTEGER NOT NULL,
+        institutional_delivery_planned BOOLEAN NOT NULL,
+        hospital_id INTEGER,
+        blood_group VARCHAR,
+        rh_negative BOOLEAN NOT NULL,
+        height_cm FLOAT,
+        weight_kg FLOAT,
+        bmi FLOAT,
+        hb_level FLOAT,
+        anemia BOOLEAN NOT NULL,
+        bp_systolic INTEGER,
+        bp_diastolic INTEGER,
+        high_bp BOOLEAN NOT NULL,
+        diabetes BOOLEAN NOT NULL,
+        thyroid BOOLEAN NOT NULL,
+        hiv_positive BOOLEAN NOT NULL,
+        syphilis_positive BOOLEAN NOT NULL,
+        previous_csection BOOLEAN NOT NULL,
+        multiple_pregnancy BOOLEAN NOT NULL,
+        tt_doses INTEGER NOT NULL,
+        ifa_tablets INTEGER NOT NULL,
+        ifa_adequate BOOLEAN NOT NULL,
+        usg_done BOOLEAN NOT NULL,
+        danger_signs BOOLEAN NOT NULL,
+        risk_score_prebirth FLOAT,
+        risk_level_prebirth VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(beneficiary_id) REFERENCES beneficiary (id),
+        FOREIGN KEY(hospital_id) REFERENCES hospital (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS delivery (
+        id INTEGER NOT NULL,
+        pregnancy_id INTEGER NOT NULL,
+        hospital_id INTEGER NOT NULL,
+        delivery_date DATE NOT NULL,
+        delivery_type VARCHAR NOT NULL,
+        gestational_age_weeks INTEGER NOT NULL,
+        complications VARCHAR,
+        birthweight_grams INTEGER NOT NULL,
+        nicu_admission BOOLEAN NOT NULL,
+        preterm BOOLEAN NOT NULL,
+        stillbirth BOOLEAN NOT NULL,
+        pnc_check BOOLEAN NOT NULL,
+        risk_score_postbirth FLOAT,
+        risk_level_postbirth VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(pregnancy_id) REFERENCES pregnancy (id),
+        FOREIGN KEY(hospital_id) REFERENCES hospital (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS schemeapplication (
+        id INTEGER NOT NULL,
+        beneficiary_id INTEGER NOT NULL,
+        pregnancy_id INTEGER,
+        hospital_id INTEGER,
+        scheme_type VARCHAR NOT NULL,
+        status VARCHAR NOT NULL,
+        amount_eligible FLOAT,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(beneficiary_id) REFERENCES beneficiary (id),
+        FOREIGN KEY(pregnancy_id) REFERENCES pregnancy (id),
+        FOREIGN KEY(hospital_id) REFERENCES hospital (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS child (
+        id INTEGER NOT NULL,
+        delivery_id INTEGER NOT NULL,
+        name VARCHAR,
+        sex VARCHAR NOT NULL,
+        immunizations_completed INTEGER NOT NULL,
+        immunizations_expected INTEGER NOT NULL,
+        offtrack_flag BOOLEAN NOT NULL,
+        birth_dose_status BOOLEAN NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(delivery_id) REFERENCES delivery (id)
+    )""",
+]
+
+_GEO_IDS = [("state_id", "INTEGER"), ("district_id", "INTEGER"), ("block_id", "INTEGER")]
+
+GEOGRAPHY_TABLES = [
+    """CREATE TABLE IF NOT EXISTS geounit (
+        id INTEGER NOT NULL,
+        level VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        parent_id INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (level, parent_id, name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS riskrollup (
+        id INTEGER NOT NULL,
+        state_id INTEGER NOT NULL,
+        district_id INTEGER NOT NULL,
+        block_id INTEGER NOT NULL,
+        pregnancies INTEGER NOT NULL,
+        preg_high INTEGER NOT NULL,
+        preg_medium INTEGER NOT NULL,
+        preg_low INTEGER NOT NULL,
+        anc_compliance_sum FLOAT NOT NULL,
+        deliveries INTEGER NOT NULL,
+        del_high INTEGER NOT NULL,
+        del_medium INTEGER NOT NULL,
+        del_low INTEGER NOT NULL,
+        children INTEGER NOT NULL,
+        offtrack_children INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (state_id, district_id, block_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS monthlytrend (
+        id INTEGER NOT NULL,
+        state_id INTEGER NOT NULL,
+        month VARCHAR NOT NULL,
+        district_id INTEGER NOT NULL,
+        registrations INTEGER NOT NULL,
+        high_risk INTEGER NOT NULL,
+        anc_compliance_sum FLOAT NOT NULL,
+        deliveries INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (state_id, month, district_id)
+    )""",
+]
+
+INDEXES = [
+    # The baseline's RCH id index: nothing looks beneficiaries up by RCH id
+    "DROP INDEX IF EXISTS ix_beneficiary_rch_id",
+    # Foreign keys and hot filters
+    "CREATE INDEX IF NOT EXISTS ix_user_role ON user (role)",
+    "CREATE INDEX IF NOT EXISTS ix_beneficiary_linked_user_id ON beneficiary (linked_user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_pregnancy_beneficiary_id ON pregnancy (beneficiary_id)",
+    "CREATE INDEX IF NOT EXISTS ix_pregnancy_hospital_id ON pregnancy (hospital_id)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_pregnancy_id ON delivery (pregnancy_id)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_hospital_id ON delivery (hospital_id)",
+    "CREATE INDEX IF NOT EXISTS ix_child_delivery_id ON child (delivery_id)",
+    "CREATE INDEX IF NOT EXISTS ix_schemeapplication_beneficiary_id ON schemeapplication (beneficiary_id)",
+    "CREATE INDEX IF NOT EXISTS ix_schemeapplication_status ON schemeapplication (status)",
+    # Geography, keyed by GeoUnit ids
+    "CREATE INDEX IF NOT EXISTS ix_hospital_geo ON hospital (state_id, district_id, block_id)",
+    "CREATE INDEX IF NOT EXISTS ix_beneficiary_geo ON beneficiary (state_id, district_id, block_id)",
+    "CREATE INDEX IF NOT EXISTS ix_pregnancy_geo ON pregnancy (state_id, district_id, block_id)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_geo ON delivery (state_id, district_id, block_id)",
+    "CREATE INDEX IF NOT EXISTS ix_child_geo ON child (state_id, district_id, block_id)",
+    # Partial indexes for the HIGH-risk and off-track worklists
+    "CREATE INDEX IF NOT EXISTS ix_pregnancy_high ON pregnancy (state_id, risk_score_prebirth)"
+    " WHERE risk_level_prebirth = 'HIGH'",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_high ON delivery (state_id, risk_score_postbirth)"
+    " WHERE risk_level_postbirth = 'HIGH'",
+    "CREATE INDEX IF NOT EXISTS ix_child_offtrack ON child (state_id, district_id, block_id) WHERE offtrack_flag = 1",
+]
+
+DATA_VERSION = [
+    """CREATE TABLE IF NOT EXISTS dataversion (
+        id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "INSERT OR IGNORE INTO dataversion (id, version) VALUES (1, 0)",
+]
+
+PARTITION_CHANGE_LOG = [
+    """CREATE TABLE IF NOT EXISTS partitionchange (
+        id INTEGER NOT NULL,
+        state VARCHAR NOT NULL,
+        month VARCHAR NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+]
+
+PARTITION_CHANGE_KEY = [
+    # Keep the latest mark per partition, then one row per partition from now on
+    "DELETE FROM partitionchange WHERE id NOT IN (SELECT max(id) FROM partitionchange GROUP BY state, month)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_partitionchange_key ON partitionchange (state, month)",
+]
+
+SHARD_TABLES = [
+    """CREATE TABLE IF NOT EXISTS shardmap (
+        number INTEGER NOT NULL,
+        "key" VARCHAR NOT NULL,
+        PRIMARY KEY (number),
+        UNIQUE ("key")
+    )""",
+    """CREATE TABLE IF NOT EXISTS shardsequence (
+        name VARCHAR NOT NULL,
+        next_id INTEGER NOT NULL,
+        PRIMARY KEY (name)
+    )""",
+]
+
+
+def _existing_columns(conn, table_name):
+    return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table_name}")')}
+
+def _execute(*statements):
+    def step(conn):
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+    return step
+
+def _backfill_geography(conn):
+    # Imported here: geography imports database, which imports this module
+    from geography import backfill_geography
+    backfill_geography(conn)
+
+def _add_columns(columns_by_table):
+    """ALTER TABLE ADD COLUMN for each (name, type) the table lacks; new columns are nullable."""
+    def step(conn):
+        for table_name, columns in columns_by_table.items():
+            existing = _existing_columns(conn, table_name)
+            for column_name, column_type in columns:
+                if column_name not in existing:
+                    conn.exec_driver_sql(f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {column_type}')
+                    print(f"  added column {table_name}.{column_name}")
+    return step
+
+
+# (version, description, step)
+MIGRATIONS = [
+    (1, "baseline schema", _execute(*BASELINE_SCHEMA)),
+    (2, "registration_date on pregnancy, GeoUnit ids on hospital, beneficiary and the fact tables",
+        _add_columns({
+            "pregnancy": [("registration_date", "DATE")] + _GEO_IDS,
+            "hospital": _GEO_IDS,
+            "beneficiary": _GEO_IDS + [("village_id", "INTEGER")],
+            "delivery": _GEO_IDS,
+            "child": _GEO_IDS,
+        })),
+    (3, "geography dimension and rollup tables keyed by GeoUnit ids", _execute(*GEOGRAPHY_TABLES)),
+    (4, "indexes for foreign keys, geography filters and worklists", _execute(*INDEXES)),
+    (5, "data-version counter for response caching", _execute(*DATA_VERSION)),
+    (6, "change log for the incremental Parquet export", _execute(*PARTITION_CHANGE_LOG)),
+    (7, "shard map and per-shard id sequences", _execute(*SHARD_TABLES)),
+    (8, "GeoUnit ids for rows written before the geography dimension", _backfill_geography),
+    (9, "one Parquet change-log row per partition", _execute(*PARTITION_CHANGE_KEY)),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def migrate(engine, target=LATEST_VERSION):
+    """Apply pending migrations up to `target`. Returns the list of versions applied."""
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version > LATEST_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this code ({LATEST_VERSION})")
+
+    applied = []
+    for number, description, step in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        print(f"Migrating schema to v{number}: {description}")
+        with engine.begin() as conn:
+            # pysqlite only opens a transaction before DML; open it ourselves so DDL is covered too
+            conn.exec_driver_sql("BEGIN")
+            step(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+        applied.append(number)
+    if applied:
+        # Give the planner row counts for the new indexes
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+    return applied
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    if sys.argv[1:] == ["status"]:
+        with engine.connect() as conn:
+            print(f"Schema version {current_version(conn)} (latest {LATEST_VERSION})")
+    else:
+        applied = migrate(engine)
+        print(f"Applied {len(applied)} migration(s); schema is at v{LATEST_VERSION}")
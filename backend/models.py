@@ -1,12 +1,13 @@
 from datetime import date, datetime
 from typing import Optional, List
+from sqlalchemy import Index, UniqueConstraint, text
 from sqlmodel import SQLModel, Field, Relationship
 
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     phone_or_email: str = Field(unique=True, index=True)
-    role: str # AUTHORIZER, HOSPITAL, BENEFICIARY
+    role: str = Field(index=True) # AUTHORIZER, HOSPITAL, BENEFICIARY
     password_hash: str
     hospital_id: Optional[int] = Field(default=None, foreign_key="hospital.id")
     state: Optional[str] = Field(default=None)  # For state-scoped authorizers
@@ -14,24 +15,37 @@ class User(SQLModel, table=True):
     beneficiaries: List["Beneficiary"] = Relationship(back_populates="linked_user")
 
 class Hospital(SQLModel, table=True):
+    __table_args__ = (Index("ix_hospital_geo", "state_id", "district_id", "block_id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     state: Optional[str] = None # Added state field
     district: str
     block: str
+    # GeoUnit ids, resolved by geography.py
+    state_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
+    district_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
+    block_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
     type: str # Government, Private
     has_nicu: bool = Field(default=False)
 
 class Beneficiary(SQLModel, table=True):
+    __table_args__ = (Index("ix_beneficiary_geo", "state_id", "district_id", "block_id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
-    rch_id: Optional[str] = Field(index=True)
+    rch_id: Optional[str] = None
     age: int
     address: str
-    state: Optional[str] = None  # Indian state
+    state: Optional[str] = Field(default=None)  # Indian state
     district: str
     block: str
     village: Optional[str] = None
+    # GeoUnit ids, resolved by geography.py
+    state_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
+    district_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
+    block_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
+    village_id: Optional[int] = Field(default=None, foreign_key="geounit.id")
     phone: str
     education: Optional[str] = None # New
     occupation: Optional[str] = None # New
@@ -40,23 +54,35 @@ class Beneficiary(SQLModel, table=True):
     pmjay_id: Optional[str] = None # New (mapped from PMJAY_Enrolled logic)
     aadhaar_linked: bool = False # New
     
-    linked_user_id: Optional[int] = Field(default=None, foreign_key="user.id")
+    linked_user_id: Optional[int] = Field(default=None, foreign_key="user.id", index=True)
     
     linked_user: Optional[User] = Relationship(back_populates="beneficiaries")
     pregnancies: List["Pregnancy"] = Relationship(back_populates="beneficiary")
 
 class Pregnancy(SQLModel, table=True):
+    __table_args__ = (
+        # Partial index for the HIGH-risk worklist; only used when the query spells out the literal 'HIGH'
+        Index("ix_pregnancy_high", "state_id", "risk_score_prebirth", sqlite_where=text("risk_level_prebirth = 'HIGH'")),
+        # State/district slices of the analytics query API and the line lists
+        Index("ix_pregnancy_geo", "state_id", "district_id", "block_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    beneficiary_id: int = Field(foreign_key="beneficiary.id")
+    beneficiary_id: int = Field(foreign_key="beneficiary.id", index=True)
+    # GeoUnit ids copied from Beneficiary by geography.py for single-table state filters
+    state_id: Optional[int] = None
+    district_id: Optional[int] = None
+    block_id: Optional[int] = None
     lmp_date: Optional[date] = None
     edd_date: Optional[date] = None
+    registration_date: Optional[date] = Field(default_factory=date.today) # Buckets registrations in MonthlyTrend
     gravida: int = 1
     para: int = 0
     high_risk_conditions: Optional[str] = None 
     anc_visits_completed: int = 0
     anc_expected: int = 4
     institutional_delivery_planned: bool = True
-    hospital_id: Optional[int] = Field(default=None, foreign_key="hospital.id") # Registering Facility
+    hospital_id: Optional[int] = Field(default=None, foreign_key="hospital.id", index=True) # Registering Facility
     
     # New Vitals/Clinical Fields
     blood_group: Optional[str] = None
@@ -88,9 +114,18 @@ class Pregnancy(SQLModel, table=True):
     deliveries: List["Delivery"] = Relationship(back_populates="pregnancy")
 
 class Delivery(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_delivery_high", "state_id", "risk_score_postbirth", sqlite_where=text("risk_level_postbirth = 'HIGH'")),
+        Index("ix_delivery_geo", "state_id", "district_id", "block_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    pregnancy_id: int = Field(foreign_key="pregnancy.id")
-    hospital_id: int = Field(foreign_key="hospital.id")
+    pregnancy_id: int = Field(foreign_key="pregnancy.id", index=True)
+    # GeoUnit ids copied from Beneficiary by geography.py for single-table state filters
+    state_id: Optional[int] = None
+    district_id: Optional[int] = None
+    block_id: Optional[int] = None
+    hospital_id: int = Field(foreign_key="hospital.id", index=True)
     delivery_date: date
     delivery_type: str 
     gestational_age_weeks: int
@@ -110,8 +145,17 @@ class Delivery(SQLModel, table=True):
     children: List["Child"] = Relationship(back_populates="delivery")
 
 class Child(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_child_offtrack", "state_id", "district_id", "block_id", sqlite_where=text("offtrack_flag = 1")),
+        Index("ix_child_geo", "state_id", "district_id", "block_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    delivery_id: int = Field(foreign_key="delivery.id")
+    delivery_id: int = Field(foreign_key="delivery.id", index=True)
+    # GeoUnit ids copied from Beneficiary by geography.py for single-table state filters
+    state_id: Optional[int] = None
+    district_id: Optional[int] = None
+    block_id: Optional[int] = None
     name: Optional[str] = None
     sex: str = "Unknown" # Not in Excel explicitly? Or infer/random
     immunizations_completed: int = 0
@@ -123,11 +167,87 @@ class Child(SQLModel, table=True):
 
 class SchemeApplication(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    beneficiary_id: int = Field(foreign_key="beneficiary.id")
+    beneficiary_id: int = Field(foreign_key="beneficiary.id", index=True)
     pregnancy_id: Optional[int] = Field(default=None, foreign_key="pregnancy.id")
     hospital_id: Optional[int] = Field(default=None, foreign_key="hospital.id")
     scheme_type: str # JSY, PMJAY
-    status: str = "DRAFT" 
+    status: str = Field(default="DRAFT", index=True)
     amount_eligible: Optional[float] = None # New for JSY Cash
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class RiskRollup(SQLModel, table=True):
+    """Per (state, district, block) counters backing /api/authorizer/summary.
+
+    Keyed by GeoUnit ids (0 = unknown). Maintained incrementally by rollups.py on every flush.
+    """
+    __table_args__ = (UniqueConstraint("state_id", "district_id", "block_id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    state_id: int = 0 # Leading column of the unique index, so state filters are index seeks
+    district_id: int = 0
+    block_id: int = 0
+
+    pregnancies: int = 0
+    preg_high: int = 0
+    preg_medium: int = 0
+    preg_low: int = 0
+    anc_compliance_sum: float = 0.0 # Sum of anc_visits_completed / anc_expected
+
+    deliveries: int = 0
+    del_high: int = 0
+    del_medium: int = 0
+    del_low: int = 0
+
+    children: int = 0
+    offtrack_children: int = 0
+
+class MonthlyTrend(SQLModel, table=True):
+    """Per (state, month, district) time buckets backing the dashboard trend charts.
+
+    Pregnancies count in their registration month (falling back to LMP), deliveries in
+    their delivery month. Maintained incrementally by rollups.py alongside RiskRollup.
+    """
+    __table_args__ = (UniqueConstraint("state_id", "month", "district_id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    state_id: int = 0 # GeoUnit ids, 0 = unknown
+    month: str # YYYY-MM
+    district_id: int = 0
+
+    registrations: int = 0
+    high_risk: int = 0
+    anc_compliance_sum: float = 0.0
+    deliveries: int = 0
+
+class GeoUnit(SQLModel, table=True):
+    """Geography dimension: STATE -> DISTRICT -> BLOCK -> VILLAGE with small integer ids (see geography.py)."""
+    __table_args__ = (UniqueConstraint("level", "parent_id", "name"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    level: str # STATE, DISTRICT, BLOCK, VILLAGE
+    name: str
+    parent_id: int = 0 # 0 for states, and for units whose parent is unknown
+
+class DataVersion(SQLModel, table=True):
+    """Single-row counter bumped by every committed write (see data_version.py); cached responses are keyed on it."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = 0
+
+class PartitionChange(SQLModel, table=True):
+    """Parquet export partitions touched by writes since the last export; drained by parquet_export.py.
+    One row per partition: re-marking replaces the row, so its id is that of the latest write."""
+    __table_args__ = (Index("ix_partitionchange_key", "state", "month", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    state: str # the beneficiary's state, or "unknown"; "*" marks every partition
+    month: str # YYYY-MM of registration (falling back to LMP), or "unknown"
+
+class ShardMap(SQLModel, table=True):
+    """Primary database only: shard number of each state key (see sharding.py); numbers are never reused."""
+    number: Optional[int] = Field(default=None, primary_key=True)
+    key: str = Field(unique=True)
+
+class ShardSequence(SQLModel, table=True):
+    """Per shard: next id to hand out for a fact table, from the shard's own id range."""
+    name: str = Field(primary_key=True)
+    next_id: int
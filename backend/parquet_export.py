@@ -0,0 +1,332 @@
+"""
+Partitioned Parquet snapshot of the flattened Beneficiary -> Pregnancy -> Delivery -> Child
+dataset, for offline analytics that shouldn't scan the live database.
+
+Layout (Hive-style, readable by pandas / pyarrow / DuckDB / Spark as one dataset):
+
+    <PARQUET_EXPORT_DIR>/state=<state>/month=<YYYY-MM>/part-0.parquet
+    <PARQUET_EXPORT_DIR>/_manifest.json   (underscore: skipped by dataset readers)
+
+One row per child; pregnancies without a delivery, and deliveries without children,
+appear once with the missing levels null. A pregnancy's partition is its beneficiary's
+state and the month of its registration (falling back to LMP), "unknown" when missing.
+
+Exports are incremental: a before_flush hook marks the partitions touched by every
+write in the PartitionChange log (one row per partition; a re-mark replaces the row
+with a newer id), and each run rewrites only those partitions, then deletes the marks
+it consumed in the transaction that writes the new manifest. The first run (no
+manifest), `--full`, or a "*" mark (raw-SQL backfills) rewrites everything.
+
+With sharding (see sharding.py) the fact rows and their change logs are spread over
+the primary database and every shard; a run reads them all and merges the rows.
+
+Usage:  python parquet_export.py [--full] [--out DIR]
+pyarrow is only needed to run the export, not to import this module.
+"""
+import heapq
+import json
+import os
+import shutil
+import sys
+from contextlib import ExitStack
+from datetime import datetime
+from itertools import groupby, islice
+from urllib.parse import quote
+
+from sqlalchemy import event, func, inspect, select, tuple_
+from sqlmodel import Session
+
+from database import BASE_DIR, engine
+from data_version import current_version
+from models import Beneficiary, Pregnancy, Delivery, Child, PartitionChange
+from sharding import ShardRouter, router as shard_router
+
+EXPORT_DIR = os.environ.get("PARQUET_EXPORT_DIR") or os.path.join(BASE_DIR, "exports", "parquet")
+UNKNOWN = "unknown"
+ALL = ("*", "*")
+BATCH_ROWS = 50_000
+_ID_CHUNK = 500
+MANIFEST = "_manifest.json"
+
+# (model, column prefix) in join order; every column is exported as <prefix><column>
+_LEVELS = ((Beneficiary, "beneficiary_"), (Pregnancy, "pregnancy_"), (Delivery, "delivery_"), (Child, "child_"))
+
+
+# --- Change tracking ---
+def _partition(state, registration_date, lmp_date):
+    d = registration_date or lmp_date
+    return (state or UNKNOWN, d.strftime("%Y-%m") if d else UNKNOWN)
+
+def _committed_partitions(conn, cls, ids):
+    """Partitions the committed rows of `cls` currently sit in."""
+    month_src = (Beneficiary.state, Pregnancy.registration_date, Pregnancy.lmp_date)
+    query = select(*month_src).select_from(Pregnancy).join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+    if cls is Pregnancy:
+        query = query.where(Pregnancy.id.in_(ids))
+    elif cls is Delivery:
+        query = query.join(Delivery, Delivery.pregnancy_id == Pregnancy.id).where(Delivery.id.in_(ids))
+    else:
+        query = query.join(Delivery, Delivery.pregnancy_id == Pregnancy.id)\
+            .join(Child, Child.delivery_id == Delivery.id).where(Child.id.in_(ids))
+    return {_partition(*row) for row in conn.execute(query)}
+
+def _parent(session, obj, rel, cls, fk):
+    parent, parent_id = getattr(obj, rel), getattr(obj, fk)
+    if parent_id is not None and not inspect(obj).attrs[rel].history.has_changes() \
+            and (parent is None or parent.id != parent_id):
+        # Pending objects don't lazy-load relationships, and a changed FK leaves the old one loaded
+        parent = session.get(cls, parent_id)
+    return parent
+
+def _current_partition(session, obj):
+    """Partition a pending or persistent fact row will sit in after this flush (None if it has no owner yet)."""
+    if isinstance(obj, Child):
+        obj = _parent(session, obj, "delivery", Delivery, "delivery_id")
+    if isinstance(obj, Delivery):
+        obj = _parent(session, obj, "pregnancy", Pregnancy, "pregnancy_id")
+    if obj is None:
+        return None
+    ben = _parent(session, obj, "beneficiary", Beneficiary, "beneficiary_id")
+    return _partition(ben.state if ben is not None else None, obj.registration_date, obj.lmp_date)
+
+@event.listens_for(Session, "before_flush")
+def _log_partition_changes(session, flush_context, instances):
+    touched = [o for o in (*session.new, *session.dirty, *session.deleted)
+               if isinstance(o, (Beneficiary, Pregnancy, Delivery, Child))]
+    if not touched:
+        return
+    conn = session.connection()
+    keys = set()
+    committed_ids = {Pregnancy: [], Delivery: [], Child: []}
+    for obj in touched:
+        if isinstance(obj, Beneficiary):
+            if obj.id is None:
+                continue  # no pregnancies yet
+            # Her facts move from the old state's partitions to the new state's. The old state
+            # comes from the database: attribute history is empty if it expired at the last commit
+            old_state = conn.execute(select(Beneficiary.state).where(Beneficiary.id == obj.id)).scalar()
+            states = {old_state or UNKNOWN, obj.state or UNKNOWN}
+            dates = conn.execute(select(Pregnancy.registration_date, Pregnancy.lmp_date)
+                                 .where(Pregnancy.beneficiary_id == obj.id)).all()
+            keys |= {(s, _partition(None, *d)[1]) for s in states for d in dates}
+            continue
+        if obj.id is not None:
+            committed_ids[type(obj)].append(obj.id)
+        if obj not in session.deleted:
+            key = _current_partition(session, obj)
+            if key is not None:
+                keys.add(key)
+    for cls, ids in committed_ids.items():
+        for i in range(0, len(ids), _ID_CHUNK):
+            keys |= _committed_partitions(conn, cls, ids[i:i + _ID_CHUNK])
+    mark_partitions(conn, keys)
+
+def mark_partitions(conn, keys):
+    """Mark (state, month) partitions for the next export."""
+    if not keys:
+        return
+    # REPLACE, not IGNORE: the fresh id keeps a partition marked during an export out of
+    # the snapshot that export deletes
+    conn.execute(PartitionChange.__table__.insert().prefix_with("OR REPLACE"),
+                 [{"state": s, "month": m} for s, m in keys])
+
+def beneficiary_partitions(conn, ben_ids):
+    """Partitions holding the committed pregnancies of `ben_ids`."""
+    keys = set()
+    for i in range(0, len(ben_ids), _ID_CHUNK):
+        keys |= {_partition(*row) for row in conn.execute(
+            select(Beneficiary.state, Pregnancy.registration_date, Pregnancy.lmp_date)
+            .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+            .where(Beneficiary.id.in_(ben_ids[i:i + _ID_CHUNK])))}
+    return keys
+
+def mark_all_partitions(conn):
+    """For writes that bypass the ORM: the next export rewrites every partition."""
+    mark_partitions(conn, [ALL])
+
+
+# --- Export ---
+def _flat_columns():
+    cols = []
+    for model, prefix in _LEVELS:
+        for c in model.__table__.columns:
+            cols.append(c.label(prefix + c.name))
+    return cols
+
+def _flat_query(partitions=None):
+    """The flattened dataset ordered by partition; `partitions` limits it to those (state, month) keys."""
+    month = func.coalesce(func.strftime("%Y-%m", func.coalesce(Pregnancy.registration_date, Pregnancy.lmp_date)), UNKNOWN)
+    state = func.coalesce(Beneficiary.state, UNKNOWN)
+    query = (
+        select(state.label("part_state"), month.label("part_month"), *_flat_columns())
+        .select_from(Pregnancy)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .outerjoin(Delivery, Delivery.pregnancy_id == Pregnancy.id)
+        .outerjoin(Child, Child.delivery_id == Delivery.id)
+        .order_by(state, month, Pregnancy.id, Delivery.id, Child.id)
+    )
+    if partitions is not None:
+        query = query.where(tuple_(state, month).in_(sorted(partitions)))
+    return query
+
+def _row_partition(row):
+    return (row.part_state, row.part_month)
+
+def _arrow_schema():
+    import pyarrow as pa
+    from sqlalchemy import Boolean, Date, DateTime, Float, Integer
+
+    fields = []
+    for model, prefix in _LEVELS:
+        for c in model.__table__.columns:
+            t = c.type
+            arrow_type = (pa.bool_() if isinstance(t, Boolean) else pa.int64() if isinstance(t, Integer)
+                          else pa.float64() if isinstance(t, Float) else pa.timestamp("us") if isinstance(t, DateTime)
+                          else pa.date32() if isinstance(t, Date) else pa.string())
+            fields.append(pa.field(prefix + c.name, arrow_type))
+    return pa.schema(fields)
+
+def _partition_path(state, month):
+    return f"state={quote(state, safe='')}/month={quote(month, safe='')}"
+
+def _load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _write_json_atomic(path, data):
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class _PartitionWriter:
+    """Writes the sorted row stream one partition at a time, each file swapped in atomically."""
+
+    def __init__(self, out_dir, schema):
+        self.out_dir = out_dir
+        self.schema = schema
+        self.key = None
+        self.writer = None
+        self.rows = 0
+        self.written = {}  # relative path -> manifest entry
+
+    def _open(self, key):
+        import pyarrow.parquet as pq
+
+        self.key, self.rows = key, 0
+        self.rel = _partition_path(*key)
+        directory = os.path.join(self.out_dir, self.rel)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "part-0.parquet")
+        self.tmp = os.path.join(directory, ".part-0.parquet.tmp")  # dot: invisible to readers until swapped in
+        self.writer = pq.ParquetWriter(self.tmp, self.schema, compression="zstd")
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self.tmp, self.path)
+        self.written[self.rel] = {
+            "state": self.key[0], "month": self.key[1], "rows": self.rows,
+            "bytes": os.path.getsize(self.path), "written_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        self.writer = None
+
+    def write(self, key, rows):
+        import pyarrow as pa
+
+        if key != self.key:
+            self.close()
+            self._open(key)
+        columns = list(zip(*rows))
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=f.type) for col, f in zip(columns, self.schema)], schema=self.schema))
+        self.rows += len(rows)
+
+
+def _sources(router=None):
+    """Engines holding fact rows: the primary, then every shard registered in its shard map."""
+    # Not only with MAATRINET_SHARDS on: `sharding.py split` registers shards either way
+    router = router or shard_router or ShardRouter()
+    return [engine] + [shard.engine for shard in router.shards()]
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def export(out_dir=EXPORT_DIR, full=False, router=None):
+    """Rewrite changed partitions (all of them if `full`). Returns the number of partitions written."""
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = _load_manifest(out_dir)
+    sources = _sources(router)
+    last_change, changed, data_versions = [], set(), []
+    for source in sources:
+        with source.connect() as conn:
+            # Snapshot the log first: changes logged while exporting stay for the next run
+            last_change.append(conn.execute(select(func.max(PartitionChange.id))).scalar() or 0)
+            changed |= {(r.state, r.month) for r in conn.execute(
+                select(PartitionChange.state, PartitionChange.month).where(PartitionChange.id <= last_change[-1]))}
+            data_versions.append(current_version(conn))
+    full = full or manifest is None or ALL in changed
+    if not full and not changed:
+        print("No partitions changed since the last export.")
+        return 0
+
+    if full:
+        previous = set(manifest["partitions"]) if manifest else set()
+        partitions = {}
+    else:
+        previous = {_partition_path(*k) for k in changed}
+        partitions = dict(manifest["partitions"])
+    writer = _PartitionWriter(out_dir, _arrow_schema())
+    query = _flat_query(None if full else changed)
+    with ExitStack() as stack:
+        # Each source streams its rows sorted by partition; a beneficiary not yet rehomed after
+        # a move can put rows of one partition in two databases
+        results = [stack.enter_context(source.connect()).execution_options(yield_per=BATCH_ROWS).execute(query)
+                   for source in sources]
+        for key, rows in groupby(heapq.merge(*results, key=_row_partition), key=_row_partition):
+            for batch in _batches(rows, BATCH_ROWS):
+                writer.write(key, [row[2:] for row in batch])
+        writer.close()
+
+    # Partitions that were due for rewriting but have no rows any more
+    for rel in previous - set(writer.written):
+        shutil.rmtree(os.path.join(out_dir, rel), ignore_errors=True)
+        state_dir = os.path.dirname(os.path.join(out_dir, rel))
+        if os.path.isdir(state_dir) and not os.listdir(state_dir):
+            os.rmdir(state_dir)
+        partitions.pop(rel, None)
+    partitions.update(writer.written)
+
+    with ExitStack() as stack:
+        # The marks go only if the manifest is written, and the manifest only if they can go
+        for source, last in zip(sources, last_change):
+            conn = stack.enter_context(source.begin())
+            conn.execute(PartitionChange.__table__.delete().where(PartitionChange.id <= last))
+        _write_json_atomic(os.path.join(out_dir, MANIFEST), {
+            "format": 1,
+            "data_version": data_versions[0],
+            "shard_data_versions": data_versions[1:],
+            "exported_at": datetime.now().isoformat(timespec="seconds"),
+            "partitioning": ["state", "month"],
+            "rows": sum(p["rows"] for p in partitions.values()),
+            "partitions": dict(sorted(partitions.items())),
+        })
+    return len(writer.written)
+
+
+if __name__ == "__main__":
+    from database import create_db_and_tables
+
+    args = sys.argv[1:]
+    out = args[args.index("--out") + 1] if "--out" in args else EXPORT_DIR
+    create_db_and_tables()
+    written = export(out, full="--full" in args)
+    print(f"Wrote {written} partition(s) to {out}")
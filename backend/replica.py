@@ -0,0 +1,156 @@
+"""
+Optional read replica for the analytic reads (summary, analytics, line lists, exports,
+the assistant's full-table load), so heavy aggregates run against a snapshot instead
+of the database registrations write to.
+
+A background thread copies maatrinet.db with SQLite's online backup API into one of
+two replica files, alternating between them: readers of the current snapshot are
+never blocked by the next copy, and each snapshot is transactionally consistent
+(the copy reads one WAL snapshot of the primary, so it never blocks writers either).
+A refresh is skipped while the data version hasn't changed.
+
+Routing is by staleness: `replica.async_engine()` / the session dependencies below
+return the replica only while its snapshot is younger than MAATRINET_REPLICA_MAX_LAG
+seconds, and fall back to the primary otherwise (replica disabled, first copy not
+done yet, or refreshes failing).
+
+Settings: MAATRINET_REPLICA (1 to enable; default off), MAATRINET_REPLICA_INTERVAL
+(seconds between refresh checks, default 15), MAATRINET_REPLICA_MAX_LAG (seconds,
+default 60), MAATRINET_REPLICA_PATH (default <db>.replica; each process appends its pid).
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import database
+from db_profile import connect_args, pool_args, apply_pragmas, install_tracing
+from data_version import current_version
+
+ENABLED = os.environ.get("MAATRINET_REPLICA", "0").lower() in ("1", "true", "yes")
+INTERVAL = float(os.environ.get("MAATRINET_REPLICA_INTERVAL", "15"))
+MAX_LAG = float(os.environ.get("MAATRINET_REPLICA_MAX_LAG", "60"))
+PATH = os.environ.get("MAATRINET_REPLICA_PATH") or database.sqlite_file_name + ".replica"
+
+
+class _Snapshot:
+    """One replica file with its engines and the primary data version it was copied at."""
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = create_engine(f"sqlite:///{path}", connect_args=connect_args(database.profile),
+                                    **pool_args(database.profile))
+        self.async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}",
+                                                connect_args=connect_args(database.profile),
+                                                **pool_args(database.profile))
+        for label, sync_engine in (("replica:sync", self.engine), ("replica:async", self.async_engine.sync_engine)):
+            apply_pragmas(sync_engine, database.profile)
+            install_tracing(sync_engine, label, database.profile)
+        self.data_version = None
+        self.taken_at = None  # time.monotonic() the snapshot was last known to match the primary
+
+
+class ReadReplica:
+    def __init__(self, path=PATH, interval=INTERVAL, max_lag=MAX_LAG):
+        self.path = path
+        self.interval = interval
+        self.max_lag = max_lag
+        self._snapshots = None  # created by start(), in the process that serves from them
+        self._current = None  # the snapshot readers use, None until the first copy
+        self._lock = threading.Lock()  # one refresh at a time
+        self._thread = None
+
+    def refresh(self, force=False):
+        """Copy the primary into the idle snapshot file and switch readers to it. Returns True if copied."""
+        with self._lock:
+            current = self._current
+            with database.engine.connect() as conn:
+                version = current_version(conn)
+            if current is not None and not force and current.data_version == version:
+                current.taken_at = time.monotonic()  # still identical to the primary
+                return False
+            target = self._snapshots[1] if current is self._snapshots[0] else self._snapshots[0]
+            source = sqlite3.connect(database.sqlite_file_name)
+            dest = sqlite3.connect(target.path, timeout=database.profile["busy_timeout_ms"] / 1000)
+            try:
+                # pages=-1: copy everything in one step, i.e. from a single read snapshot of the primary
+                source.backup(dest, pages=-1)
+                # The copy may have raced a write after the version read; tag it with what it contains
+                target.data_version = dest.execute("SELECT version FROM dataversion WHERE id = 1").fetchone()[0]
+            finally:
+                dest.close()
+                source.close()
+            target.taken_at = time.monotonic()
+            self._current = target
+            return True
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last snapshot; routing falls back to the primary once it is too old
+                print(f"Read replica refresh failed: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        """Take the first snapshot and keep refreshing it in a daemon thread."""
+        if self._thread is None:
+            # Per process: pre-forked workers (serve.py) each refresh their own pair of files
+            suffix = os.getpid()
+            self._snapshots = [_Snapshot(f"{self.path}.{suffix}.a"), _Snapshot(f"{self.path}.{suffix}.b")]
+            atexit.register(self._remove_files)
+            self._thread = threading.Thread(target=self._run, name="read-replica", daemon=True)
+            self._thread.start()
+
+    def _remove_files(self):
+        for snapshot in self._snapshots:
+            for path in (snapshot.path, snapshot.path + "-wal", snapshot.path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def fresh_snapshot(self):
+        """The current snapshot if it is within the staleness bound, else None."""
+        current = self._current
+        if current is None or time.monotonic() - current.taken_at > self.max_lag:
+            return None
+        return current
+
+    def version_tag(self):
+        """Data version of the snapshot served right now (None: reads go to the primary)."""
+        current = self.fresh_snapshot()
+        return current.data_version if current else None
+
+    def engine(self):
+        current = self.fresh_snapshot()
+        return current.engine if current else database.engine
+
+    def async_engine(self):
+        current = self.fresh_snapshot()
+        return current.async_engine if current else database.async_engine
+
+
+replica = ReadReplica() if ENABLED else None
+
+
+def analytics_engine():
+    return replica.engine() if replica else database.engine
+
+def analytics_async_engine():
+    return replica.async_engine() if replica else database.async_engine
+
+def replica_version_tag():
+    return replica.version_tag() if replica else None
+
+def get_analytics_session():
+    with Session(analytics_engine()) as session:
+        yield session
+
+async def get_analytics_async_session():
+    async with AsyncSession(analytics_async_engine()) as session:
+        yield session
@@ -0,0 +1,161 @@
+"""
+Response cache for the polled dashboard endpoints.
+
+Responses are cached per (path, query parameters) together with the data version
+(see data_version.py) they were computed at. A request is served from the cache while
+the stored version still matches the database and the entry is younger than the TTL;
+the TTL only bounds staleness for writes made outside the app (maintenance scripts).
+The cache is an LRU bounded by entry count. Streamed responses (the line lists) are
+forwarded chunk by chunk on a miss while a copy is collected, and cached at the end
+unless they outgrew the per-entry byte cap, so the first byte is never held back.
+
+Responses served from the cache get a strong ETag over the body and `Cache-Control:
+no-cache`, so browsers revalidate with If-None-Match and unchanged dashboards get an
+empty 304.
+
+Settings: RESPONSE_CACHE_SIZE (entries, default 256), RESPONSE_CACHE_TTL (seconds, default 300),
+RESPONSE_CACHE_MAX_BYTES (per entry, default 2 MB).
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response, StreamingResponse
+
+from database import async_engine
+from data_version import current_version
+from replica import replica_version_tag
+from sharding import router as shard_router
+
+CACHED_PATHS = {
+    "/api/authorizer/summary",
+    "/api/admin/analytics",
+    "/api/admin/overview",
+    "/api/authorizer/offtrack",
+}
+
+
+@dataclass
+class CachedResponse:
+    version: tuple  # (primary data version, replica snapshot version, shard versions; see _read_version)
+    expires: float
+    body: bytes
+    media_type: str
+    etag: str
+
+
+class ResponseCache:
+    def __init__(self, maxsize=256, ttl=300.0, max_body=2_000_000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_body = max_body
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version or entry.expires < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, body, media_type):
+        entry = CachedResponse(
+            version=version,
+            expires=time.monotonic() + self.ttl,
+            body=body,
+            media_type=media_type,
+            etag='"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest(),
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache(
+    maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+    max_body=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", "2000000")),
+)
+
+
+async def _read_version():
+    async with async_engine.connect() as conn:
+        version = await conn.run_sync(current_version)
+    # Responses served from the read replica reflect its snapshot, not the primary;
+    # when sharded, the fact data versions live in the shards
+    return (version, replica_version_tag(), await shard_router.versions() if shard_router else None)
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+class ResponseCacheMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, cache=response_cache, paths=CACHED_PATHS):
+        super().__init__(app)
+        self.cache = cache
+        self.paths = paths
+
+    async def dispatch(self, request, call_next):
+        if request.method != "GET" or request.url.path not in self.paths:
+            return await call_next(request)
+
+        # Read before computing: a write racing the computation leaves the entry under
+        # the older version, so it is simply recomputed on the next request
+        version = await _read_version()
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+        entry = self.cache.get(key, version)
+        status = "HIT"
+        if entry is None:
+            response = await call_next(request)
+            if response.status_code != 200:
+                return response
+            length = response.headers.get("content-length")
+            if length is None or int(length) > self.cache.max_body:
+                return self._tee(response, key, version)
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            entry = self.cache.put(key, version, body, response.headers.get("content-type"))
+            status = "MISS"
+
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache", "X-Cache": status}
+        if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+    def _tee(self, response, key, version):
+        """Stream `response` to the client as it is produced, caching the body once complete if it fits."""
+        async def body():
+            chunks, size = [], 0
+            async for chunk in response.body_iterator:
+                yield chunk
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > self.cache.max_body:
+                        chunks = None  # too big to cache; keep streaming
+                    else:
+                        chunks.append(chunk)
+            # Not reached if the client disconnects mid-stream: a partial body is never cached
+            if chunks is not None:
+                self.cache.put(key, version, b"".join(chunks), response.headers.get("content-type"))
+        headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+        headers.update({"Cache-Control": "no-cache", "X-Cache": "MISS"})
+        return StreamingResponse(body(), status_code=response.status_code, headers=headers)
@@ -0,0 +1,345 @@
+"""
+Materialized rollups for the authorizer and admin dashboards.
+
+RiskRollup keeps risk-level counts, ANC compliance sums and off-track counts per
+(state, district, block) GeoUnit id, so /api/authorizer/summary reads a few hundred small rows
+instead of re-running aggregate joins over every pregnancy, delivery and child.
+MonthlyTrend keeps registrations, high-risk counts, ANC compliance and deliveries per
+(state, month, district), so trend charts can cover multi-year ranges without scans.
+
+Both are updated incrementally from a before_flush hook: every Pregnancy, Delivery or
+Child that is inserted, rescored, re-linked or deleted (and every Beneficiary whose
+address moves) contributes a +/- delta in the same transaction as the write itself; rows
+below a re-linked pregnancy or delivery move with it.
+
+Run `python rollups.py` to rebuild (or backfill) everything from the base tables.
+"""
+from collections import defaultdict
+
+from sqlalchemy import event, func, case, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select, delete
+
+from models import Beneficiary, Pregnancy, Delivery, Child, RiskRollup, MonthlyTrend
+
+_LEVELS = ("HIGH", "MEDIUM", "LOW")
+
+# Unique key columns of each rollup table, in index order
+_KEYS = {
+    RiskRollup: ("state_id", "district_id", "block_id"),
+    MonthlyTrend: ("state_id", "month", "district_id"),
+}
+_FLOAT_COLUMNS = {"anc_compliance_sum"}
+
+# Attributes whose change alters a row's contribution to the rollups; a re-link shows up on the
+# foreign key or, until the flush syncs it, only on the relationship
+_TRACKED = {
+    Pregnancy: ("risk_level_prebirth", "anc_visits_completed", "anc_expected", "registration_date", "lmp_date",
+                "beneficiary_id", "beneficiary"),
+    Delivery: ("risk_level_postbirth", "delivery_date", "pregnancy_id", "pregnancy"),
+    Child: ("offtrack_flag", "delivery_id", "delivery"),
+}
+# Assigned by the geography hook, which runs before this one
+_GEO_ATTRS = ("state_id", "district_id", "block_id")
+
+
+def _month(d):
+    return d.strftime("%Y-%m") if d else None
+
+
+# --- Per-row contributions ---
+def _contributions(cls, src, state_id, district_id, block_id):
+    """Yield (table, key, counters) for one fact row.
+
+    `src` is either a model instance or a committed row selected with the same
+    attribute names, so pre- and post-flush values go through the same code.
+    """
+    state_id, district_id, block_id = state_id or 0, district_id or 0, block_id or 0
+    risk_key = (state_id, district_id, block_id)
+
+    if cls is Pregnancy:
+        level = src.risk_level_prebirth
+        anc = (src.anc_visits_completed or 0) / src.anc_expected if src.anc_expected else 0.0
+        counters = {"pregnancies": 1, "anc_compliance_sum": anc}
+        if level in _LEVELS:
+            counters[f"preg_{level.lower()}"] = 1
+        yield RiskRollup, risk_key, counters
+
+        month = _month(src.registration_date or src.lmp_date)
+        if month:
+            yield MonthlyTrend, (state_id, month, district_id), {
+                "registrations": 1,
+                "high_risk": 1 if level == "HIGH" else 0,
+                "anc_compliance_sum": anc,
+            }
+
+    elif cls is Delivery:
+        level = src.risk_level_postbirth
+        counters = {"deliveries": 1}
+        if level in _LEVELS:
+            counters[f"del_{level.lower()}"] = 1
+        yield RiskRollup, risk_key, counters
+
+        month = _month(src.delivery_date)
+        if month:
+            yield MonthlyTrend, (state_id, month, district_id), {"deliveries": 1}
+
+    else:
+        yield RiskRollup, risk_key, {"children": 1, "offtrack_children": 1 if src.offtrack_flag else 0}
+
+
+# --- Committed (pre-flush) state, read straight from the database ---
+def _committed_rows(cls):
+    """Select of committed rows of `cls` with the owning beneficiary's geography."""
+    geo = (Beneficiary.id.label("ben_id"), Beneficiary.state_id, Beneficiary.district_id, Beneficiary.block_id)
+    if cls is Pregnancy:
+        return select(
+            Pregnancy.id, Pregnancy.risk_level_prebirth, Pregnancy.anc_visits_completed, Pregnancy.anc_expected,
+            Pregnancy.registration_date, Pregnancy.lmp_date, *geo
+        ).join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+    if cls is Delivery:
+        return select(Delivery.id, Delivery.risk_level_postbirth, Delivery.delivery_date,
+                      Pregnancy.id.label("preg_id"), *geo)\
+            .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)\
+            .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+    return select(Child.id, Child.offtrack_flag, Delivery.id.label("del_id"), Pregnancy.id.label("preg_id"), *geo)\
+        .join(Delivery, Delivery.id == Child.delivery_id)\
+        .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)\
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class _FlushResolver:
+    """Resolves the (post-flush) owning beneficiary of pending and persistent objects."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def _parent(self, obj, rel, cls, fk):
+        parent, parent_id = getattr(obj, rel), getattr(obj, fk)
+        if parent_id is not None and not _changed(obj, (rel,)) and (parent is None or parent.id != parent_id):
+            # Pending objects don't lazy-load relationships, and a changed FK leaves the old one loaded
+            parent = self.session.get(cls, parent_id)
+        return parent
+
+    def beneficiary(self, obj):
+        if isinstance(obj, Child):
+            obj = self._parent(obj, "delivery", Delivery, "delivery_id")
+        if isinstance(obj, Delivery):
+            obj = self._parent(obj, "pregnancy", Pregnancy, "pregnancy_id")
+        if isinstance(obj, Pregnancy):
+            return self._parent(obj, "beneficiary", Beneficiary, "beneficiary_id")
+        return None
+
+
+def _changed(obj, attrs):
+    state = inspect(obj)
+    return any(state.attrs[a].history.has_changes() for a in attrs)
+
+
+def _collect_deltas(session):
+    deltas = defaultdict(lambda: defaultdict(float))
+    resolver = _FlushResolver(session)
+
+    def add(cls, src, ben, sign):
+        for table, key, counters in _contributions(cls, src, ben.state_id, ben.district_id, ben.block_id):
+            for col, value in counters.items():
+                deltas[(table, key)][col] += sign * value
+
+    # Owners whose rows below them change beneficiary: a beneficiary whose address moves, and
+    # pregnancies or deliveries re-linked to another parent; each maps to the new beneficiary
+    moved = {
+        "ben_id": {
+            b.id: b for b in session.dirty
+            if isinstance(b, Beneficiary) and b.id is not None and _changed(b, _GEO_ATTRS)
+        },
+        "preg_id": {
+            p.id: resolver.beneficiary(p) for p in session.dirty
+            if isinstance(p, Pregnancy) and p.id is not None and _changed(p, ("beneficiary_id", "beneficiary"))
+        },
+        "del_id": {
+            d.id: resolver.beneficiary(d) for d in session.dirty
+            if isinstance(d, Delivery) and d.id is not None and _changed(d, ("pregnancy_id", "pregnancy"))
+        },
+    }
+    owner_columns = {"ben_id": Beneficiary.id, "preg_id": Pregnancy.id, "del_id": Delivery.id}
+    # Owners above each fact class that can move it, nearest first
+    owner_levels = {Pregnancy: ("ben_id",), Delivery: ("preg_id", "ben_id"), Child: ("del_id", "preg_id", "ben_id")}
+
+    for cls, tracked in _TRACKED.items():
+        new = [o for o in session.new if isinstance(o, cls)]
+        dirty = [o for o in session.dirty if isinstance(o, cls) and _changed(o, tracked)]
+        deleted = [o for o in session.deleted if isinstance(o, cls)]
+
+        # 1. Retract the committed contribution of everything this flush touches
+        touched_ids = {o.id for o in dirty + deleted if o.id is not None}
+        retracted = {}
+        for ids in _chunks(touched_ids):
+            retracted.update((r.id, r) for r in session.execute(_committed_rows(cls).where(cls.id.in_(ids))))
+        for level in owner_levels[cls]:
+            for owner_ids in _chunks(moved[level]):
+                retracted.update((r.id, r) for r in session.execute(
+                    _committed_rows(cls).where(owner_columns[level].in_(owner_ids))))
+
+        for row in retracted.values():
+            add(cls, row, row, -1)
+
+        # 2. Re-add the post-flush contribution of new and modified rows
+        for obj in new + dirty:
+            ben = resolver.beneficiary(obj)
+            if ben is not None:
+                add(cls, obj, ben, +1)
+
+        # 3. Rows that only moved with an owner keep their counts under the owner's new key
+        for row in retracted.values():
+            if row.id in touched_ids:
+                continue
+            level = next(lvl for lvl in owner_levels[cls] if getattr(row, lvl) in moved[lvl])
+            ben = moved[level][getattr(row, level)]
+            if ben is not None:
+                add(cls, row, ben, +1)
+
+    return deltas
+
+
+def beneficiary_deltas(connection, ben_ids):
+    """Contribution of the committed facts of `ben_ids`, for moving them with plain SQL (see sharding.py)."""
+    deltas = defaultdict(lambda: defaultdict(float))
+    for cls in _TRACKED:
+        for ids in _chunks(ben_ids):
+            for row in connection.execute(_committed_rows(cls).where(Beneficiary.id.in_(ids))):
+                for table, key, counters in _contributions(cls, row, row.state_id, row.district_id, row.block_id):
+                    for col, value in counters.items():
+                        deltas[(table, key)][col] += value
+    return deltas
+
+
+def apply_deltas(connection, deltas, sign=1):
+    """Add `deltas` (subtract them if `sign` is -1) to the rollup rows of `connection`'s database."""
+    for (model, key), counters in deltas.items():
+        values = {c: sign * (v if c in _FLOAT_COLUMNS else int(v)) for c, v in counters.items() if v}
+        if not values:
+            continue
+        table = model.__table__
+        key_columns = _KEYS[model]
+        stmt = sqlite_insert(table).values(**dict(zip(key_columns, key)), **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={c: table.c[c] + stmt.excluded[c] for c in values},
+        )
+        connection.execute(stmt)
+
+
+@event.listens_for(Session, "before_flush")
+def _maintain_rollups(session, flush_context, instances):
+    deltas = _collect_deltas(session)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+# --- Full rebuild / backfill ---
+def _rebuild_risk_rollups(session: Session):
+    geo = (Beneficiary.state_id, Beneficiary.district_id, Beneficiary.block_id)
+    level_sum = lambda col, level: func.sum(case((col == level, 1), else_=0))
+
+    preg_rows = session.execute(
+        select(
+            *geo,
+            func.count(Pregnancy.id).label("pregnancies"),
+            *(level_sum(Pregnancy.risk_level_prebirth, lvl).label(f"preg_{lvl.lower()}") for lvl in _LEVELS),
+            func.sum(func.coalesce(Pregnancy.anc_visits_completed * 1.0 / Pregnancy.anc_expected, 0.0)).label("anc_compliance_sum"),
+        ).join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id).group_by(*geo)
+    ).all()
+
+    del_rows = session.execute(
+        select(
+            *geo,
+            func.count(Delivery.id).label("deliveries"),
+            *(level_sum(Delivery.risk_level_postbirth, lvl).label(f"del_{lvl.lower()}") for lvl in _LEVELS),
+        ).join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id).group_by(*geo)
+    ).all()
+
+    child_rows = session.execute(
+        select(
+            *geo,
+            func.count(Child.id).label("children"),
+            func.sum(case((Child.offtrack_flag == True, 1), else_=0)).label("offtrack_children"),
+        ).join(Delivery, Delivery.id == Child.delivery_id)
+        .join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id).group_by(*geo)
+    ).all()
+
+    return _merge_rows(RiskRollup, (preg_rows, del_rows, child_rows))
+
+
+def _rebuild_monthly_trend(session: Session):
+    preg_month = func.strftime("%Y-%m", func.coalesce(Pregnancy.registration_date, Pregnancy.lmp_date))
+    preg_rows = session.execute(
+        select(
+            Beneficiary.state_id, preg_month.label("month"), Beneficiary.district_id,
+            func.count(Pregnancy.id).label("registrations"),
+            func.sum(case((Pregnancy.risk_level_prebirth == "HIGH", 1), else_=0)).label("high_risk"),
+            func.sum(func.coalesce(Pregnancy.anc_visits_completed * 1.0 / Pregnancy.anc_expected, 0.0)).label("anc_compliance_sum"),
+        ).join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .where(preg_month.is_not(None))
+        .group_by(Beneficiary.state_id, preg_month, Beneficiary.district_id)
+    ).all()
+
+    del_month = func.strftime("%Y-%m", Delivery.delivery_date)
+    del_rows = session.execute(
+        select(
+            Beneficiary.state_id, del_month.label("month"), Beneficiary.district_id,
+            func.count(Delivery.id).label("deliveries"),
+        ).join(Pregnancy, Pregnancy.id == Delivery.pregnancy_id)
+        .join(Beneficiary, Beneficiary.id == Pregnancy.beneficiary_id)
+        .where(del_month.is_not(None))
+        .group_by(Beneficiary.state_id, del_month, Beneficiary.district_id)
+    ).all()
+
+    return _merge_rows(MonthlyTrend, (preg_rows, del_rows))
+
+
+def _merge_rows(model, row_sets):
+    merged = defaultdict(dict)
+    for rows in row_sets:
+        for row in rows:
+            values = row._asdict()
+            key = tuple(values.pop(k) or 0 for k in _KEYS[model])
+            for col, value in values.items():
+                merged[key][col] = (merged[key].get(col) or 0) + (value or 0)
+    return [model(**dict(zip(_KEYS[model], key)), **counters) for key, counters in merged.items()]
+
+
+def rebuild_rollups(session: Session):
+    """Recompute every RiskRollup and MonthlyTrend row from the base tables."""
+    risk_rows = _rebuild_risk_rollups(session)
+    trend_rows = _rebuild_monthly_trend(session)
+    session.execute(delete(RiskRollup))
+    session.execute(delete(MonthlyTrend))
+    session.add_all(risk_rows + trend_rows)
+    session.commit()
+    return len(risk_rows), len(trend_rows)
+
+
+def ensure_rollups(session: Session):
+    """Build the rollups once for databases that predate them."""
+    if session.exec(select(Pregnancy.id)).first() is None:
+        return
+    if session.exec(select(RiskRollup.id)).first() is None or session.exec(select(MonthlyTrend.id)).first() is None:
+        print("Rollup tables empty. Rebuilding from base tables...")
+        rebuild_rollups(session)
+
+
+if __name__ == "__main__":
+    from database import engine, create_db_and_tables
+
+    create_db_and_tables()
+    with Session(engine) as session:
+        risk_count, trend_count = rebuild_rollups(session)
+    print(f"Rebuilt {risk_count} risk rollup rows and {trend_count} monthly trend rows.")
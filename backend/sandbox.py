@@ -0,0 +1,358 @@
+"""
+Isolated execution of the assistant's generated `analyze(df)` code.
+
+The code runs in a small pool of worker processes. The API process is multi-threaded
+and must not fork, so the workers are forked by a single-threaded helper process
+(started through multiprocessing's forkserver, at boot): the API sends the helper each
+new analysis frame once, and every worker forked from it shares the frame's pages
+copy-on-write instead of loading or copying it. The helper hands each worker's socket
+back over a Unix socket and reaps the workers. A new frame (after a write) retires the
+idle workers; busy ones finish their job first. Workers take one job at a time; each
+job is limited to
+
+    ASSISTANT_SANDBOX_CPU_SECONDS   CPU time (default 10), enforced with RLIMIT_CPU
+    ASSISTANT_SANDBOX_TIMEOUT       wall-clock seconds (default 20), then the worker is killed
+    ASSISTANT_SANDBOX_MEMORY_MB     memory on top of the inherited frame (default 1024), RLIMIT_AS
+    ASSISTANT_SANDBOX_MAX_RESULT_KB result size as JSON (default 256)
+
+A job that breaks a limit fails with SandboxError and its worker is replaced, so a
+runaway cross join or row-by-row loop costs one sandbox process, never an API thread.
+Results come back as JSON (numpy scalars as numbers; Series, frames and other objects
+as their text), never as pickles: nothing the generated code builds is unpickled in
+the API process.
+At most ASSISTANT_SANDBOX_WORKERS jobs (default 2) run at once; further requests wait
+up to the timeout for a free worker. Where fork is unavailable the code runs inline,
+without limits, as it did before.
+"""
+import gc
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+WORKERS = int(os.environ.get("ASSISTANT_SANDBOX_WORKERS", "2"))
+CPU_SECONDS = int(os.environ.get("ASSISTANT_SANDBOX_CPU_SECONDS", "10"))
+TIMEOUT = float(os.environ.get("ASSISTANT_SANDBOX_TIMEOUT", "20"))
+MEMORY_MB = int(os.environ.get("ASSISTANT_SANDBOX_MEMORY_MB", "1024"))
+MAX_RESULT_KB = int(os.environ.get("ASSISTANT_SANDBOX_MAX_RESULT_KB", "256"))
+
+FORK = hasattr(os, "fork") and hasattr(socket, "send_fds") and resource is not None
+
+
+class SandboxError(Exception):
+    """The generated code could not be run to completion; the message is shown to the user."""
+
+
+class SandboxBusy(SandboxError):
+    """No worker became free within the timeout (the code itself may be fine)."""
+
+
+def execute(code, frame):
+    """Run `code` and return analyze(df) on a copy-on-write copy of `frame` (in the current process)."""
+    execution_globals = {"df": frame.copy(deep=False), "pd": pd, "np": np}
+    exec(code, execution_globals)
+    if "analyze" not in execution_globals:
+        raise Exception("Function 'analyze(df)' was not defined in generated code.")
+    return execution_globals["analyze"](execution_globals["df"])
+
+
+class RenderedValue:
+    """A result that was not plain data (a Series, a DataFrame, ...), as its text."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+    __repr__ = __str__
+
+
+def _plain(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_plain(v) for v in value]
+    return str(value)
+
+
+def _to_json(result):
+    if result is not None and not isinstance(result, (bool, int, float, str, dict, list, tuple, set, np.generic)):
+        result = {"__rendered__": str(result)}
+    return json.dumps(["ok", _plain(result)], default=str)
+
+
+def _from_json(payload):
+    status, value = json.loads(payload)
+    if isinstance(value, dict) and set(value) == {"__rendered__"}:
+        value = RenderedValue(value["__rendered__"])
+    return status, value
+
+
+# --- Worker process ---
+def _address_space():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _serve(conn, frame, cpu_seconds, memory_bytes, max_result_bytes):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is the server's; the pool stops its workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    gc.freeze()  # keep the collector from writing to (and un-sharing) the inherited pages
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = _address_space() + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    except (OSError, ValueError):
+        pass  # no /proc (macOS), where RLIMIT_AS is not enforced anyway
+    cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    while True:
+        try:
+            code = conn.recv()
+        except (EOFError, OSError):
+            return
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # SIGXCPU (which terminates the worker) once this job has used cpu_seconds
+        resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + cpu_seconds, cpu_hard))
+        fatal = False
+        try:
+            payload = _to_json(execute(code, frame))
+            if len(payload) > max_result_bytes:
+                payload = json.dumps(["error", f"The analysis result is too large ({len(payload) // 1024} KB; "
+                                               f"the limit is {max_result_bytes // 1024} KB). Ask for a summary instead."])
+        except MemoryError:
+            # The heap may be left fragmented or half-built: answer, then let the pool replace this worker
+            fatal = True
+            payload = json.dumps(["fatal", "The analysis needed more memory than allowed and was stopped."])
+        except Exception as e:
+            payload = json.dumps(["error", str(e)])
+        conn.send_bytes(payload.encode())
+        if fatal:
+            return
+
+
+def _host(control, fds, cpu_seconds, memory_bytes, max_result_bytes):
+    """
+    The helper process: single-threaded, so it can fork safely. Holds the current frame
+    (sent once per frame by the API process), forks workers that share it copy-on-write,
+    hands each worker's socket to the API process and reaps the workers.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    frame = None
+    while True:
+        try:
+            request = control.recv()
+        except (EOFError, OSError):
+            return  # the API process is gone; its workers see EOF on their sockets and exit too
+        if request[0] == "frame":
+            frame = None
+            gc.collect()  # drop the old frame before the next workers fork
+            frame = request[1]
+            control.send(None)
+        elif request[0] == "spawn":
+            ours, theirs = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                ours.close()
+                control.close()
+                fds.close()
+                try:
+                    _serve(Connection(theirs.detach()), frame, cpu_seconds, memory_bytes, max_result_bytes)
+                finally:
+                    os._exit(0)
+            theirs.close()
+            socket.send_fds(fds, [b"w"], [ours.fileno()])
+            ours.close()
+            control.send(pid)
+        elif request[0] == "reap":
+            try:
+                control.send(os.waitstatus_to_exitcode(os.waitpid(request[1], 0)[1]))
+            except ChildProcessError:
+                control.send(None)  # forked by an earlier helper
+
+
+@dataclass
+class _Worker:
+    pid: int
+    conn: Connection
+    entry: object  # the AnalysisFrame the worker was forked with
+    exitcode: Optional[int] = None  # once reaped
+
+
+class _Host:
+    """API-side handle on the helper process; one request at a time."""
+
+    def __init__(self, *limits):
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._process = None
+        self._entry = None  # frame the helper holds
+
+    def _start(self):
+        # forkserver: the helper is forked from a fresh single-threaded server, never from this process
+        context = multiprocessing.get_context("forkserver")
+        self._control, control = context.Pipe()
+        self._fds, fds = socket.socketpair()
+        self._process = context.Process(target=_host, name="assistant-sandbox-host", daemon=True,
+                                        args=(control, fds, *self._limits))
+        self._process.start()
+        control.close()
+        fds.close()
+        self._entry = None
+
+    def _call(self, *request):
+        self._control.send(request)
+        return self._control.recv()
+
+    def start(self):
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+
+    def spawn(self, entry):
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+            if entry is not self._entry:
+                self._call("frame", entry.frame)
+                self._entry = entry
+            pid = self._call("spawn")
+            _, (fd,), _, _ = socket.recv_fds(self._fds, 1, 1)
+        return _Worker(pid, Connection(fd), entry)
+
+    def reap(self, worker):
+        """Exit code of a worker that has exited or been killed."""
+        if worker.exitcode is None:
+            with self._lock:
+                worker.exitcode = self._call("reap", worker.pid)
+        return worker.exitcode
+
+
+class SandboxPool:
+    def __init__(self, size=WORKERS, cpu_seconds=CPU_SECONDS, timeout=TIMEOUT, memory_mb=MEMORY_MB,
+                 max_result_kb=MAX_RESULT_KB):
+        self.size = size
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self.memory_bytes = memory_mb * 1024 * 1024
+        self.max_result_bytes = max_result_kb * 1024
+        self._host = _Host(cpu_seconds, self.memory_bytes, self.max_result_bytes) if FORK else None
+        self._cond = threading.Condition()
+        self._entry = None  # frame the current workers hold
+        self._idle = []
+        self._live = 0  # workers of the current frame, idle or busy
+        self.runs = 0
+        self.killed = 0
+
+    def start(self):
+        """Start the helper process now rather than on the first run (call at boot)."""
+        if self._host is not None:
+            self._host.start()
+
+    def _stop(self, worker):
+        worker.conn.close()
+        if worker.exitcode is None:
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self._host.reap(worker)
+
+    def _acquire(self, entry):
+        deadline = time.monotonic() + self.timeout
+        stale = []
+        try:
+            with self._cond:
+                if entry is not self._entry:
+                    # New frame: idle workers of the old one stop now, busy ones when they finish
+                    stale, self._idle = self._idle, []
+                    self._entry, self._live = entry, 0
+                while True:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._live < self.size:
+                        self._live += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SandboxBusy("All analysis workers are busy. Please try again in a moment.")
+                    self._cond.wait(remaining)
+        finally:
+            # Outside the lock: killing and reaping waits on other processes
+            for worker in stale:
+                self._stop(worker)
+        try:
+            return self._host.spawn(entry)
+        except Exception:
+            with self._cond:
+                if entry is self._entry:
+                    self._live -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, worker, healthy):
+        with self._cond:
+            keep = worker.entry is self._entry and healthy
+            if keep:
+                self._idle.append(worker)
+            elif worker.entry is self._entry:
+                self._live -= 1
+            self._cond.notify()
+        if not keep:
+            self._stop(worker)
+
+    def _failure(self, exitcode):
+        if exitcode == -signal.SIGXCPU:
+            return f"The analysis used more than {self.cpu_seconds} seconds of CPU time and was stopped."
+        if exitcode == -signal.SIGKILL:
+            return "The analysis used too much memory and was stopped."
+        return f"The analysis worker stopped unexpectedly (exit code {exitcode})."
+
+    def run(self, code, entry):
+        """analyze(df) of `code` over `entry.frame` (an AnalysisFrame) in a sandbox worker. Raises SandboxError."""
+        if not FORK:
+            return execute(code, entry.frame)
+        worker = self._acquire(entry)
+        healthy = False
+        self.runs += 1
+        try:
+            worker.conn.send(code)
+            if not worker.conn.poll(self.timeout):
+                self.killed += 1
+                raise SandboxError(f"The analysis took longer than {self.timeout:g} seconds and was stopped.")
+            try:
+                status, value = _from_json(worker.conn.recv_bytes())
+            except (EOFError, OSError):
+                self.killed += 1
+                raise SandboxError(self._failure(self._host.reap(worker)))
+            healthy = status != "fatal"
+            if status != "ok":
+                raise SandboxError(value)
+            return value
+        finally:
+            self._release(worker, healthy)
+
+    def stats(self):
+        return {"workers": self.size, "live": self._live, "idle": len(self._idle), "runs": self.runs,
+                "killed": self.killed, "isolated": FORK}
+
+
+sandbox = SandboxPool()
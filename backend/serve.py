@@ -0,0 +1,123 @@
+"""
+Multi-process server entry point.
+
+    python serve.py [--workers N] [--host 0.0.0.0] [--port 8000]
+
+The parent process imports the app once (pandas, scikit-learn, the three risk-model
+pickles, the Gemini client), runs the migrations once, freezes the heap and then
+forks N uvicorn workers that share one listening socket. Workers inherit the loaded
+models copy-on-write instead of each unpickling their own. The first worker to start
+runs the seed import in the background (see warmup.py) while the others wait for it;
+each worker answers /health/live and /health/ready for itself (`worker` in the body
+is its index).
+
+The parent restarts workers that die and forwards SIGINT/SIGTERM to them on shutdown.
+Where fork is unavailable (Windows) or N is 1, this runs a single uvicorn process.
+N defaults to WEB_CONCURRENCY, else the CPU count.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import uvicorn
+
+RESTART_BACKOFF = 1.0  # seconds between restarts of a crashing worker
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the MaatriNet API with pre-forked workers.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    return parser.parse_args(argv)
+
+
+def _listen(host, port):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _spawn(index, app, sock):
+    pid = os.fork()
+    if pid:
+        return pid
+    # Child: default signal handling (uvicorn installs its own), then serve until told to stop
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.environ["MAATRINET_WORKER"] = str(index)
+    import main
+    main.worker_state["worker"] = str(index)
+    try:
+        uvicorn.Server(uvicorn.Config(app, lifespan="on")).run(sockets=[sock])
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+def run(workers, host, port):
+    if workers <= 1 or not hasattr(os, "fork"):
+        import main
+        uvicorn.run(main.app, host=host, port=port)
+        return
+
+    # Preload in the parent: every worker shares these pages
+    import main
+    from database import engine, create_db_and_tables, startup_lock
+
+    # Seeding is left to the workers' background warm-up so they start answering probes at once
+    with startup_lock():
+        create_db_and_tables()
+    # No pooled SQLite connection may be shared across fork
+    engine.dispose()
+    # Keep the preloaded objects out of the collector so its writes don't un-share their pages
+    gc.freeze()
+
+    sock = _listen(host, port)
+    children = {}  # pid -> worker index
+    for index in range(workers):
+        children[_spawn(index, main.app, sock)] = index
+    print(f"Serving on {host}:{port} with {workers} workers: {sorted(children)}")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"Worker {index} (pid {pid}) exited with status {status}; restarting")
+        time.sleep(RESTART_BACKOFF)
+        children[_spawn(index, main.app, sock)] = index
+    sock.close()
+
+
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+    run(args.workers, args.host, args.port)
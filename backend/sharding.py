@@ -0,0 +1,377 @@
+"""
+Optional per-state sharding: one SQLite file per state for the fact tables, so each
+state has its own writer lock and state-scoped queries read a small file.
+
+Layout (MAATRINET_SHARDS=1 enables it):
+
+    maatrinet.db                   users, hospitals, GeoUnit, the shard map
+    <MAATRINET_SHARD_DIR>/<key>.db  beneficiaries of one state with their pregnancies,
+                                    deliveries, children, scheme applications and rollups
+
+The shard key is the beneficiary's state (slugged); beneficiaries without a state
+live in the "_unassigned" shard. A state authorizer's scope resolves to one shard,
+global admin views fan out to every shard and combine the results.
+
+Ids stay globally unique: rows that came from the unsharded database keep their ids,
+and every new fact row gets an id from its shard's own range (shard number *
+ID_STRIDE upwards, handed out by the ShardSequence table), so the shard of any new
+id is known without a lookup. GeoUnit stays in the primary database; shards only
+carry the ids.
+
+A beneficiary whose state changes stays in her old shard until `rehome` moves her
+with all her facts (done inline by the profile update, or `python sharding.py rebalance`).
+Facts written to maatrinet.db while sharded (the seed import) are moved into their
+shards by the warm-up before the server reports ready (main.prepare_database).
+
+Usage:  python sharding.py split       # move every beneficiary out of maatrinet.db into its shard
+        python sharding.py rebalance   # move beneficiaries whose state no longer matches their shard
+        python sharding.py status
+"""
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import database
+from db_profile import connect_args, pool_args, apply_pragmas, install_tracing
+from data_version import bump_data_version, current_version
+from migrations import migrate
+from models import ShardMap, ShardSequence
+from rollups import beneficiary_deltas, apply_deltas
+
+ENABLED = os.environ.get("MAATRINET_SHARDS", "0").lower() in ("1", "true", "yes")
+SHARD_DIR = os.environ.get("MAATRINET_SHARD_DIR") or os.path.join(database.BASE_DIR, "shards")
+UNASSIGNED = "_unassigned"
+ID_STRIDE = 10 ** 12
+RELOAD_SECONDS = 5  # how often to look for shards other workers created
+
+# Fact tables in parent -> child order, with the column linking each to the level above
+FACT_TABLES = (
+    ("beneficiary", None),
+    ("pregnancy", "beneficiary_id"),
+    ("delivery", "pregnancy_id"),
+    ("child", "delivery_id"),
+    ("schemeapplication", "beneficiary_id"),
+)
+_PARENT_TABLE = {"pregnancy": "beneficiary", "delivery": "pregnancy", "child": "delivery",
+                 "schemeapplication": "beneficiary"}
+
+
+def shard_key(state):
+    """File-safe key of a state name ("Tamil Nadu" -> "tamil_nadu"); no state -> UNASSIGNED."""
+    slug = re.sub(r"[^a-z0-9]+", "_", (state or "").strip().lower()).strip("_")
+    return slug or UNASSIGNED
+
+
+class Shard:
+    def __init__(self, key, number, path):
+        self.key = key
+        self.number = number
+        self.path = path
+        self.engine = create_engine(f"sqlite:///{path}", connect_args=connect_args(database.profile),
+                                    **pool_args(database.profile))
+        self.async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}",
+                                                connect_args=connect_args(database.profile),
+                                                **pool_args(database.profile))
+        for label, sync_engine in ((f"shard:{key}", self.engine), (f"shard:{key}:async", self.async_engine.sync_engine)):
+            apply_pragmas(sync_engine, database.profile)
+            install_tracing(sync_engine, label, database.profile)
+
+    def session(self):
+        """Write session on this shard: new fact rows get ids from the shard's range."""
+        return Session(self.engine, info={"shard": self.key, "shard_number": self.number})
+
+    def async_session(self):
+        return AsyncSession(self.async_engine, info={"shard": self.key, "shard_number": self.number})
+
+    def __repr__(self):
+        return f"Shard({self.key!r}, {self.number})"
+
+
+class ShardRouter:
+    def __init__(self, shard_dir=SHARD_DIR):
+        self.shard_dir = shard_dir
+        self._shards = {}   # key -> Shard
+        self._by_number = {}
+        self._lock = threading.Lock()
+        self._loaded_at = 0.0
+
+    def _open(self, key, number):
+        shard = Shard(key, number, os.path.join(self.shard_dir, f"{key}.db"))
+        migrate(shard.engine)
+        with shard.engine.begin() as conn:
+            base = number * ID_STRIDE + 1
+            for table, _ in FACT_TABLES:
+                conn.execute(sqlite_insert(ShardSequence.__table__).values(name=table, next_id=base)
+                             .on_conflict_do_nothing())
+        self._shards[key] = shard
+        self._by_number[number] = shard
+        return shard
+
+    def _load(self, force=False):
+        """Open every shard registered in the primary's shard map (another worker may have added some)."""
+        if not force and time.monotonic() - self._loaded_at < RELOAD_SECONDS:
+            return
+        self._loaded_at = time.monotonic()
+        with database.engine.connect() as conn:
+            registered = conn.execute(select(ShardMap.key, ShardMap.number)).all()
+        with self._lock:
+            for key, number in registered:
+                if key not in self._shards:
+                    self._open(key, number)
+
+    def shard(self, state):
+        """The shard holding `state`'s beneficiaries, created on first use."""
+        return self.shard_by_key(shard_key(state))
+
+    def shard_by_key(self, key):
+        shard = self._shards.get(key)
+        if shard is not None:
+            return shard
+        with self._lock:
+            if key in self._shards:
+                return self._shards[key]
+            os.makedirs(self.shard_dir, exist_ok=True)
+            with database.engine.begin() as conn:
+                conn.execute(sqlite_insert(ShardMap.__table__).values(key=key).on_conflict_do_nothing())
+                number = conn.execute(select(ShardMap.number).where(ShardMap.key == key)).scalar_one()
+            return self._open(key, number)
+
+    def shards(self):
+        self._load()
+        return sorted(self._shards.values(), key=lambda s: s.number)
+
+    def for_scope(self, state=None):
+        """Shards a caller scoped to `state` reads (None: global scope, every shard)."""
+        if state:
+            key = shard_key(state)
+            if key not in self._shards:
+                self._load(force=True)
+            # A state nobody has registered in yet has no shard, and no rows
+            return [self._shards[key]] if key in self._shards else []
+        return self.shards()
+
+    def shard_for_id(self, row_id):
+        """Shard of an id allocated after sharding; None for ids carried over from the unsharded database."""
+        if row_id is None or row_id < ID_STRIDE:
+            return None
+        number = row_id // ID_STRIDE
+        if number not in self._by_number:
+            self._load(force=True)
+        return self._by_number.get(number)
+
+    # --- Fan-out ---
+    async def gather(self, query, state=None):
+        """Rows of `query` from the shards in `state`'s scope, concatenated in shard order."""
+        async def run(shard):
+            async with AsyncSession(shard.async_engine) as session:
+                return (await session.exec(query)).all()
+        results = await asyncio.gather(*(run(s) for s in self.for_scope(state)))
+        return [row for rows in results for row in rows]
+
+    def locate(self, model, **filters):
+        """(shard, first `model` row matching `filters`), looking in the id's own shard first; (None, None) if absent."""
+        row_id = filters.get("id")
+        owner = self.shard_for_id(row_id)
+        candidates = [owner] if owner else self.shards()
+        query = select(model).filter_by(**filters)
+        for shard in candidates:
+            with Session(shard.engine) as session:
+                obj = session.exec(query).first()
+                if obj is not None:
+                    session.expunge(obj)
+                    return shard, obj
+        return None, None
+
+    async def alocate(self, model, options=(), **filters):
+        """Async `locate`; `options` (e.g. selectinload) are loaded before the session closes."""
+        row_id = filters.get("id")
+        owner = self.shard_for_id(row_id)
+        candidates = [owner] if owner else self.shards()
+        query = select(model).filter_by(**filters).options(*options)
+        for shard in candidates:
+            async with AsyncSession(shard.async_engine) as session:
+                obj = (await session.exec(query)).first()
+                if obj is not None:
+                    return shard, obj
+        return None, None
+
+    async def versions(self):
+        """Data version of every shard, for cache keys."""
+        async def version(shard):
+            async with shard.async_engine.connect() as conn:
+                return shard.key, await conn.run_sync(current_version)
+        return tuple(await asyncio.gather(*(version(s) for s in self.shards())))
+
+    # --- Moving beneficiaries between databases ---
+    def rehome(self, source_engine, source_path, ben_ids=None):
+        """
+        Move beneficiaries (all of them if `ben_ids` is None) from the database at
+        `source_path` into the shard of their current state, with all their facts.
+        Rows that are already in the right shard stay. Returns {shard key: beneficiaries moved}.
+        """
+        with source_engine.connect() as conn:
+            rows = conn.execute(text("SELECT id, state FROM beneficiary")).all()
+        by_key = {}
+        for ben_id, state in rows:
+            if ben_ids is not None and ben_id not in ben_ids:
+                continue
+            key = shard_key(state)
+            if source_path != os.path.join(self.shard_dir, f"{key}.db"):
+                by_key.setdefault(key, []).append(ben_id)
+        for key, ids in by_key.items():
+            _move_beneficiaries(source_engine, self.shard_by_key(key).path, ids)
+        return {key: len(ids) for key, ids in by_key.items()}
+
+
+class FactSessions:
+    """
+    Per-request access to the databases holding fact rows. Unsharded, every method
+    returns the request's own session; sharded, shard sessions are opened on demand
+    and closed with the request (see get_fact_sessions in main.py).
+    """
+
+    def __init__(self, session, router):
+        self.session = session
+        self.router = router
+        self._open = {}  # shard key -> Session
+
+    def _for_shard(self, shard):
+        if shard.key not in self._open:
+            self._open[shard.key] = shard.session()
+        return self._open[shard.key]
+
+    def for_state(self, state):
+        """Session for writing facts of a beneficiary in `state`."""
+        if self.router is None:
+            return self.session
+        return self._for_shard(self.router.shard(state))
+
+    def owner(self, model, default_state=None, **filters):
+        """Session on the database holding the `model` row matching `filters` (`default_state`'s if there is none)."""
+        if self.router is None:
+            return self.session
+        shard, _ = self.router.locate(model, **filters)
+        return self._for_shard(shard or self.router.shard(default_state))
+
+    def all(self):
+        """One session per fact database, for whole-dataset jobs."""
+        if self.router is None:
+            return [self.session]
+        return [self._for_shard(shard) for shard in self.router.shards()]
+
+    def rehome(self, session, beneficiary):
+        """After a state change: move the beneficiary into her new state's shard (committed `session` only)."""
+        if self.router is None or shard_key(beneficiary.state) == session.info["shard"]:
+            return
+        shard = self.router.shard_by_key(session.info["shard"])
+        self.router.rehome(shard.engine, shard.path, {beneficiary.id})
+
+    def close(self):
+        for session in self._open.values():
+            session.close()
+        self._open.clear()
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.exec_driver_sql(f'PRAGMA {schema}.table_info("{table}")')]
+
+def _move_beneficiaries(source_engine, dest_path, ben_ids):
+    """
+    Move beneficiaries and their facts from `source_engine`'s database into `dest_path`, in
+    one transaction over both files. Their rollup contributions move with them, and only
+    the export partitions of their pregnancies are marked, in both databases.
+    """
+    # Imported here: parquet_export reads every shard, so it imports this module
+    from parquet_export import beneficiary_partitions, mark_partitions
+
+    with source_engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS dst", (dest_path,))
+        try:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            deltas = beneficiary_deltas(conn, ben_ids)
+            partitions = beneficiary_partitions(conn, ben_ids)
+            conn.exec_driver_sql("CREATE TEMP TABLE move_ids (tbl TEXT, id INTEGER, PRIMARY KEY (tbl, id))")
+            conn.exec_driver_sql("INSERT INTO move_ids VALUES ('beneficiary', ?)", [(i,) for i in ben_ids])
+            for table, parent_col in FACT_TABLES[1:]:
+                conn.exec_driver_sql(f"INSERT INTO move_ids SELECT ?, id FROM main.{table} WHERE {parent_col} IN "
+                                     f"(SELECT id FROM move_ids WHERE tbl = ?)", (table, _PARENT_TABLE[table]))
+            for table, _ in FACT_TABLES:
+                # Explicit column lists: ALTER-added columns may sit in a different order in each file
+                dest_cols = _columns(conn, "dst", table)
+                cols = ", ".join(f'"{c}"' for c in _columns(conn, "main", table) if c in dest_cols)
+                conn.exec_driver_sql(f"INSERT INTO dst.{table} ({cols}) SELECT {cols} FROM main.{table} "
+                                     f"WHERE id IN (SELECT id FROM move_ids WHERE tbl = ?)", (table,))
+            for table, _ in reversed(FACT_TABLES):
+                conn.exec_driver_sql(f"DELETE FROM main.{table} WHERE id IN (SELECT id FROM move_ids WHERE tbl = ?)",
+                                     (table,))
+            # Rows moved with plain SQL: carry the derived data over by hand
+            apply_deltas(conn, deltas, sign=-1)
+            bump_data_version(conn)
+            mark_partitions(conn, partitions)
+            # The same statements against the attached file (execution_options apply in place)
+            conn.execution_options(schema_translate_map={None: "dst"})
+            apply_deltas(conn, deltas)
+            bump_data_version(conn)
+            mark_partitions(conn, partitions)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS temp.move_ids")
+            conn.exec_driver_sql("DETACH DATABASE dst")
+
+
+@event.listens_for(Session, "before_flush")
+def _allocate_shard_ids(session, flush_context, instances):
+    """Give new fact rows in a shard session ids from the shard's range."""
+    if session.info.get("shard_number") is None:
+        return
+    fact_tables = {table for table, _ in FACT_TABLES}
+    pending = {}
+    for obj in session.new:
+        table = getattr(obj, "__tablename__", None)
+        if table in fact_tables and obj.id is None:
+            pending.setdefault(table, []).append(obj)
+    conn = session.connection()
+    for table, objs in pending.items():
+        # The UPDATE takes the shard's write lock, so concurrent writers get disjoint blocks
+        start = conn.execute(
+            text("UPDATE shardsequence SET next_id = next_id + :n WHERE name = :t RETURNING next_id - :n"),
+            {"n": len(objs), "t": table},
+        ).scalar_one()
+        for i, obj in enumerate(objs):
+            obj.id = start + i
+
+
+router = ShardRouter() if ENABLED else None
+
+
+if __name__ == "__main__":
+    from database import create_db_and_tables
+
+    create_db_and_tables()
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    r = router or ShardRouter()
+    if command == "split":
+        moved = r.rehome(database.engine, database.sqlite_file_name)
+        print(f"Moved {sum(moved.values())} beneficiaries into {len(moved)} shard(s)")
+    elif command == "rebalance":
+        total = 0
+        for shard in r.shards():
+            total += sum(r.rehome(shard.engine, shard.path).values())
+        print(f"Moved {total} beneficiaries to their state's shard")
+    else:
+        for shard in r.shards():
+            with shard.engine.connect() as conn:
+                count = conn.execute(text("SELECT count(*) FROM beneficiary")).scalar()
+            print(f"{shard.number:>4}  {shard.key:<24} {count:>8} beneficiaries  {shard.path}")
@@ -0,0 +1,97 @@
+"""
+Streaming responses for the large list endpoints, line-list exports and assistant
+progress events.
+
+Rows are serialized with orjson as they come off the cursor and sent in small
+batches, so neither the full result list nor the full JSON document is ever held in
+memory, and the first bytes go out as soon as the first rows are read. The rows are
+plain dicts built by the endpoint, so there is no response_model validation pass.
+
+`rows` is an async iterable, normally an async generator reading an aiosqlite cursor
+(database.async_engine), so a slow client never holds a threadpool thread. Row
+generators should open their own connection inside the generator: the request's
+session dependency may already be closed by the time the body is sent.
+"""
+import csv
+import io
+
+import orjson
+from starlette.responses import StreamingResponse
+
+BATCH_ROWS = 200
+
+
+async def _json_array(rows, batch_rows):
+    yield b"["
+    sep = b""
+    batch = []
+    async for row in rows:
+        batch.append(orjson.dumps(row))
+        if len(batch) >= batch_rows:
+            yield sep + b",".join(batch)
+            sep, batch = b",", []
+    if batch:
+        yield sep + b",".join(batch)
+    yield b"]"
+
+
+def stream_json_array(rows, batch_rows=BATCH_ROWS):
+    """StreamingResponse sending the dicts from the async iterable `rows` as one JSON array."""
+    return StreamingResponse(_json_array(rows, batch_rows), media_type="application/json")
+
+
+def _attachment(filename):
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+
+async def _ndjson(rows, batch_rows):
+    batch = []
+    async for row in rows:
+        batch.append(orjson.dumps(row))
+        if len(batch) >= batch_rows:
+            yield b"\n".join(batch) + b"\n"
+            batch = []
+    if batch:
+        yield b"\n".join(batch) + b"\n"
+
+
+def stream_ndjson(rows, filename, batch_rows=BATCH_ROWS):
+    """Download of the dicts from `rows`, one JSON object per line."""
+    return StreamingResponse(_ndjson(rows, batch_rows), media_type="application/x-ndjson",
+                             headers=_attachment(filename))
+
+
+async def _csv(rows, columns, batch_rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    i = 0
+    async for row in rows:
+        writer.writerow(row)
+        i += 1
+        if i % batch_rows == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_csv(rows, columns, filename, batch_rows=BATCH_ROWS):
+    """Download of the dicts from `rows` as CSV with the given column order (extra keys are dropped)."""
+    return StreamingResponse(_csv(rows, columns, batch_rows), media_type="text/csv; charset=utf-8",
+                             headers=_attachment(filename))
+
+
+def _sse(events):
+    for event, data in events:
+        yield b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS) + b"\n\n"
+
+
+def stream_events(events):
+    """
+    Server-Sent Events from the (event, data) pairs of `events`, sent as each is produced.
+
+    `events` is a plain (blocking) iterable; Starlette runs it in the threadpool.
+    """
+    return StreamingResponse(_sse(events), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
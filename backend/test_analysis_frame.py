@@ -0,0 +1,38 @@
+"""compact_frame dtypes and schema_hash: integer columns never narrower than int32, and a
+hash that does not move when only the value range or cardinality changes.
+
+Pure pandas, no database.
+"""
+import pandas as pd
+
+from analysis_frame import compact_frame, schema_hash
+
+
+def _frame(n, first_id=1, states=("Bihar", "Kerala")):
+    return pd.DataFrame({
+        "beneficiary_id": range(first_id, first_id + n),
+        "age": [20 + i % 15 for i in range(n)],
+        "anc_visits_completed": [None if i % 3 == 0 else i % 5 for i in range(n)],
+        "state": [states[i % len(states)] for i in range(n)],
+    })
+
+
+def test_integer_columns_do_not_wrap():
+    df = compact_frame(_frame(30))
+    assert str(df["age"].dtype) == "int32"
+    assert str(df["anc_visits_completed"].dtype) == "Int32"  # NULLs from the outer joins
+    assert (df["age"] * 1000).max() == 34_000
+    assert df["anc_visits_completed"].sum() * 100 == 100 * sum(i % 5 for i in range(30) if i % 3)
+
+    # Ids from a shard's range need 64 bits
+    assert str(compact_frame(_frame(3, first_id=3 * 10 ** 12))["beneficiary_id"].dtype) == "int64"
+
+
+def test_schema_hash_ignores_value_range_and_cardinality():
+    small = compact_frame(_frame(30))
+    wide = compact_frame(_frame(30, first_id=3 * 10 ** 12, states=[f"State {i}" for i in range(30)]))
+    assert str(small["state"].dtype) == "category" and str(wide["state"].dtype) != "category"
+    assert schema_hash(small) == schema_hash(wide)
+
+    renamed = small.rename(columns={"age": "age_years"})
+    assert schema_hash(renamed) != schema_hash(small)
@@ -0,0 +1,155 @@
+"""Declarative analytics queries: joins, geography pinning, cross-shard merging, limits and
+the 400s for malformed specs. Rows are seeded in a state of their own.
+
+Run with pytest (see conftest.py for the scratch database).
+"""
+import os
+import tempfile
+from datetime import date
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "analytics_query.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session, select
+
+import main
+from analytics_query import compile_query, run_query, _merge
+from database import engine, create_db_and_tables
+from geography import filter_ids
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child
+
+STATE = "Nagaland"
+PINNED = {"field": "state", "value": STATE}
+
+
+def _seed():
+    create_db_and_tables()
+    with Session(engine) as session:
+        if session.exec(select(Beneficiary).where(Beneficiary.state == STATE)).first():
+            return
+        hospital = Hospital(name="Kohima DH", state=STATE, district="Kohima", block="Kohima Sadar", type="Government")
+        session.add(hospital)
+        pregnancies = []
+        for age, district, block, hb, level in ((20, "Kohima", "Kohima Sadar", 9.0, "HIGH"),
+                                                 (30, "Kohima", "Kohima Sadar", 11.0, "HIGH"),
+                                                 (40, "Dimapur", "Chumukedima", 7.0, "MEDIUM")):
+            mother = Beneficiary(name="Query Mother", age=age, address=block, state=STATE, district=district,
+                                 block=block, phone="9400000000")
+            session.add(mother)
+            session.flush()
+            preg = Pregnancy(beneficiary_id=mother.id, hospital_id=hospital.id, lmp_date=date(2024, 4, 1),
+                             hb_level=hb, anemia=hb < 10, risk_level_prebirth=level)
+            session.add(preg)
+            pregnancies.append(preg)
+        session.flush()
+        delivery = Delivery(pregnancy_id=pregnancies[0].id, hospital_id=hospital.id, delivery_date=date(2025, 1, 2),
+                            delivery_type="Normal", gestational_age_weeks=37, birthweight_grams=2400)
+        session.add(delivery)
+        session.flush()
+        session.add(Child(delivery_id=delivery.id, name="Query Baby", offtrack_flag=True))
+        session.commit()
+
+
+def _sql(spec):
+    return str(compile_query(spec).statement)
+
+
+def test_joins_only_what_the_fields_need():
+    _seed()
+    assert "JOIN" not in _sql({"entity": "child", "filters": [PINNED, {"field": "offtrack_flag", "value": True}]})
+    partial = _sql({"entity": "child", "group_by": ["delivery_type"]})
+    assert "JOIN delivery" in partial and "JOIN pregnancy" not in partial
+    full = _sql({"entity": "child", "filters": [{"field": "age", "op": "lt", "value": 25}]})
+    assert all(f"JOIN {table} " in full for table in ("delivery", "pregnancy", "beneficiary"))
+
+    # The mother's age, through every join
+    result = run_query({"entity": "child", "filters": [PINNED, {"field": "beneficiary.age", "op": "lt", "value": 25}]})
+    assert result["rows"] == [{"count": 1}]
+
+
+def test_geography_filters_pin_the_levels_above():
+    _seed()
+    query = compile_query({"filters": [{"field": "district", "value": "Kohima"}]})
+    params = query.statement.compile().params
+    ids = filter_ids(state=STATE, district="Kohima")
+    assert ids["district_id"] in params.values() and ids["state_id"] in params.values()
+    assert "pregnancy.state_id IN" in str(query.statement) and query.state is None
+
+    assert compile_query({"filters": [{"field": "state", "op": "in", "value": [STATE]}]}).state == STATE
+    assert compile_query({"filters": [{"field": "state", "op": "in", "value": [STATE, "Assam"]}]}).state is None
+
+
+def test_top_n_and_truncation():
+    _seed()
+    spec = {"filters": [PINNED], "group_by": ["district"],
+            "aggregates": [{"fn": "count"}, {"fn": "avg", "field": "hb_level", "as": "mean_hb"}]}
+    result = run_query({**spec, "limit": 1})
+    assert result["columns"] == ["district", "count", "mean_hb"]
+    assert result["rows"] == [{"district": "Kohima", "count": 2, "mean_hb": 10.0}] and result["truncated"]
+
+    result = run_query({**spec, "order_by": "district"})  # by name, not GeoUnit id
+    assert [r["district"] for r in result["rows"]] == ["Dimapur", "Kohima"] and not result["truncated"]
+
+
+def test_same_named_blocks_stay_apart():
+    create_db_and_tables()
+    with Session(engine) as session:
+        if not session.exec(select(Beneficiary).where(Beneficiary.state == "Mizoram")).first():
+            for age, district in ((22, "Aizawl"), (26, "Aizawl"), (35, "Lunglei")):
+                mother = Beneficiary(name="Query Mother", age=age, address="Central", state="Mizoram",
+                                     district=district, block="Central", phone="9400000001")
+                session.add(mother)
+            session.commit()
+
+    spec = {"entity": "beneficiary", "group_by": ["block"], "order_by": "block"}
+    result = run_query({**spec, "filters": [{"field": "state", "value": "Mizoram"}]})
+    assert result["rows"] == [{"block": "Aizawl / Central", "count": 2}, {"block": "Lunglei / Central", "count": 1}]
+    # Unpinned, the state leads
+    result = run_query({**spec, "filters": [{"field": "block", "value": "Central"}]})
+    assert [r["block"] for r in result["rows"]] == ["Mizoram / Aizawl / Central", "Mizoram / Lunglei / Central"]
+
+
+def test_merge_across_shards():
+    query = compile_query({"group_by": ["anemia"], "aggregates": [
+        {"fn": "count"}, {"fn": "avg", "field": "hb_level", "as": "mean_hb"}, {"fn": "min", "field": "hb_level"}]},
+        single_source=False)
+    assert not query.sql_ordered
+    rows = [
+        {"anemia": True, "count": 2, "mean_hb": 8.0, "__n_mean_hb": 2, "min_hb_level": 7.0},
+        {"anemia": True, "count": 3, "mean_hb": 10.0, "__n_mean_hb": 3, "min_hb_level": 9.0},
+        {"anemia": False, "count": 1, "mean_hb": None, "__n_mean_hb": 0, "min_hb_level": None},
+        {"anemia": False, "count": 4, "mean_hb": 12.0, "__n_mean_hb": 4, "min_hb_level": 11.0},
+    ]
+    merged = {row["anemia"]: row for row in _merge(rows, query)}
+    assert (merged[True]["count"], merged[True]["min_hb_level"]) == (5, 7.0)
+    assert merged[True]["mean_hb"] == pytest.approx(9.2)  # weighted by each side's count
+    assert (merged[False]["count"], merged[False]["mean_hb"], merged[False]["min_hb_level"]) == (5, 12.0, 11.0)
+
+
+@pytest.mark.parametrize("spec, message", [
+    ("x", "JSON object"),
+    ({"entity": ["x"]}, "'entity'"),
+    ({"entity": "mother"}, "'entity'"),
+    ({"filters": "x"}, "must be a list"),
+    ({"filters": ["x"]}, "Each filter"),
+    ({"filters": [{"field": "state", "op": ["eq"], "value": STATE}]}, "Unknown op"),
+    ({"filters": [{"field": "name", "value": "Asha"}]}, "Unknown field"),
+    ({"filters": [{"field": "hb_level", "op": "lt", "value": "low"}]}, "takes a number"),
+    ({"filters": [{"field": "risk_level_prebirth", "op": "gt", "value": "HIGH"}]}, "needs a number or date"),
+    ({"filters": [{"field": "state", "op": "lt", "value": STATE}]}, "supports eq"),
+    ({"filters": [{"field": "age", "op": "in", "value": list(range(201))}]}, "At most 200"),
+    ({"order_by": 5, "group_by": ["district"]}, "'order_by'"),
+    ({"order_by": "-nope", "group_by": ["district"]}, "'order_by'"),
+    ({"group_by": ["hb_level"]}, "Cannot group"),
+    ({"aggregates": [{"fn": ["sum"]}]}, "Each aggregate"),
+    ({"aggregates": [{"fn": "sum", "field": "blood_group"}]}, "number or bool"),
+    ({"aggregates": [{"fn": "count", "as": ["n"]}]}, "'as'"),
+    ({"limit": 0}, "'limit'"),
+    ({"limit": True}, "'limit'"),
+])
+def test_malformed_queries_are_rejected(spec, message):
+    with pytest.raises(HTTPException) as error:
+        main.query_analytics(spec)
+    assert error.value.status_code == 400 and message in error.value.detail
@@ -0,0 +1,64 @@
+"""The assistant's SSE progress events: the stage order for a question answered by the
+LLM-generated analysis, with the LLM, analysis frame, code cache and sandbox faked.
+
+No database (see conftest.py for the environment).
+"""
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "assistant.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+import orjson
+import pandas as pd
+
+import main
+
+
+class _FakeLLM:
+    def generate(self, prompt, accept=None):
+        return SimpleNamespace(text="def analyze(df):\n    return len(df)\n", model="fake", seconds=0.0)
+
+    def stream(self, prompt):
+        yield from ("There are ", "2 mothers.")
+
+
+class _NoCache:
+    def get(self, query, schema_hash, columns):
+        return None
+
+    def put(self, query, schema_hash, code):
+        pass
+
+    def discard(self, query, schema_hash):
+        pass
+
+
+def _events(response):
+    async def read():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    events = []
+    for block in asyncio.run(read()).decode().strip().split("\n\n"):
+        event, data = block.split("\n", 1)
+        events.append((event.removeprefix("event: "), orjson.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_llm_path_reports_its_stages_in_order(monkeypatch):
+    frame = pd.DataFrame({"age": [24, 31]})
+    monkeypatch.setattr(main, "match_intent", lambda query: None)
+    monkeypatch.setattr(main, "match_slice", lambda query: None)
+    monkeypatch.setattr(main, "llm", _FakeLLM())
+    monkeypatch.setattr(main, "analysis_frames", SimpleNamespace(entry=lambda: SimpleNamespace(
+        frame=frame, schema_hash="h", columns=list(frame.columns), digest="- age: int")))
+    monkeypatch.setattr(main, "code_cache", _NoCache())
+    monkeypatch.setattr(main, "sandbox", SimpleNamespace(run=lambda code, entry: len(entry.frame)))
+
+    events = _events(main.assistant_query_stream({"query": "How many mothers are registered?"}))
+    assert [(event, data.get("stage")) for event, data in events] == [
+        ("stage", "intent"), ("stage", "code_generated"), ("stage", "result_computed"),
+        ("token", None), ("token", None), ("done", None)]
+    assert events[0][1] == {"stage": "intent", "intent": "llm"}
+    assert events[-1][1]["response"] == "There are 2 mothers."
@@ -0,0 +1,126 @@
+"""CSV / NDJSON line-list exports: columns, one CSV line per child, score order, scoping
+and batching. Rows are seeded in a state of their own, so other tests' rows don't show up.
+
+Run with pytest (see conftest.py for the scratch database).
+"""
+import asyncio
+import csv
+import io
+import os
+import tempfile
+from datetime import date
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "exports.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+import orjson
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session
+
+import main
+from database import engine, async_engine, create_db_and_tables
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child
+from streaming import stream_csv, stream_ndjson
+
+STATE, DISTRICT = "Tripura", "West Tripura"
+
+
+def _seed():
+    create_db_and_tables()
+    with Session(engine) as session:
+        if session.exec(main.select(Beneficiary).where(Beneficiary.state == STATE)).first():
+            return
+        hospital = Hospital(name="Agartala PHC", state=STATE, district=DISTRICT, block="Agartala", type="Government")
+        asha = Beneficiary(name="Export Asha", age=22, address="Agartala", state=STATE, district=DISTRICT,
+                           block="Agartala", phone="9100000001")
+        bina = Beneficiary(name="Export Bina", age=31, address="Mohanpur", state=STATE, district=DISTRICT,
+                           block="Mohanpur", phone="9100000002")
+        session.add_all([hospital, asha, bina])
+        session.flush()
+        p_asha = Pregnancy(beneficiary_id=asha.id, hospital_id=hospital.id, lmp_date=date(2024, 1, 1),
+                           risk_level_prebirth="HIGH", risk_score_prebirth=0.6)
+        p_bina = Pregnancy(beneficiary_id=bina.id, hospital_id=hospital.id, lmp_date=date(2024, 5, 1),
+                           edd_date=date(2025, 2, 5), risk_level_prebirth="HIGH", risk_score_prebirth=0.9)
+        session.add_all([p_asha, p_bina])
+        session.flush()
+        delivery = Delivery(pregnancy_id=p_asha.id, hospital_id=hospital.id, delivery_date=date(2024, 10, 3),
+                            delivery_type="C-Section", gestational_age_weeks=35, birthweight_grams=2100,
+                            risk_level_postbirth="HIGH", risk_score_postbirth=0.75)
+        session.add(delivery)
+        session.flush()
+        session.add_all([Child(delivery_id=delivery.id, name="Twin A", sex="F", offtrack_flag=True),
+                         Child(delivery_id=delivery.id, name="Twin B", sex="M")])
+        session.commit()
+
+
+async def _download(response):
+    chunks = [chunk async for chunk in response.body_iterator]
+    await async_engine.dispose()
+    return b"".join(chunk if isinstance(chunk, bytes) else chunk.encode() for chunk in chunks).decode()
+
+
+def _call(endpoint, **params):
+    async def run():
+        response = await endpoint(**params)
+        return response, await _download(response)
+    return asyncio.run(run())
+
+
+def test_highrisk_csv_has_one_line_per_child_in_score_order():
+    _seed()
+    response, body = _call(main.export_highrisk_cases, format="csv", state=STATE)
+    assert response.media_type.startswith("text/csv")
+    assert f'filename="highrisk_{STATE}_{date.today().isoformat()}.csv"' in response.headers["content-disposition"]
+
+    reader = csv.DictReader(io.StringIO(body))
+    assert reader.fieldnames == main._HIGHRISK_CSV_COLUMNS
+    lines = [(r["type"], r["name"], r["child_name"], r["state"], r["district"]) for r in reader]
+    assert lines == [
+        ("Pregnancy", "Export Bina", "", STATE, DISTRICT),
+        ("Delivery", "Export Asha", "Twin A", STATE, DISTRICT),
+        ("Delivery", "Export Asha", "Twin B", STATE, DISTRICT),
+        ("Pregnancy", "Export Asha", "", STATE, DISTRICT),
+    ]
+
+
+def test_highrisk_ndjson_nests_children():
+    _seed()
+    response, body = _call(main.export_highrisk_cases, format="ndjson", state=STATE, district=DISTRICT, block="Agartala")
+    assert f"highrisk_{STATE}_West-Tripura_Agartala_" in response.headers["content-disposition"]
+    cases = [orjson.loads(line) for line in body.splitlines()]
+    assert [(c["type"], c["name"]) for c in cases] == [("Delivery", "Export Asha"), ("Pregnancy", "Export Asha")]
+    assert [child["name"] for child in cases[0]["children"]] == ["Twin A", "Twin B"]
+    assert cases[0]["block"] == "Agartala"
+
+
+def test_offtrack_csv():
+    _seed()
+    _, body = _call(main.export_offtrack_cases, format="csv", state=STATE)
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert [(r["child_name"], r["beneficiary"], r["block"], r["sex"]) for r in rows] == [
+        ("Twin A", "Export Asha", "Agartala", "F")]
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.export_offtrack_cases(format="xlsx", state=STATE))
+    assert error.value.status_code == 400
+
+
+def test_batches_join_up_to_the_whole_document():
+    rows = [{"a": i, "b": f"x{i}", "extra": "dropped"} for i in range(7)]
+
+    async def source():
+        for row in rows:
+            yield row
+
+    async def read(response):
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(read(stream_csv(source(), ["a", "b"], "t.csv", batch_rows=3)))
+    assert len(chunks) > 2
+    assert b"".join(chunks).decode().splitlines() == ["a,b"] + [f"{i},x{i}" for i in range(7)]
+
+    chunks = asyncio.run(read(stream_ndjson(source(), "t.ndjson", batch_rows=3)))
+    assert [orjson.loads(line) for line in b"".join(chunks).splitlines()] == rows
@@ -0,0 +1,128 @@
+"""Denormalized GeoUnit ids on Pregnancy / Delivery / Child follow their beneficiary through
+moves and re-links, in the database and on already-loaded instances.
+
+Run with pytest (see conftest.py for the scratch database).
+"""
+import asyncio
+import json
+import os
+import tempfile
+from datetime import date
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "geography.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+from sqlalchemy import select
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import main
+from database import engine, async_engine, create_db_and_tables
+from geography import filter_ids
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child, RiskRollup
+from rollups import apply_deltas
+
+GEO = ("state_id", "district_id", "block_id")
+
+
+def _ids(obj):
+    return tuple(getattr(obj, a) for a in GEO)
+
+
+def _stored(model, row_id):
+    with engine.connect() as conn:
+        return tuple(conn.execute(select(*(getattr(model, a) for a in GEO)).where(model.id == row_id)).one())
+
+
+def _assert_copies(owner, *facts):
+    for fact in facts:
+        assert _ids(fact) == _ids(owner), f"{type(fact).__name__} {fact.id} (loaded) lags its beneficiary"
+        assert _stored(type(fact), fact.id) == _ids(owner), f"{type(fact).__name__} {fact.id} (stored) lags"
+
+
+def test_fact_copies_follow_moves_and_relinks():
+    create_db_and_tables()
+    with Session(engine) as session:
+        hospital = Hospital(name="Geo Test PHC", state="Kerala", district="Thrissur", block="Chalakudy", type="Government")
+        meera = Beneficiary(name="Geo Meera", age=25, address="Chalakudy", state="Kerala", district="Thrissur",
+                            block="Chalakudy", phone="9000000001")
+        rani = Beneficiary(name="Geo Rani", age=29, address="Hajipur", state="Bihar", district="Vaishali",
+                           block="Hajipur", phone="9000000002")
+        session.add_all([hospital, meera, rani])
+        session.flush()
+        p1 = Pregnancy(beneficiary_id=meera.id, hospital_id=hospital.id, lmp_date=date(2024, 2, 1))
+        p2 = Pregnancy(beneficiary_id=rani.id, hospital_id=hospital.id, lmp_date=date(2024, 3, 1))
+        session.add_all([p1, p2])
+        session.flush()
+        d1 = Delivery(pregnancy_id=p1.id, hospital_id=hospital.id, delivery_date=date(2024, 11, 2),
+                      delivery_type="Normal", gestational_age_weeks=39, birthweight_grams=3000)
+        session.add(d1)
+        session.flush()
+        c1 = Child(delivery_id=d1.id, name="Geo Baby", offtrack_flag=True)
+        session.add(c1)
+        session.commit()
+        assert meera.state_id and meera.district_id and meera.block_id
+        _assert_copies(meera, p1, d1, c1)
+        _assert_copies(rani, p2)
+
+        # The mother moves: every fact below her follows
+        meera.state, meera.district, meera.block = "Kerala", "Ernakulam", "Kalamassery"
+        session.commit()
+        _assert_copies(meera, p1, d1, c1)
+
+        # A delivery re-linked by FK to the other mother's pregnancy takes its child along
+        d1.pregnancy_id = p2.id
+        session.commit()
+        _assert_copies(rani, d1, c1)
+
+        # ... and back again through the relationship
+        d1.pregnancy = p1
+        session.commit()
+        _assert_copies(meera, d1, c1)
+
+        # A pregnancy re-linked to another beneficiary restamps its delivery and child
+        p1.beneficiary_id = rani.id
+        session.commit()
+        _assert_copies(rani, p1, d1, c1)
+        child_id = c1.id
+
+    # Line lists name the geography from the dimension
+    geo = filter_ids(state="Bihar", district="Vaishali", block="Hajipur")
+
+    async def offtrack():
+        return [row async for row in main._offtrack_rows(geo)]
+    rows = asyncio.run(offtrack())
+    assert child_id and {"child_name": "Geo Baby", "state": "Bihar", "district": "Vaishali", "block": "Hajipur"}.items() \
+        <= next(r for r in rows if r["child_name"] == "Geo Baby").items()
+
+
+def test_public_payloads_keep_their_shape():
+    create_db_and_tables()
+    with Session(engine) as session:
+        session.add(Hospital(name="Geo Payload PHC", state="Kerala", district="Thrissur", block="Chalakudy",
+                             type="Government"))
+        session.commit()
+    # Rows whose beneficiary has no resolvable geography roll up under key 0
+    unassigned = {(RiskRollup, (0, 0, 0)): {"pregnancies": 1}}
+    with engine.begin() as conn:
+        apply_deltas(conn, unassigned)
+
+    async def fetch():
+        try:
+            async with AsyncSession(async_engine) as session:
+                summary = await main.get_authorizer_summary(session=session)
+            response = await main.get_authorizer_hospitals(state="Kerala")
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            return summary, json.loads(body)
+        finally:
+            await async_engine.dispose()
+    try:
+        summary, hospitals = asyncio.run(fetch())
+    finally:
+        with engine.begin() as conn:
+            apply_deltas(conn, unassigned, sign=-1)
+
+    # Unassigned is null, listed first, as when the breakdown was grouped on the name columns
+    assert summary["districts"][0]["district"] is None and summary["blocks"][0]["block"] is None
+    hospital = next(h for h in hospitals if h["name"] == "Geo Payload PHC")
+    assert set(hospital) == {"id", "name", "state", "district", "block", "type", "has_nicu"}
@@ -0,0 +1,71 @@
+"""The frozen migration steps must build exactly the schema models.py declares.
+
+Migrates an empty scratch database (not the shared test one) and compares tables,
+columns and index names with SQLModel.metadata.
+"""
+import os
+import tempfile
+
+from sqlmodel import SQLModel, create_engine
+
+import geography
+import models  # noqa: F401  (registers the tables on SQLModel.metadata)
+from migrations import migrate, LATEST_VERSION, current_version
+
+
+def _scratch_engine(name):
+    return create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), name)}")
+
+
+def _schema(conn):
+    tables = [row[0] for row in conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    columns = {t: {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{t}")')} for t in tables}
+    indexes = {row[0] for row in conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+    return columns, indexes
+
+
+def test_migrations_build_the_model_schema():
+    engine = _scratch_engine("migrations.db")
+    assert migrate(engine) == list(range(1, LATEST_VERSION + 1))
+    # A second run is a no-op
+    assert migrate(engine) == []
+
+    with engine.connect() as conn:
+        assert current_version(conn) == LATEST_VERSION
+        columns, indexes = _schema(conn)
+
+    expected_columns = {t.name: {c.name for c in t.columns} for t in SQLModel.metadata.sorted_tables}
+    expected_indexes = {i.name for t in SQLModel.metadata.sorted_tables for i in t.indexes}
+    assert columns == expected_columns
+    assert indexes == expected_indexes
+
+
+def test_geography_backfill_runs_once(monkeypatch):
+    engine = _scratch_engine("baseline.db")
+    # The dimension cache belongs to the app database; give this one its own
+    monkeypatch.setattr(geography, "engine", engine)
+    monkeypatch.setattr(geography, "_cache", geography._GeoCache())
+    monkeypatch.setattr(geography, "RCH_EXCEL_PATH", os.devnull + ".missing")  # FALLBACK_MAP is enough here
+    migrate(engine, target=1)
+    with engine.begin() as conn:
+        # Rows from the first release: no GeoUnit ids, one beneficiary without a resolvable state
+        conn.exec_driver_sql("INSERT INTO hospital (id, name, state, district, block, type, has_nicu) "
+                             "VALUES (1, 'PHC', 'Kerala', 'Ernakulam', 'Aluva', 'Government', 0)")
+        for ben_id, state, district in ((1, "Kerala", "Ernakulam"), (2, None, "Patna"), (3, None, "Nowhere")):
+            conn.exec_driver_sql(
+                "INSERT INTO beneficiary (id, name, age, address, state, district, block, phone, bpl_card, aadhaar_linked) "
+                "VALUES (?, 'Mother', 25, 'x', ?, ?, 'Block', '9', 0, 0)", (ben_id, state, district))
+    migrate(engine)
+
+    with engine.connect() as conn:
+        rows = dict(conn.exec_driver_sql("SELECT id, state_id FROM beneficiary").all())
+        states = dict(conn.exec_driver_sql("SELECT id, state FROM beneficiary").all())
+        version = conn.exec_driver_sql("SELECT version FROM dataversion").scalar()
+    assert rows[1] and rows[2] and rows[3] is None
+    assert states[2] == "Bihar"  # inferred from the district
+    # The unresolvable row does not trigger another backfill on the next start
+    assert migrate(engine) == []
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT version FROM dataversion").scalar() == version
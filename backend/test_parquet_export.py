@@ -0,0 +1,89 @@
+"""Incremental Parquet export: partitions by the beneficiary's state and registration month,
+rewrites only what changed, and keeps one change-log row per partition.
+
+Run with pytest (see conftest.py for the scratch database).
+"""
+import json
+import os
+import tempfile
+from datetime import date
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "parquet_export.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+import pyarrow.parquet as pq
+from sqlalchemy import func, select
+from sqlmodel import Session
+
+from database import engine, create_db_and_tables
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child, PartitionChange
+from parquet_export import export, mark_all_partitions, MANIFEST
+
+STATE = "Sikkim"
+
+
+def _log():
+    with engine.connect() as conn:
+        return conn.execute(select(PartitionChange.state, PartitionChange.month, func.count())
+                            .group_by(PartitionChange.state, PartitionChange.month)).all()
+
+
+def _rows(out, rel):
+    return pq.read_table(os.path.join(out, rel, "part-0.parquet")).to_pylist()
+
+
+def test_incremental_export_and_compact_log():
+    create_db_and_tables()
+    out = tempfile.mkdtemp()
+    with Session(engine) as session:
+        hospital = Hospital(name="Gangtok PHC", state=STATE, district="East Sikkim", block="Gangtok", type="Government")
+        mother = Beneficiary(name="Parquet Dolma", age=26, address="Gangtok", state=STATE, district="East Sikkim",
+                             block="Gangtok", phone="9200000001")
+        session.add_all([hospital, mother])
+        session.flush()
+        early = Pregnancy(beneficiary_id=mother.id, hospital_id=hospital.id, lmp_date=date(2022, 11, 10),
+                          registration_date=date(2023, 1, 20))
+        late = Pregnancy(beneficiary_id=mother.id, hospital_id=hospital.id, lmp_date=date(2024, 6, 1),
+                         registration_date=date(2024, 7, 15))
+        session.add_all([early, late])
+        session.flush()
+        delivery = Delivery(pregnancy_id=early.id, hospital_id=hospital.id, delivery_date=date(2023, 10, 12),
+                            delivery_type="Normal", gestational_age_weeks=39, birthweight_grams=3100)
+        session.add(delivery)
+        session.flush()
+        session.add_all([Child(delivery_id=delivery.id, name="Pema"), Child(delivery_id=delivery.id, name="Karma")])
+        session.commit()
+
+        # No manifest yet: a full export
+        assert export(out) > 0
+        assert _log() == []
+        manifest = json.load(open(os.path.join(out, MANIFEST)))
+        early_rel, late_rel = f"state={STATE}/month=2023-01", f"state={STATE}/month=2024-07"
+        assert manifest["partitions"][early_rel]["rows"] == 2  # one row per child
+        assert [r["child_name"] for r in _rows(out, early_rel)] == ["Pema", "Karma"]
+        assert [r["pregnancy_id"] for r in _rows(out, late_rel)] == [late.id]
+
+        # Repeated writes to one partition leave one log row
+        for weeks in (37, 38, 40):
+            delivery.gestational_age_weeks = weeks
+            session.commit()
+        assert _log() == [(STATE, "2023-01", 1)]
+        assert export(out) == 1
+        assert [r["delivery_gestational_age_weeks"] for r in _rows(out, early_rel)] == [40, 40]
+        assert export(out) == 0
+
+        # Moving the mother empties her old state's partitions
+        mother.state = "Assam"
+        session.commit()
+        assert export(out) == 2
+        manifest = json.load(open(os.path.join(out, MANIFEST)))
+        assert early_rel not in manifest["partitions"] and not os.path.exists(os.path.join(out, f"state={STATE}"))
+        assert manifest["partitions"]["state=Assam/month=2024-07"]["rows"] == 1
+
+    # A raw-SQL backfill mark collapses to one row too, and rewrites everything
+    with engine.begin() as conn:
+        mark_all_partitions(conn)
+        mark_all_partitions(conn)
+    assert _log() == [("*", "*", 1)]
+    assert export(out) == len(json.load(open(os.path.join(out, MANIFEST)))["partitions"])
+    assert _log() == []
@@ -0,0 +1,209 @@
+"""Query-plan regression test: every read endpoint's SQL must be served by an index.
+
+Builds a scratch database through migrations.py, seeds one row per table, calls the
+read endpoints directly, captures every SELECT they issue and runs
+`EXPLAIN QUERY PLAN` on it. Any `SCAN <table>` that doesn't use an index fails,
+unless that endpoint lists the table in its allowed scans (whole-table listings
+and the small rollup/dimension tables).
+
+Run with `python test_query_plans.py` (or pytest). Does not touch maatrinet.db.
+"""
+import asyncio
+import os
+import tempfile
+from datetime import date
+
+# Under pytest, conftest.py has already pointed every test at one scratch database
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "query_plans.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+from sqlalchemy import event
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import engine, async_engine, create_db_and_tables
+import geography
+from models import User, Hospital, Beneficiary, Pregnancy, Delivery, Child, SchemeApplication
+import main
+
+# Tables any endpoint may scan: the GeoUnit cache is loaded whole once per process
+ALWAYS_ALLOWED = {"geounit"}
+
+def _seed():
+    with Session(engine) as session:
+        hosp = Hospital(name="PHC Kochi", state="Kerala", district="Ernakulam", block="Kochi", type="Government")
+        session.add(hosp)
+        session.flush()
+        user = User(name="Mother", phone_or_email="mother@example.com", role="BENEFICIARY", password_hash="hashed_pass")
+        session.add(user)
+        session.add(User(name="Kerala Authorizer", phone_or_email="auth@example.com", role="AUTHORIZER",
+                         password_hash="x", state="Kerala"))
+        session.add(User(name="PHC Staff", phone_or_email="phc@example.com", role="HOSPITAL",
+                         password_hash="x", hospital_id=hosp.id))
+        session.flush()
+        ben = Beneficiary(name="Mother", rch_id="RCH1", age=27, address="Kochi", state="Kerala",
+                          district="Ernakulam", block="Kochi", phone="9999999999", linked_user_id=user.id)
+        session.add(ben)
+        session.flush()
+        preg = Pregnancy(beneficiary_id=ben.id, hospital_id=hosp.id, lmp_date=date(2024, 1, 1),
+                         risk_level_prebirth="HIGH", risk_score_prebirth=0.9)
+        session.add(preg)
+        session.flush()
+        delivery = Delivery(pregnancy_id=preg.id, hospital_id=hosp.id, delivery_date=date(2024, 10, 1),
+                            delivery_type="Normal", gestational_age_weeks=39, birthweight_grams=2900,
+                            risk_level_postbirth="HIGH", risk_score_postbirth=0.8)
+        session.add(delivery)
+        session.flush()
+        session.add(Child(delivery_id=delivery.id, name="Baby", offtrack_flag=True))
+        session.add(SchemeApplication(beneficiary_id=ben.id, pregnancy_id=preg.id, hospital_id=hosp.id,
+                                      scheme_type="JSY", status="SUBMITTED"))
+        session.commit()
+        ids = {"hospital_id": hosp.id, "user_id": user.id, "preg_id": preg.id}
+
+    with engine.begin() as conn:
+        # Plan as for a full-size database: without stats SQLite assumes large tables
+        if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").first():
+            conn.exec_driver_sql("DELETE FROM sqlite_stat1")
+            conn.exec_driver_sql("ANALYZE sqlite_master")
+    return ids
+
+def _calls(ids):
+    """(label, endpoint call, tables it may legitimately scan)"""
+    return [
+        ("admin overview", lambda s: main.get_admin_overview(session=s), {"hospital"}),
+        ("admin analytics", lambda s: main.get_admin_analytics(months=12, session=s), {"hospital", "monthlytrend"}),
+        ("summary (all states)", lambda s: main.get_authorizer_summary(session=s), {"riskrollup", "monthlytrend"}),
+        ("summary (state)", lambda s: main.get_authorizer_summary(state="Kerala", session=s), set()),
+        ("hospitals (all states)", lambda s: main.get_authorizer_hospitals(), {"hospital"}),
+        ("hospitals (state)", lambda s: main.get_authorizer_hospitals(state="Kerala"), set()),
+        ("highrisk (all states)", lambda s: main.get_highrisk_cases(), set()),
+        ("highrisk (state)", lambda s: main.get_highrisk_cases(state="Kerala"), set()),
+        ("offtrack (all states)", lambda s: main.get_offtrack_cases(), set()),
+        ("offtrack (state)", lambda s: main.get_offtrack_cases(state="Kerala"), set()),
+        ("offtrack (district)", lambda s: main.get_offtrack_cases(district="Ernakulam"), set()),
+        ("highrisk export (block)", lambda s: main.export_highrisk_cases(
+            format="csv", state="Kerala", district="Ernakulam", block="Kochi"), set()),
+        ("offtrack export", lambda s: main.export_offtrack_cases(format="ndjson", state="Kerala"), set()),
+        ("applications (status)", lambda s: main.get_authorizer_applications(status="SUBMITTED", session=s), set()),
+        ("applications (all)", lambda s: main.get_authorizer_applications(session=s), {"schemeapplication"}),
+        ("hospital dashboard", lambda s: main.get_hospital_dashboard(hospital_id=ids["hospital_id"], session=s), set()),
+        ("patient detail", lambda s: main.get_hospital_patient_detail(preg_id=ids["preg_id"], session=s), set()),
+        ("beneficiary dashboard", lambda s: main.get_beneficiary_dashboard(user_id=ids["user_id"], session=s), set()),
+        ("analytics query (state, by district)", lambda s: _sync(main.query_analytics, {
+            "entity": "pregnancy", "group_by": ["district"],
+            "filters": [{"field": "state", "value": "Kerala"}, {"field": "anemia", "value": True}]}), set()),
+        ("analytics query (risk, by state)", lambda s: _sync(main.query_analytics, {
+            "entity": "delivery", "group_by": ["state"], "filters": [{"field": "risk_level_postbirth", "value": "HIGH"}],
+            "aggregates": [{"fn": "avg", "field": "birthweight_grams"}]}), set()),
+        ("analytics query (district, by block)", lambda s: _sync(main.query_analytics, {
+            "entity": "child", "group_by": ["block"], "filters": [{"field": "district", "value": "Ernakulam"}]}), set()),
+        ("analytics query (off-track, mother's age)", lambda s: _sync(main.query_analytics, {
+            "entity": "child", "filters": [{"field": "offtrack_flag", "value": True}, {"field": "age", "op": "lt", "value": 20}]}),
+            set()),
+        ("analytics query (beneficiaries, state)", lambda s: _sync(main.query_analytics, {
+            "entity": "beneficiary", "group_by": ["district"], "filters": [{"field": "state", "value": "Kerala"}]}), set()),
+        ("analytics query (deliveries, district)", lambda s: _sync(main.query_analytics, {
+            "entity": "delivery", "group_by": ["delivery_type"], "filters": [{"field": "district", "value": "Ernakulam"}]}),
+            set()),
+        ("login", lambda s: _sync(main.login, {"phone_or_email": "mother@example.com", "password": "x"}), set()),
+    ]
+
+async def _sync(endpoint, *args):
+    return endpoint(*args)
+
+async def _run(call):
+    async with AsyncSession(async_engine) as session:
+        result = await call(session)
+        if hasattr(result, "body_iterator"):
+            # Streaming endpoints only query while the body is being sent
+            async for _ in result.body_iterator:
+                pass
+
+def _capture(call, loop):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+    # Read routes use the aiosqlite engine; geography lookups still go through the sync one
+    engines = (engine, async_engine.sync_engine)
+    for e in engines:
+        event.listen(e, "before_cursor_execute", before_cursor_execute)
+    try:
+        loop.run_until_complete(_run(call))
+    finally:
+        for e in engines:
+            event.remove(e, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+def _full_scans(statement, parameters):
+    """Table names the plan reads without an index."""
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    scans = set()
+    for row in plan:
+        detail = row[-1]
+        if not detail.startswith("SCAN ") or " USING " in detail:
+            continue
+        table = detail.split()[1]
+        if table in ("CONSTANT", "(subquery") or table.startswith("("):
+            continue
+        scans.add(table)
+    return scans
+
+def collect_regressions():
+    create_db_and_tables()
+    ids = _seed()
+    failures = []
+    # One loop for the whole run: pooled aiosqlite connections are bound to it
+    loop = asyncio.new_event_loop()
+    try:
+        for label, call, allowed in _calls(ids):
+            statements = _capture(call, loop)
+            assert statements, f"{label}: no SQL captured"
+            for statement, parameters in statements:
+                bad = _full_scans(statement, parameters) - allowed - ALWAYS_ALLOWED
+                if bad:
+                    failures.append((label, sorted(bad), " ".join(statement.split())))
+        loop.run_until_complete(async_engine.dispose())
+    finally:
+        loop.close()
+    return failures
+
+def test_no_full_scans():
+    failures = collect_regressions()
+    assert not failures, "\n".join(f"{label}: full scan of {tables}\n    {sql}" for label, tables, sql in failures)
+
+def test_async_routes_stay_off_the_sync_engine():
+    """Once the dimension is loaded, geography lookups in async routes must not block the event loop."""
+    create_db_and_tables()
+    with Session(engine) as session:
+        session.add(Hospital(name="PHC Aluva", state="Kerala", district="Ernakulam", block="Aluva", type="Government"))
+        session.commit()
+    geography._cache.ensure_loaded()
+
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    calls = [
+        lambda s: main.get_authorizer_summary(state="Kerala", session=s),
+        lambda s: main.get_authorizer_hospitals(state="Kerala"),
+        lambda s: main.get_highrisk_cases(state="Kerala", district="Ernakulam", block="Aluva"),
+    ]
+    loop = asyncio.new_event_loop()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for call in calls:
+            loop.run_until_complete(_run(call))
+        loop.run_until_complete(async_engine.dispose())
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        loop.close()
+    assert statements == []
+
+
+if __name__ == "__main__":
+    failures = collect_regressions()
+    for label, tables, sql in failures:
+        print(f"FULL SCAN  {label}: {tables}\n    {sql}")
+    print(f"\n{len(failures)} full-scan regression(s)" if failures else "All endpoint queries use indexes")
+    raise SystemExit(1 if failures else 0)
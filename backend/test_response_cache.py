@@ -0,0 +1,135 @@
+"""ResponseCacheMiddleware: hits, ETag revalidation, invalidation on writes, and streamed
+responses forwarded while they are being cached.
+
+Drives a small app through raw ASGI calls. Run with pytest (see conftest.py).
+"""
+import asyncio
+import os
+import tempfile
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "response_cache.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session
+
+from database import engine, async_engine, create_db_and_tables
+from data_version import bump_data_version
+from response_cache import ResponseCache, ResponseCacheMiddleware
+
+calls = {"summary": 0}
+gate = None  # set by the client once the first streamed chunk has arrived
+
+
+def _app(cache):
+    app = FastAPI()
+
+    @app.get("/summary")
+    def summary():
+        calls["summary"] += 1
+        return {"total": 42}
+
+    @app.get("/lines")
+    async def lines(rows: int = 2):
+        async def body():
+            yield b"[first"
+            # Blocks until the client has seen the first chunk; a buffering cache would deadlock
+            await asyncio.wait_for(gate.wait(), timeout=2)
+            for i in range(rows):
+                yield b",row%d" % i
+            yield b"]"
+        return StreamingResponse(body(), media_type="application/json")
+
+    app.add_middleware(ResponseCacheMiddleware, cache=cache, paths={"/summary", "/lines"})
+    return app
+
+
+async def _get(app, path, query="", headers=()):
+    """(status, headers, body) of a GET; sets `gate` as soon as the first body chunk arrives."""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+             "headers": [(k.encode(), v.encode()) for k, v in headers], "client": ("test", 1), "server": ("test", 80)}
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and message.get("body"):
+            gate.set()
+
+    await app(scope, receive, send)
+    start = messages[0]
+    response_headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], response_headers, body
+
+
+def _run(coro):
+    async def main():
+        global gate
+        gate = asyncio.Event()
+        try:
+            return await coro
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(main())
+
+
+def test_hits_revalidation_and_invalidation():
+    create_db_and_tables()
+    app = _app(ResponseCache())
+
+    async def scenario():
+        calls["summary"] = 0
+        status, headers, body = await _get(app, "/summary")
+        assert (status, headers["x-cache"], body) == (200, "MISS", b'{"total":42}')
+        status, headers, body = await _get(app, "/summary")
+        assert (status, headers["x-cache"], calls["summary"]) == (200, "HIT", 1)
+        status, _, body = await _get(app, "/summary", headers=[("if-none-match", headers["etag"])])
+        assert (status, body) == (304, b"")
+
+        # Any committed write moves the data version on
+        with Session(engine) as session:
+            bump_data_version(session.connection())
+            session.commit()
+        status, headers, _ = await _get(app, "/summary")
+        assert (headers["x-cache"], calls["summary"]) == ("MISS", 2)
+    _run(scenario())
+
+
+def test_streamed_response_is_forwarded_before_it_is_cached():
+    create_db_and_tables()
+    cache = ResponseCache()
+    app = _app(cache)
+
+    async def scenario():
+        status, headers, body = await _get(app, "/lines")
+        assert (status, headers["x-cache"], body) == (200, "MISS", b"[first,row0,row1]")
+        assert "content-length" not in headers
+
+        gate.clear()  # a hit is served from memory, without running the endpoint
+        status, headers, body = await _get(app, "/lines")
+        assert (status, headers["x-cache"], body) == (200, "HIT", b"[first,row0,row1]")
+        assert headers["etag"]
+    _run(scenario())
+
+
+def test_streamed_response_over_the_cap_is_not_cached():
+    create_db_and_tables()
+    cache = ResponseCache(max_body=64)
+    app = _app(cache)
+
+    async def scenario():
+        _, headers, body = await _get(app, "/lines", "rows=40")
+        assert headers["x-cache"] == "MISS" and len(body) > 64
+        _, headers, again = await _get(app, "/lines", "rows=40")
+        assert headers["x-cache"] == "MISS" and again == body
+    _run(scenario())
@@ -0,0 +1,121 @@
+"""Incremental rollups: after inserts, updates and deletes through the ORM, RiskRollup and
+MonthlyTrend must hold exactly what a full rebuild from the base tables computes.
+
+Run with pytest (see conftest.py for the scratch database).
+"""
+import os
+import tempfile
+from datetime import date
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "rollups.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+
+from sqlmodel import Session, select
+
+import geography  # noqa: F401  (stamps geography ids before the rollup hook runs)
+from database import engine, create_db_and_tables
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child, RiskRollup, MonthlyTrend
+from rollups import _KEYS, _rebuild_risk_rollups, _rebuild_monthly_trend
+
+
+def _table(rows, model):
+    """{key: counters} without all-zero rows (deltas can leave those behind) or the surrogate id."""
+    result = {}
+    for row in rows:
+        values = row.model_dump(exclude={"id"})
+        key = tuple(values.pop(k) for k in _KEYS[model])
+        counters = {c: round(v, 6) for c, v in values.items()}
+        if any(counters.values()):
+            result[key] = counters
+    return result
+
+
+def assert_matches_rebuild(session):
+    session.expire_all()
+    for model, rebuild in ((RiskRollup, _rebuild_risk_rollups), (MonthlyTrend, _rebuild_monthly_trend)):
+        maintained = _table(session.exec(select(model)).all(), model)
+        expected = _table(rebuild(session), model)
+        assert maintained == expected, f"{model.__name__} drifted from a rebuild"
+
+
+def _mother(session, name, state, district, block):
+    ben = Beneficiary(name=name, age=24, address=block, state=state, district=district, block=block, phone="9000000000")
+    session.add(ben)
+    session.flush()
+    return ben
+
+
+def _pregnancy(session, ben, hospital, level, registered, anc=2):
+    preg = Pregnancy(beneficiary_id=ben.id, hospital_id=hospital.id, registration_date=registered,
+                     lmp_date=date(registered.year, registered.month, 1), risk_level_prebirth=level,
+                     anc_visits_completed=anc, anc_expected=4)
+    session.add(preg)
+    session.flush()
+    return preg
+
+
+def _delivery(session, preg, hospital, level, delivered):
+    delivery = Delivery(pregnancy_id=preg.id, hospital_id=hospital.id, delivery_date=delivered, delivery_type="Normal",
+                        gestational_age_weeks=38, birthweight_grams=2800, risk_level_postbirth=level)
+    session.add(delivery)
+    session.flush()
+    return delivery
+
+
+def test_rollups_follow_inserts_updates_and_deletes():
+    create_db_and_tables()
+    with Session(engine) as session:
+        hospital = Hospital(name="Rollup Test PHC", state="Kerala", district="Ernakulam", block="Aluva", type="Government")
+        session.add(hospital)
+        session.flush()
+        anu = _mother(session, "Rollup Anu", "Kerala", "Ernakulam", "Aluva")
+        sita = _mother(session, "Rollup Sita", "Bihar", "Patna", "Danapur")
+        p1 = _pregnancy(session, anu, hospital, "HIGH", date(2023, 4, 10))
+        p2 = _pregnancy(session, anu, hospital, "LOW", date(2023, 6, 2), anc=4)
+        p3 = _pregnancy(session, sita, hospital, "MEDIUM", date(2023, 4, 20), anc=0)
+        d1 = _delivery(session, p1, hospital, "HIGH", date(2024, 1, 5))
+        d3 = _delivery(session, p3, hospital, "LOW", date(2024, 2, 1))
+        c1 = Child(delivery_id=d1.id, name="Rollup Twin A", offtrack_flag=True)
+        c2 = Child(delivery_id=d1.id, name="Rollup Twin B")
+        c3 = Child(delivery_id=d3.id, name="Rollup Baby")
+        session.add_all([c1, c2, c3])
+        session.commit()
+        assert_matches_rebuild(session)
+
+        # Rescoring, changed ANC visits, a new registration month and an off-track flip
+        p1.risk_level_prebirth = "LOW"
+        p3.anc_visits_completed = 3
+        p2.registration_date = date(2023, 7, 15)
+        d3.risk_level_postbirth = "HIGH"
+        c2.offtrack_flag = True
+        session.commit()
+        assert_matches_rebuild(session)
+
+        # A mother moves to another state, district and block with all her facts
+        anu.state, anu.district, anu.block = "Bihar", "Gaya", "Bodh Gaya"
+        session.commit()
+        assert_matches_rebuild(session)
+
+        # A delivery re-linked to another pregnancy (a data-entry correction)
+        d3.pregnancy_id = p2.id
+        session.commit()
+        assert_matches_rebuild(session)
+
+        # ... and a pregnancy re-linked through the relationship rather than the FK
+        p3.beneficiary = anu
+        session.commit()
+        assert_matches_rebuild(session)
+
+        # Deletes, children before their delivery
+        session.delete(c1)
+        session.commit()
+        assert_matches_rebuild(session)
+        session.delete(c2)
+        session.delete(d1)
+        session.commit()
+        assert_matches_rebuild(session)
+        session.delete(c3)
+        session.delete(d3)
+        session.delete(p3)
+        session.commit()
+        assert_matches_rebuild(session)
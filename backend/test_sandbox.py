@@ -0,0 +1,69 @@
+"""SandboxPool: results, the wall-clock / CPU / result-size limits, frame changes, and
+workers forked by the helper process rather than the (threaded) API process.
+
+No database; skipped where the pool runs code inline.
+"""
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from sandbox import SandboxPool, SandboxError, SandboxBusy, RenderedValue, FORK
+
+pytestmark = pytest.mark.skipif(not FORK, reason="no fork: the code runs inline, without limits")
+
+SUM = "def analyze(df):\n    return df['x'].sum()\n"
+
+
+def _entry(values):
+    return SimpleNamespace(frame=pd.DataFrame({"x": values}))
+
+
+def _parent(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        return int(f.read().rsplit(")", 1)[1].split()[1])
+
+
+def test_results_and_frames():
+    pool = SandboxPool(size=1, timeout=10)
+    first = _entry([1, 2, 3])
+    assert pool.run(SUM, first) == 6
+    assert isinstance(pool.run("def analyze(df):\n    return df['x'] * 2\n", first), RenderedValue)
+    worker = pool._idle[0]
+    if os.path.exists(f"/proc/{worker.pid}"):
+        assert _parent(worker.pid) != os.getpid()  # forked by the helper
+
+    # A new frame retires the old frame's workers
+    assert pool.run(SUM, _entry([10, 20])) == 30
+    assert pool._idle[0] is not worker and worker.exitcode is not None
+
+    with pytest.raises(SandboxError, match="not defined"):
+        pool.run("x = 1\n", first)
+    assert pool.stats()["killed"] == 0
+
+
+def test_limits():
+    pool = SandboxPool(size=1, cpu_seconds=1, timeout=3, max_result_kb=1)
+    entry = _entry(list(range(1000)))
+
+    with pytest.raises(SandboxError, match="too large"):
+        pool.run("def analyze(df):\n    return df['x'].tolist()\n", entry)
+    assert pool.run(SUM, entry) == 499500  # the worker survives an oversized result
+
+    with pytest.raises(SandboxError, match="CPU time"):
+        pool.run("def analyze(df):\n    while True:\n        pass\n", entry)
+    with pytest.raises(SandboxError, match="longer than 3 seconds"):
+        pool.run("import time\ndef analyze(df):\n    time.sleep(30)\n", entry)
+    assert pool.stats()["killed"] == 2
+    assert pool.run(SUM, entry) == 499500  # replaced
+
+
+def test_busy_pool_times_out():
+    pool = SandboxPool(size=1, timeout=0.5)
+    entry = _entry([1])
+    worker = pool._acquire(entry)  # the only worker, busy
+    with pytest.raises(SandboxBusy):
+        pool.run(SUM, entry)
+    pool._release(worker, healthy=True)
+    assert pool.run(SUM, entry) == 1
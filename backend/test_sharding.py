@@ -0,0 +1,132 @@
+"""Moving beneficiaries between the primary database and state shards: facts, rollups, data
+versions and export marks move with them, and the Parquet export reads every shard.
+
+Run with pytest (see conftest.py for the scratch database and shard directory).
+"""
+import json
+import os
+import tempfile
+from datetime import date
+from types import SimpleNamespace
+
+os.environ.setdefault("MAATRINET_DB", os.path.join(tempfile.mkdtemp(), "sharding.db"))
+os.environ.setdefault("MAATRINET_ENV", "test")
+os.environ.setdefault("MAATRINET_SHARD_DIR", os.path.join(tempfile.mkdtemp(), "shards"))
+
+from sqlmodel import Session, select
+
+import database
+import geography  # noqa: F401  (stamps geography ids before the rollup hook runs)
+from data_version import current_version
+from models import Hospital, Beneficiary, Pregnancy, Delivery, Child, PartitionChange
+from parquet_export import export, MANIFEST
+from sharding import ShardRouter, ID_STRIDE
+from test_rollups import assert_matches_rebuild
+
+
+def _marks(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(select(PartitionChange.state, PartitionChange.month)).all())
+
+
+def _versions(*engines):
+    versions = []
+    for engine in engines:
+        with engine.connect() as conn:
+            versions.append(current_version(conn))
+    return versions
+
+
+def test_rehome_moves_facts_and_derived_data():
+    database.create_db_and_tables()
+    router = ShardRouter()
+    out = tempfile.mkdtemp()
+    with Session(database.engine) as session:
+        hospital = Hospital(name="Panaji PHC", state="Goa", district="North Goa", block="Tiswadi", type="Government")
+        mother = Beneficiary(name="Shard Leela", age=27, address="Panaji", state="Goa", district="North Goa",
+                             block="Tiswadi", phone="9300000001")
+        session.add_all([hospital, mother])
+        session.flush()
+        preg = Pregnancy(beneficiary_id=mother.id, hospital_id=hospital.id, lmp_date=date(2024, 2, 1),
+                         registration_date=date(2024, 3, 5), risk_level_prebirth="HIGH", anc_visits_completed=2,
+                         anc_expected=4)
+        session.add(preg)
+        session.flush()
+        delivery = Delivery(pregnancy_id=preg.id, hospital_id=hospital.id, delivery_date=date(2024, 11, 9),
+                            delivery_type="Normal", gestational_age_weeks=38, birthweight_grams=2900,
+                            risk_level_postbirth="LOW")
+        session.add(delivery)
+        session.flush()
+        session.add(Child(delivery_id=delivery.id, name="Shard Baby", offtrack_flag=True))
+        session.commit()
+        ben_id, preg_id, delivery_id = mother.id, preg.id, delivery.id
+    export(out, full=True, router=router)
+    assert not _marks(database.engine)
+
+    # Split her out of the primary
+    goa = router.shard("Goa")
+    before = _versions(database.engine, goa.engine)
+    assert router.rehome(database.engine, database.sqlite_file_name, {ben_id}) == {"goa": 1}
+    assert [v - b for v, b in zip(_versions(database.engine, goa.engine), before)] == [1, 1]
+    with Session(database.engine) as session:
+        assert session.get(Beneficiary, ben_id) is None and session.get(Pregnancy, preg_id) is None
+        assert_matches_rebuild(session)
+    with Session(goa.engine) as session:
+        assert session.exec(select(Child.name).join(Delivery).where(Delivery.pregnancy_id == preg_id)).all() \
+            == ["Shard Baby"]
+        assert_matches_rebuild(session)
+    # Only her partition is marked, on both sides
+    assert _marks(database.engine) == _marks(goa.engine) == {("Goa", "2024-03")}
+
+    # The export finds her rows in the shard instead of dropping the partition
+    assert export(out, router=router) == 1
+    manifest = json.load(open(os.path.join(out, MANIFEST)))
+    assert manifest["partitions"]["state=Goa/month=2024-03"]["rows"] == 1
+    assert not _marks(database.engine) and not _marks(goa.engine)
+
+    # A write in the shard gives the new row an id from the shard's range, and is exported
+    with goa.session() as session:
+        session.add(Child(delivery_id=delivery_id, name="Shard Twin"))
+        session.commit()
+    with Session(goa.engine) as session:
+        twin_id = session.exec(select(Child.id).where(Child.name == "Shard Twin")).one()
+    assert router.shard_for_id(twin_id) is goa and twin_id >= ID_STRIDE
+    assert export(out, router=router) == 1
+    assert json.load(open(os.path.join(out, MANIFEST)))["partitions"]["state=Goa/month=2024-03"]["rows"] == 2
+
+    # She moves state: the profile write marks both states, the rehome moves her to the new shard
+    with goa.session() as session:
+        session.get(Beneficiary, ben_id).state = "Manipur"
+        session.commit()
+    assert router.rehome(goa.engine, goa.path, {ben_id}) == {"manipur": 1}
+    manipur = router.shard("Manipur")
+    for shard in (goa, manipur):
+        with Session(shard.engine) as session:
+            assert_matches_rebuild(session)
+    assert export(out, router=router) == 1  # Manipur written; Goa, now empty, removed
+    partitions = json.load(open(os.path.join(out, MANIFEST)))["partitions"]
+    assert "state=Goa/month=2024-03" not in partitions
+    assert partitions["state=Manipur/month=2024-03"]["rows"] == 2
+
+
+def test_warm_up_moves_seeded_facts_into_shards(monkeypatch):
+    import main
+    database.create_db_and_tables()
+    router = ShardRouter()
+    with Session(database.engine) as session:
+        mother = Beneficiary(name="Seeded Pema", age=24, address="Gangtok", state="Sikkim", district="East Sikkim",
+                             block="Gangtok", phone="9300000002")
+        session.add(mother)
+        session.commit()
+        ben_id = mother.id
+
+    # Only her, so the other modules' rows stay in the shared scratch database
+    monkeypatch.setattr(main, "seed_data_if_empty", lambda: None)
+    monkeypatch.setattr(main, "shard_router", SimpleNamespace(
+        rehome=lambda engine, path: router.rehome(engine, path, {ben_id})))
+    main.prepare_database()
+    with Session(database.engine) as session:
+        assert session.get(Beneficiary, ben_id) is None
+    with Session(router.shard("Sikkim").engine) as session:
+        assert session.get(Beneficiary, ben_id).name == "Seeded Pema"
+        assert_matches_rebuild(session)
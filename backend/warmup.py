@@ -0,0 +1,138 @@
+"""
+Background warm-up: the Excel seed import and derived tables are built after the
+server starts listening, so liveness probes pass immediately and a slow import no
+longer gets the process killed.
+
+Phases: migrating -> waiting (for another worker holding the startup lock) -> seeding
+-> deriving (geography ids, rollups) -> sharding (MAATRINET_SHARDS only: seeded facts
+move out of the primary) -> ready, or failed. `/health/live` answers 200 throughout
+(503 only once warm-up has failed); `/health/ready` answers 503 with the
+phase and import progress until ready:
+
+    {"status": "warming_up", "phase": "seeding", "rows_done": 1250, "rows_total": 5000,
+     "rows_per_second": 410.2, "eta_seconds": 9.1, ...}
+
+Until then every /api/ route returns the same 503 with a Retry-After header. The
+worker that seeds publishes its progress to a small file next to the database, so
+workers still waiting on the startup lock report the same numbers.
+"""
+import json
+import os
+import time
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+
+import database
+
+PUBLISH_SECONDS = 1.0  # how often the seeding worker rewrites the shared progress file
+
+
+class WarmupState:
+    def __init__(self, progress_path):
+        self.progress_path = progress_path
+        self.phase = "migrating"
+        self.rows_done = 0
+        self.rows_total = None
+        self.started = None  # time.time() the current phase began
+        self.error = None
+        self._published = 0.0
+
+    @property
+    def ready(self):
+        return self.phase == "ready"
+
+    def begin(self, phase, rows_total=None):
+        self.phase = phase
+        self.rows_total = rows_total
+        self.rows_done = 0
+        self.started = time.time()
+        self._publish(force=True)
+
+    def advance(self, rows_done):
+        self.rows_done = rows_done
+        self._publish()
+
+    def finish(self):
+        self.begin("ready")
+
+    def fail(self, error):
+        self.error = str(error)
+        self.begin("failed")
+
+    def _own(self):
+        elapsed = time.time() - self.started if self.started else 0.0
+        rate = self.rows_done / elapsed if elapsed > 0 and self.rows_done else None
+        remaining = self.rows_total - self.rows_done if self.rows_total else None
+        return {
+            "phase": self.phase,
+            "rows_done": self.rows_done,
+            "rows_total": self.rows_total,
+            "rows_per_second": round(rate, 1) if rate else None,
+            "eta_seconds": round(remaining / rate, 1) if rate and remaining is not None else None,
+            "phase_seconds": round(elapsed, 1),
+            "error": self.error,
+            "pid": os.getpid(),
+        }
+
+    def _publish(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._published < PUBLISH_SECONDS:
+            return
+        self._published = now
+        temp_path = f"{self.progress_path}.{os.getpid()}"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self._own(), f)
+            os.replace(temp_path, self.progress_path)
+        except OSError:
+            pass  # progress reporting must never break the import
+
+    def snapshot(self):
+        """Progress of this process; while waiting on another worker, that worker's progress."""
+        own = self._own()
+        if self.phase != "waiting":
+            return own
+        try:
+            with open(self.progress_path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            return own
+        return {**other, "phase": "waiting", "seeding_pid": other.get("pid"), "pid": own["pid"]}
+
+    def describe(self, progress):
+        if progress["phase"] in ("seeding", "waiting") and progress.get("rows_total"):
+            return f"importing seed data ({progress['rows_done']:,} of {progress['rows_total']:,} rows)"
+        return {
+            "migrating": "updating the database schema",
+            "waiting": "waiting for another worker to prepare the database",
+            "seeding": "importing seed data",
+            "deriving": "building dashboard aggregates",
+            "failed": f"database preparation failed: {self.error}",
+        }.get(progress["phase"], progress["phase"])
+
+
+warmup = WarmupState(database.sqlite_file_name + ".seed-progress")
+
+
+def warming_up_response(state=warmup):
+    progress = state.snapshot()
+    eta = progress.get("eta_seconds")
+    return JSONResponse(
+        {
+            "detail": f"MaatriNet is warming up: {state.describe(progress)}. Please retry shortly.",
+            "warming_up": True,
+            "progress": progress,
+        },
+        status_code=503,
+        headers={"Retry-After": str(max(1, min(30, int(eta)))) if eta else "5"},
+    )
+
+
+class WarmupMiddleware(BaseHTTPMiddleware):
+    """Answer /api/ requests with a 503 "warming up" response until the data is loaded."""
+
+    async def dispatch(self, request, call_next):
+        if warmup.ready or not request.url.path.startswith("/api/"):
+            return await call_next(request)
+        return warming_up_response()
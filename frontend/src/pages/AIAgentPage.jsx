@@ -1,10 +1,16 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import { Bot, Mic, Send, X, MessageCircle, ChevronDown, Activity, Shield, ArrowLeft, BarChart2 } from 'lucide-react';
-import axios from 'axios';
 import { useNavigate } from 'react-router-dom';
 import { BarChart, Bar, XAxis, YAxis, Tooltip as RechartsTooltip, ResponsiveContainer, CartesianGrid, LineChart, Line, PieChart, Pie, Cell } from 'recharts';
 
+// Progress shown while the assistant works (see /api/assistant/query/stream)
+const STAGE_LABELS = {
+    intent: 'Found a matching report…',
+    code_generated: 'Analysing the data…',
+    result_computed: 'Writing the answer…'
+};
+
 const AIAgentPage = () => {
     const navigate = useNavigate();
     const [messages, setMessages] = useState([
@@ -25,29 +31,55 @@ const AIAgentPage = () => {
         setInputValue('');
         setIsSending(true);
 
-        try {
-            // Simulated delay for realism
-            setMessages(prev => [...prev, { type: 'loading' }]);
+        // The reply placeholder is updated in place as the server streams its progress
+        const replyId = Date.now();
+        const updateReply = (changes) => setMessages(prev => prev.map(m => m.id === replyId ? { ...m, ...changes } : m));
 
-            const response = await axios.post('http://localhost:8000/api/assistant/query', { query: text });
+        try {
+            setMessages(prev => [...prev, { type: 'loading', id: replyId }]);
 
-            // Remove loading and add Bot Message
-            setMessages(prev => {
-                const filtered = prev.filter(m => m.type !== 'loading');
-                return [...filtered, {
-                    type: 'bot',
-                    text: response.data.response,
-                    action: response.data.action,
-                    plot_data: response.data.plot_data
-                }];
+            const response = await fetch('http://localhost:8000/api/assistant/query/stream', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ query: text })
             });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+
+            const handleEvent = (event, data) => {
+                if (event === 'stage') {
+                    updateReply({ stage: STAGE_LABELS[data.stage] });
+                } else if (event === 'plot') {
+                    updateReply({ type: 'bot', text: data.description, action: 'plot', plot_data: data });
+                } else if (event === 'token') {
+                    setMessages(prev => prev.map(m => m.id !== replyId ? m
+                        : m.type === 'loading' ? { type: 'bot', id: replyId, text: data.text }
+                        : { ...m, text: m.text + data.text }));
+                } else if (event === 'done') {
+                    updateReply({ type: 'bot', text: data.response, action: data.action, plot_data: data.plot_data });
+                }
+            };
+
+            // Server-Sent Events: "event: <name>\ndata: <json>" blocks separated by blank lines
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let end;
+                while ((end = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.slice(0, end);
+                    buffer = buffer.slice(end + 2);
+                    const event = block.match(/^event: (.*)$/m)?.[1];
+                    const data = block.match(/^data: (.*)$/m)?.[1];
+                    if (event && data) handleEvent(event, JSON.parse(data));
+                }
+            }
 
         } catch (error) {
             console.error("Assistant Error:", error);
-            setMessages(prev => {
-                const filtered = prev.filter(m => m.type !== 'loading');
-                return [...filtered, { type: 'bot', text: "Connection to Sentinel Core interrupted. Please try again." }];
-            });
+            updateReply({ type: 'bot', text: "Connection to Sentinel Core interrupted. Please try again." });
         } finally {
             setIsSending(false);
         }
@@ -162,6 +194,7 @@ const AIAgentPage = () => {
                                                 <span className="w-2 h-2 bg-slate-500 rounded-full animate-bounce" style={{ animationDelay: '0ms' }} />
                                                 <span className="w-2 h-2 bg-slate-500 rounded-full animate-bounce" style={{ animationDelay: '150ms' }} />
                                                 <span className="w-2 h-2 bg-slate-500 rounded-full animate-bounce" style={{ animationDelay: '300ms' }} />
+                                                {msg.stage && <span className="ml-2 text-sm">{msg.stage}</span>}
                                             </div>
                                         ) : (
                                             <div className="space-y-4">